@@ -0,0 +1,118 @@
+"""
+Замер архивации бэкапа: shutil.make_archive (прежний способ: deflate 6 для всех файлов в один поток)
+против write_backup_archive с разными форматами, уровнями и числом потоков. Для каждого варианта
+выводятся время и размер архива.
+
+Синтетическая папка бэкапа похожа на сервер iiko: jar-файлы (уже сжаты, сохраняются без сжатия),
+текстовые ресурсы, крупные логи Tomcat и исполняемый файл. Архив пишется в счетчик байт, без диска.
+
+    python bench/backup_archive.py --variants deflate:1:4,zstd:3:4,lzma:6:4
+    python bench/backup_archive.py --path D:\\backups\\RMS_backup
+"""
+import argparse
+import configparser
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import iiko_updater
+
+DEFAULT_VARIANTS = 'store:0:1,deflate:1:1,deflate:1:4,deflate:6:1,deflate:6:4,deflate:9:4,lzma:6:4,zstd:1:4,zstd:3:4,zstd:9:4'
+
+
+def build_backup(root, scale):
+    """Папка бэкапа примерно 200 МБ * scale."""
+    rng = random.Random(7)
+    words = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 10))) for _ in range(3000)]
+    def text(size):
+        lines, written = [], 0
+        while written < size:
+            line = ' '.join(rng.choice(words) for _ in range(12)) + '\n'
+            lines.append(line)
+            written += len(line)
+        return ''.join(lines).encode()
+
+    lib = os.path.join(root, 'exploded', 'WEB-INF', 'lib')
+    os.makedirs(lib)
+    for i in range(int(60 * scale)):
+        with zipfile.ZipFile(os.path.join(lib, f'lib{i}.jar'), 'w', zipfile.ZIP_DEFLATED) as jar:
+            for k in range(20): jar.writestr(f'c/{k}.class', text(rng.randint(20000, 120000)))
+    for d in range(int(30 * scale)):
+        resources = os.path.join(root, 'exploded', 'res', f'm{d}')
+        os.makedirs(resources)
+        for k in range(30):
+            with open(os.path.join(resources, f'f{k}.xml'), 'wb') as f: f.write(text(rng.randint(1000, 60000)))
+    logs = os.path.join(root, 'logs')
+    os.makedirs(logs)
+    for k in range(4):
+        with open(os.path.join(logs, f'server{k}.log'), 'wb') as f:
+            for j in range(int(300000 * scale)):
+                f.write(f'2026-10-18 09:{j % 60:02d}:{j % 60:02d},{j % 1000:03d} INFO  [http-nio-{j % 16}] '
+                        f'com.iiko.{rng.choice(words)}.{rng.choice(words)} - request {j} done in {rng.randint(1, 900)} ms\n'.encode())
+    os.makedirs(os.path.join(root, 'tomcat9', 'bin'))
+    with open(os.path.join(root, 'tomcat9', 'bin', 'tomcat9.exe'), 'wb') as f: f.write(os.urandom(2000000))
+
+
+class ByteCounter:
+    """Файловый объект, который только считает записанные байты."""
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def report(label, seconds, size):
+    print(f"{label:<36}{seconds:7.2f} с {size / 1024 / 1024:8.1f} МБ")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--path', help="существующая папка бэкапа (по умолчанию создается синтетическая)")
+    parser.add_argument('--scale', type=float, default=1.0, help="масштаб синтетической папки (1 - около 200 МБ)")
+    parser.add_argument('--variants', default=DEFAULT_VARIANTS, help="формат:уровень:потоки через запятую")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='backup_bench_')
+    backup_path = args.path
+    try:
+        if not backup_path:
+            backup_path = os.path.join(work_dir, 'RMS_backup')
+            build_backup(backup_path, args.scale)
+        total = sum(os.path.getsize(os.path.join(r, f)) for r, _, files in os.walk(backup_path) for f in files)
+        print(f"Папка бэкапа: {total / 1024 / 1024:.0f} МБ, процессоров: {os.cpu_count()}")
+
+        started = time.perf_counter()
+        archive = shutil.make_archive(os.path.join(work_dir, 'reference'), 'zip', root_dir=os.path.dirname(backup_path),
+                                      base_dir=os.path.basename(backup_path))
+        report("make_archive (прежний способ)", time.perf_counter() - started, os.path.getsize(archive))
+        os.remove(archive)
+
+        for variant in args.variants.split(','):
+            backup_format, level, workers = variant.split(':')
+            if backup_format == 'zstd' and iiko_updater.zstandard is None:
+                print(f"{variant:<36}пропущен: не установлен zstandard")
+                continue
+            config = configparser.ConfigParser()
+            config.read_dict(iiko_updater.DEFAULT_CONFIG)
+            config['Backup'].update(format=backup_format, level=level, workers=workers)
+            settings = iiko_updater.get_transfer_settings(config)
+            counter = ByteCounter()
+            started = time.perf_counter()
+            iiko_updater.write_backup_archive(counter, backup_path, settings)
+            report(f"{backup_format} уровень {level}, потоков {workers}", time.perf_counter() - started, counter.size)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
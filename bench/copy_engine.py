@@ -0,0 +1,90 @@
+"""
+Микрозамер копирования файла: прежний цикл read/write по 1 МБ с обновлением tqdm на каждый блок
+против copy_file (copy_file_range/sendfile там, где ОС их поддерживает, иначе readinto в один буфер)
+при разных размерах блока. Отдельно замеряется copy_file без копирования средствами ядра.
+
+Файлы берутся из кэша ОС, поэтому замер показывает накладные расходы самого цикла копирования,
+а не скорость диска или сети. Для замера на SMB укажите --dir на сетевом ресурсе.
+
+    python bench/copy_engine.py --size-mb 512 --block-kb 64,1024,4096
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+from tqdm import tqdm
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import iiko_updater
+
+
+def copy_read_write(src_path, dst_path, progress, chunk_size=1024 * 1024):
+    """Прежний цикл из download_update_archive, upload_backup и download_and_place_installers."""
+    with open(src_path, 'rb') as fsrc, open(dst_path, 'wb') as fdst:
+        while True:
+            chunk = fsrc.read(chunk_size)
+            if not chunk: break
+            fdst.write(chunk)
+            progress.update(len(chunk))
+
+
+@contextmanager
+def without_kernel_copy():
+    """Скрывает os.copy_file_range и os.sendfile, чтобы copy_file копировал через readinto."""
+    hidden = {name: getattr(os, name) for name in ('copy_file_range', 'sendfile') if hasattr(os, name)}
+    for name in hidden: delattr(os, name)
+    try:
+        yield
+    finally:
+        for name, func in hidden.items(): setattr(os, name, func)
+
+
+def best_time(func, repeat, dst_path):
+    times = []
+    for _ in range(repeat):
+        # Без удаления каждый замер включал бы освобождение блоков при усечении прошлой копии
+        if os.path.exists(dst_path): os.remove(dst_path)
+        started = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=int, default=512, help="размер тестового файла")
+    parser.add_argument('--block-kb', default='64,1024,4096', help="размеры блока copy_file через запятую")
+    parser.add_argument('--repeat', type=int, default=3, help="повторов каждого замера, берется лучший")
+    parser.add_argument('--dir', help="каталог для тестовых файлов (по умолчанию временный)")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='copy_bench_', dir=args.dir)
+    src_path, dst_path = os.path.join(work_dir, 'src.bin'), os.path.join(work_dir, 'dst.bin')
+    size = args.size_mb * 1024 * 1024
+    try:
+        with open(src_path, 'wb') as f:
+            block = os.urandom(1024 * 1024)
+            for _ in range(args.size_mb): f.write(block)
+
+        with open(os.devnull, 'w') as devnull, tqdm(total=size * 100, unit='B', file=devnull, ascii=True) as progress:
+            def report(label, func):
+                seconds = best_time(func, args.repeat, dst_path)
+                assert os.path.getsize(dst_path) == size
+                print(f"{label:<40}{seconds:8.3f} с  {size / seconds / 1024 / 1024:8.0f} МБ/с")
+
+            report("read/write 1 МБ (прежний цикл)", lambda: copy_read_write(src_path, dst_path, progress))
+            for block_kb in (int(b) for b in args.block_kb.split(',')):
+                copy = lambda: iiko_updater.copy_file(src_path, dst_path, 'bench', block_size=block_kb * 1024, progress=progress)
+                report(f"copy_file, блок {block_kb} КБ", copy)
+                with without_kernel_copy():
+                    report(f"copy_file без ядра (readinto), {block_kb} КБ", copy)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
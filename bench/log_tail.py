@@ -0,0 +1,114 @@
+"""
+Замер отслеживания startup.log на большом синтетическом логе: прежний monitor_log_in_thread (каждую
+секунду открывает файл заново и читает весь остаток одним read()) против текущего (LogTailer, постоянный
+дескриптор и чтение частями по LOG_READ_CHUNK). Сообщение об успешном запуске стоит в конце лога.
+
+Каждый вариант выполняется в отдельном процессе, чтобы пиковая память (ru_maxrss) не смешивалась.
+Вывод строк лога уходит в os.devnull. Пиковая память выводится только там, где есть модуль resource.
+
+    python bench/log_tail.py --size-mb 300
+"""
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import iiko_updater
+from iiko_updater import cprint, decode_bytes_with_fallbacks
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def monitor_log_reopen(log_path, stop_event, success_event, success_message):
+    """Прежняя реализация monitor_log_in_thread."""
+    last_pos = 0
+    while not stop_event.is_set():
+        try:
+            if not os.path.exists(log_path):
+                time.sleep(1)
+                continue
+            with open(log_path, 'rb') as f:
+                f.seek(last_pos)
+                chunk = f.read()
+                if chunk:
+                    decoded_chunk = decode_bytes_with_fallbacks(chunk, fallbacks=['utf-8', 'cp1251', 'cp866'], errors='ignore')
+                    if decoded_chunk:
+                        for line in decoded_chunk.splitlines():
+                            print(f"    {line}")
+                            if success_message in line:
+                                success_event.set()
+                                return
+                    last_pos = f.tell()
+        except Exception as e:
+            cprint(f"\n  (Ошибка в потоке-наблюдателе: {e})", 'warning')
+        time.sleep(iiko_updater.LOG_POLL_INTERVAL)
+
+
+def build_log(path, size_mb):
+    """Лог Tomcat с русскими и английскими словами, строки CRLF, в конце - сообщение об успешном запуске."""
+    rng = random.Random(1)
+    words = ['INFO', 'DEBUG', 'Загрузка', 'модуля', 'resto.back', 'Инициализация', 'кэша', 'com.iiko', 'ОК', 'запрос', 'таблица']
+    with open(path, 'wb') as f:
+        written, n = 0, 0
+        while written < size_mb * 1024 * 1024:
+            line = f"2026-10-18 10:{n % 60:02d} [{rng.choice(words)}] " + ' '.join(rng.choice(words) for _ in range(12)) + "\r\n"
+            written += f.write(line.encode('utf-8'))
+            n += 1
+        f.write(f"2026-10-18 11:00 INFO {iiko_updater.SUCCESS_LOG_MESSAGE}\r\n".encode('utf-8'))
+
+
+def run_variant(variant, log_path):
+    """Выполняется в дочернем процессе: отслеживает лог до сообщения об успехе и печатает результат."""
+    monitor = monitor_log_reopen if variant == 'reopen' else iiko_updater.monitor_log_in_thread
+    stop_event, success_event = threading.Event(), threading.Event()
+    report = sys.stdout
+    sys.stdout = open(os.devnull, 'w', encoding='utf-8')
+    started = time.perf_counter()
+    thread = threading.Thread(target=monitor, args=(log_path, stop_event, success_event, iiko_updater.SUCCESS_LOG_MESSAGE))
+    thread.start()
+    success_event.wait(600)
+    seconds = time.perf_counter() - started
+    stop_event.set()
+    thread.join()
+    sys.stdout = report
+    # ru_maxrss: килобайты в Linux, байты в macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024) if resource else None
+    print(f"{seconds:.2f} {peak if peak is not None else -1:.0f} {int(success_event.is_set())}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=int, default=300, help="размер синтетического лога")
+    parser.add_argument('--run', choices=('reopen', 'tailer'), help=argparse.SUPPRESS)
+    parser.add_argument('--log', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        run_variant(args.run, args.log)
+        return
+
+    work_dir = tempfile.mkdtemp(prefix='log_bench_')
+    try:
+        log_path = os.path.join(work_dir, iiko_updater.LOG_FILE_NAME)
+        build_log(log_path, args.size_mb)
+        print(f"Лог: {os.path.getsize(log_path) / 1024 / 1024:.0f} МБ")
+        for variant, label in (('reopen', "прежний (read() всего остатка)"), ('tailer', "LogTailer")):
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), '--run', variant, '--log', log_path],
+                                    capture_output=True, text=True, check=True).stdout
+            seconds, peak, found = output.split()
+            peak = f"{peak} МБ" if peak != '-1' else 'н/д'
+            print(f"{label:<34}{float(seconds):7.2f} с  пик памяти {peak:>8}  сообщение {'найдено' if found == '1' else 'НЕ найдено'}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Замер поиска версий на SMB: прежний обход (os.listdir + os.path.isdir на каждый элемент, затем listdir
+каждой папки версии, все последовательно) против find_versions_on_smb (os.scandir и пул потоков).
+
+На локальном диске обращения к файловой системе почти бесплатны, поэтому задержка сетевого запроса
+SMB эмулируется: каждый вызов listdir/scandir/isdir/stat ждет --latency-ms. Для замера на настоящем
+ресурсе укажите --path (дерево не создается, задержка не добавляется).
+
+    python bench/smb_discovery.py --versions 3000 --latency-ms 2 --workers 8
+    python bench/smb_discovery.py --path \\\\server\\iiko_updates --workers 8
+"""
+import argparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import iiko_updater
+
+
+def find_versions_listdir(smb_path):
+    """Прежняя реализация find_versions_on_smb (без вывода сообщений)."""
+    available_versions = {}
+    if not os.path.isdir(smb_path): return {}
+    directories = [item for item in os.listdir(smb_path) if os.path.isdir(os.path.join(smb_path, item))]
+    for version_dir in directories:
+        if not re.match(r'^[\d\.]+$', version_dir): continue
+        version_full_path = os.path.join(smb_path, version_dir)
+        try:
+            files_in_dir = os.listdir(version_full_path)
+        except OSError:
+            continue
+        found_archives = [f for f in files_in_dir if f.lower().endswith('.zip') and ('chain' in f.lower() or 'rms' in f.lower())]
+        if found_archives:
+            available_versions[f"SMB {version_dir}"] = {'source': 'smb', 'version': version_dir, 'path': version_full_path, 'archives': found_archives}
+    return available_versions
+
+
+def build_tree(root, versions, other_dirs):
+    """Папки версий с архивами RMS/Chain и установщиками, плюс посторонние папки и файлы в корне."""
+    for i in range(versions):
+        version_dir = os.path.join(root, f"8.{i // 100}.{i % 100}.{1000 + i}")
+        os.makedirs(os.path.join(version_dir, 'Installers'))
+        for name in ('RMS.zip', 'Chain.zip', 'readme.txt'):
+            with open(os.path.join(version_dir, name), 'wb') as f:
+                f.write(b'x' * 1024)
+    for i in range(other_dirs):
+        os.makedirs(os.path.join(root, f"archive_{i}"))
+        with open(os.path.join(root, f"notes_{i}.txt"), 'w') as f:
+            f.write('x')
+
+
+def add_latency(seconds):
+    """Задержка на каждое обращение к файловой системе, как у запроса к SMB-серверу."""
+    def delayed(func):
+        def wrapper(*args, **kwargs):
+            time.sleep(seconds)
+            return func(*args, **kwargs)
+        return wrapper
+    os.listdir, os.scandir, os.stat = delayed(os.listdir), delayed(os.scandir), delayed(os.stat)
+    os.path.isdir = delayed(os.path.isdir)
+
+
+def measure(func):
+    started = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--path', help="существующий каталог дистрибутивов (по умолчанию создается синтетическое дерево)")
+    parser.add_argument('--versions', type=int, default=3000, help="число папок версий в синтетическом дереве")
+    parser.add_argument('--other-dirs', type=int, default=500, help="число посторонних папок и файлов в корне")
+    parser.add_argument('--latency-ms', type=float, default=2.0, help="эмулируемая задержка одного обращения к SMB")
+    parser.add_argument('--workers', type=int, default=8, help="потоков для find_versions_on_smb")
+    args = parser.parse_args()
+
+    root = args.path
+    if not root:
+        root = tempfile.mkdtemp(prefix='smb_bench_')
+        build_tree(root, args.versions, args.other_dirs)
+        add_latency(args.latency_ms / 1000)
+    try:
+        old, old_time = measure(lambda: find_versions_listdir(root))
+        new, new_time = measure(lambda: iiko_updater.find_versions_on_smb(root, quiet=True, workers=args.workers))
+        assert set(old) == set(new), "результаты поиска различаются"
+        print(f"Папок версий найдено: {len(new)}")
+        print(f"{'listdir + isdir:':<32}{old_time:8.2f} с")
+        print(f"{f'scandir + пул ({args.workers} потоков):':<32}{new_time:8.2f} с  (в {old_time / new_time:.1f} раза быстрее)")
+    finally:
+        if not args.path: shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
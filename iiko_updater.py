@@ -1,15 +1,31 @@
+import argparse
 import configparser
 import subprocess
 import os
 import shutil
 import ftplib
 import threading
+import queue
 import zipfile
+import tarfile
+import lzma
+import stat
+import struct
 import time
 import re
 import sys
+import json
+import math
+import zlib
+import base64
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
+from contextlib import contextmanager, nullcontext
 from urllib.parse import urlparse
 from tqdm import tqdm
+import hashlib
+import io
+import xml.etree.ElementTree as ET
 import ctypes # Для проверки прав администратора и UAC
 from ctypes import wintypes # Для проверки прав администратора
 
@@ -18,17 +34,64 @@ CONFIG_FILE = 'config.ini'
 DEFAULT_CONFIG = {
     'FTP': {'url': ''}, 
     'SMB': {'path': ''}, 
-    'Services': {'keywords': 'Tomcat,iiko,RMS,ChainServer,iikoChain'}, 
-    'General': {'download_dir': './downloads', 'backup_dir': './backups'}
+    'Services': {'keywords': 'Tomcat,iiko,RMS,ChainServer,iikoChain', 'control_backend': 'auto',
+                 'shell_worker': 'yes', 'worker_timeout': '30', 'worker_restarts': '3',
+                 'stop_timeout': '120', 'kill_on_timeout': 'yes', 'kill_wait': '60'}, 
+    'General': {'download_dir': './downloads', 'backup_dir': './backups'},
+    'Update': {'deploy_mode': 'full', 'backup_strategy': 'auto', 'backup_workers': '8'},
+    'Transfer': {'ftp_segments': '4', 'retries': '5', 'retry_delay': '2', 'discovery_workers': '4', 'block_size_kb': '1024',
+                 'ftp_blocksize_kb': '256', 'write_queue_blocks': '64',
+                 'smb_workers': '4', 'smb_range_mb': '16', 'extract_workers': '4'},
+    'Backup': {'stream': 'yes', 'queue_blocks': '16', 'format': 'deflate', 'level': '1', 'workers': '4',
+               'store_extensions': '.jar,.war,.zip,.gz,.tgz,.bz2,.xz,.zst,.7z,.rar,.cab,.msi,.png,.jpg,.jpeg,.gif',
+               'dedup': 'no', 'chunk_size_kb': '1024', 'volume_size_mb': '0', 'upload_workers': '4'},
+    'Cache': {'dir': './cache', 'max_size_mb': '10240', 'catalog_ttl': '3600'}
 }
 REQUIRED_BACKUP_FOLDERS = ['exploded', 'tools', 'tomcat9', 'logs']
 FOLDERS_TO_REPLACE = ['exploded', 'tools', 'tomcat9']
+CUSTOM_LIBS_DIR = 'exploded/WEB-INF/lib'
+INCREMENTAL_MANIFEST = 'incremental.json'
+BACKUP_INFO_FILE = 'backup_info.json'
+BACKUP_REPO_DIR = 'repository' # репозиторий бэкапов с дедупликацией в temp/update_backups
+BACKUP_REPO_INDEX = 'chunks.idx'
+BACKUP_REPO_FORMAT = 1
+VOLUME_MANIFEST_SUFFIX = '.volumes.json' # манифест многотомного архива бэкапа
+VOLUME_MANIFEST_FORMAT = 1
+# Установщики и папки в exploded/update, куда они кладутся
+INSTALLER_SUBDIRS = {
+    'Setup.Front.exe': 'Front',
+    'Setup.RMS.BackOffice.exe': 'BackOffice',
+    'Setup.Chain.BackOffice.exe': 'BackOffice'
+}
+MANIFEST_FILE_NAME = 'index.json'
+MANIFEST_FORMAT = 1
 LOG_FILE_NAME = 'startup.log'
 SUCCESS_LOG_MESSAGE = 'STARTED_SUCCESSFULLY'
 SERVICE_POLL_INTERVAL = 2 # seconds
 SERVICE_TIMEOUT = 600 # seconds
+SERVICE_NATIVE_POLL_INTERVAL = 0.05 # seconds, опрос статуса через SCM без запуска процессов
+SERVICE_CONTROL_BACKENDS = ('auto', 'native', 'shell')
+SERVICE_DISCOVERY_PROPERTIES = ('Name', 'DisplayName', 'State', 'PathName', 'StartName')
+SERVICE_WORKER_POLL_INTERVAL = 0.25 # seconds, опрос статуса через постоянный процесс PowerShell
 LOG_POLL_INTERVAL = 1 # seconds
 LOG_TIMEOUT = 900 # seconds (15 minutes)
+LOG_READ_CHUNK = 256 * 1024 # bytes, столько лога читается за один раз
+LOG_MAX_LINE = 1024 * 1024 # bytes, более длинная строка выводится частями
+FTP_TIMEOUT = 60 # seconds, для дополнительных FTP-сессий
+FTP_SEGMENT_MIN_SIZE = 16 * 1024 * 1024 # файлы меньше этого размера качаются одним потоком
+FTP_SEGMENT_BLOCK_SIZE = 256 * 1024
+RETRY_MAX_DELAY = 60 # seconds
+TRANSFER_STATE_INTERVAL = 8 * 1024 * 1024 # bytes, как часто при скачивании одним потоком сохраняется смещение в .part.json
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+PROGRESS_UPDATE_INTERVAL = 0.2 # seconds, не чаще обновляем прогресс-бар при копировании
+SNAPSHOT_BATCH_FILES = 64 # файлов в одном задании пула при снимке папки в бэкап
+SNAPSHOT_BATCH_BYTES = 16 * 1024 * 1024
+FTP_BLOCK_SIZE = 256 * 1024
+SMB_PARALLEL_MIN_SIZE = 64 * 1024 * 1024 # bytes, файлы меньше копируются одним потоком
+FTP_WRITE_QUEUE_BLOCKS = 64
+BACKUP_FORMATS = ('deflate', 'lzma', 'zstd', 'store')
+BACKUP_CHUNK_SIZE = 1024 * 1024 # часть файла, которую сжимает один поток пула при архивации бэкапа
+ZIP64_LIMIT = (1 << 31) - 1 # как в zipfile: больше - только через ZIP64
 
 try:
     from colorama import Fore, Style, init
@@ -76,6 +139,16 @@ except ImportError:
     def start_color(color=''): pass
     def end_color(): pass
 
+try:
+    import zstandard # необязательно: нужен только для [Backup] format = zstd
+except ImportError:
+    zstandard = None
+
+try:
+    import msvcrt # только Windows: открытие лога с FILE_SHARE_DELETE
+except ImportError:
+    msvcrt = None
+
 # --- Вспомогательные функции ---
 
 def is_admin():
@@ -140,6 +213,58 @@ def load_config(filename):
     config.read(filename)
     return config
 
+def get_config_int(config, section, key):
+    """Читает целочисленный параметр, подставляя значение по умолчанию, если его нет в config.ini."""
+    fallback = int(DEFAULT_CONFIG[section][key])
+    if config is None: return fallback
+    try:
+        return config.getint(section, key, fallback=fallback)
+    except ValueError:
+        cprint(f"ПРЕДУПРЕЖДЕНИЕ: Некорректное значение [{section}] {key} в config.ini. Использую {fallback}.", 'warning')
+        return fallback
+
+def get_config_bool(config, section, key):
+    """Читает логический параметр (yes/no, true/false, 1/0), подставляя значение по умолчанию."""
+    fallback = DEFAULT_CONFIG[section][key].lower() in ('1', 'yes', 'true', 'on')
+    if config is None: return fallback
+    try:
+        return config.getboolean(section, key, fallback=fallback)
+    except ValueError:
+        cprint(f"ПРЕДУПРЕЖДЕНИЕ: Некорректное значение [{section}] {key} в config.ini. Использую {'yes' if fallback else 'no'}.", 'warning')
+        return fallback
+
+def get_config_str(config, section, key):
+    """Читает строковый параметр, подставляя значение по умолчанию, если его нет в config.ini."""
+    fallback = DEFAULT_CONFIG[section][key]
+    if config is None: return fallback
+    return config.get(section, key, fallback=fallback).strip()
+
+def get_transfer_settings(config):
+    """Собирает параметры передачи файлов и кэша из config.ini в один словарь."""
+    return {
+        'ftp_segments': get_config_int(config, 'Transfer', 'ftp_segments'),
+        'retries': get_config_int(config, 'Transfer', 'retries'),
+        'retry_delay': get_config_int(config, 'Transfer', 'retry_delay'),
+        'block_size': max(64, get_config_int(config, 'Transfer', 'block_size_kb')) * 1024,
+        'ftp_blocksize': max(8, get_config_int(config, 'Transfer', 'ftp_blocksize_kb')) * 1024,
+        'write_queue_blocks': max(1, get_config_int(config, 'Transfer', 'write_queue_blocks')),
+        'smb_workers': max(1, get_config_int(config, 'Transfer', 'smb_workers')),
+        'smb_range_size': max(1, get_config_int(config, 'Transfer', 'smb_range_mb')) * 1024 * 1024,
+        'extract_workers': max(1, get_config_int(config, 'Transfer', 'extract_workers')),
+        'backup_stream': get_config_bool(config, 'Backup', 'stream'),
+        'stream_blocks': max(1, get_config_int(config, 'Backup', 'queue_blocks')),
+        'backup_format': get_config_str(config, 'Backup', 'format').lower(),
+        'backup_level': get_config_int(config, 'Backup', 'level'),
+        'compress_workers': max(1, get_config_int(config, 'Backup', 'workers')),
+        'backup_dedup': get_config_bool(config, 'Backup', 'dedup'),
+        'chunk_size': max(64, get_config_int(config, 'Backup', 'chunk_size_kb')) * 1024,
+        'volume_size': max(0, get_config_int(config, 'Backup', 'volume_size_mb')) * 1024 * 1024,
+        'upload_workers': max(1, get_config_int(config, 'Backup', 'upload_workers')),
+        'store_extensions': {ext.strip().lower() for ext in get_config_str(config, 'Backup', 'store_extensions').split(',') if ext.strip()},
+        'cache_dir': get_config_str(config, 'Cache', 'dir'),
+        'cache_max_bytes': get_config_int(config, 'Cache', 'max_size_mb') * 1024 * 1024,
+    }
+
 def decode_bytes_with_fallbacks(byte_data, fallbacks=['cp866', 'cp1251', 'utf-8', sys.stdout.encoding], errors='ignore'):
     """Пытается декодировать байты, перебирая кодировки, возвращает первый успешный результат."""
     if not isinstance(byte_data, bytes): return byte_data
@@ -185,34 +310,17 @@ def run_command(command, shell=True, check=True, text=False, encoding=None, erro
         return None
 
 def get_service_info_wmic(keywords):
-    """Находит службы iikoRMS/iikoChain по ключевым словам, используя wmic."""
-    cprint("\n--- Поиск служб iikoRMS/iikoChain через wmic ---", 'step')
+    """Находит службы iikoRMS/iikoChain по ключевым словам (список служб - через выбранный способ управления службами)."""
+    cprint(f"\n--- Поиск служб iikoRMS/iikoChain через {get_service_control().label} ---", 'step')
     services_info = []
     
-    output = run_command('wmic service get Name,DisplayName,State,PathName /format:list', shell=True, check=False, text=False)
-    if not output:
+    keyword_list = [k.strip().lower() for k in keywords.split(',') if k.strip()]
+    records = discover_services(keyword_list)
+    if records is None:
         cprint("Не удалось получить или декодировать список служб.", 'error')
         return services_info
 
-    raw_blocks = re.split(r'\r\r\n\r\r\n', output.strip())
-    
-    keyword_list = [k.strip().lower() for k in keywords.split(',') if k.strip()]
-
-    for raw_block in raw_blocks:
-        block = raw_block.strip()
-        if not block: continue
-
-        current_service_data = {}
-        lines = block.split('\r\r\n')
-        
-        for line in lines:
-            line = line.strip()
-            if not line or '=' not in line: continue
-            try:
-                key, value = line.split('=', 1)
-                current_service_data[key.strip()] = value.strip()
-            except Exception: continue
-
+    for current_service_data in records:
         name = current_service_data.get('Name')
         display = current_service_data.get('DisplayName')
         state = current_service_data.get('State')
@@ -260,21 +368,62 @@ def get_service_info_wmic(keywords):
 
     return services_info
 
-def get_service_status_wmic(service_name):
-    """Получает текущий статус службы, используя wmic."""
-    output = run_command(f'wmic service where Name="{service_name}" get State /value', shell=True, check=False, text=False)
-    if output:
-        state_match = re.search(r'^State=(.+)$', output.strip(), re.MULTILINE)
-        if state_match: return state_match.group(1).strip().capitalize() 
+# Снимок служб, найденных при поиске: {кортеж ключевых слов: список записей}. Запрос к WMI выполняется один раз за запуск
+service_discovery_cache = {}
+
+def build_service_wql_condition(keywords):
+    """Условие WQL: Name или DisplayName содержит одно из ключевых слов (LIKE в WQL без учета регистра)."""
+    clauses = []
+    for keyword in keywords:
+        # В LIKE символы %, _ и [ - шаблоны, берем их в скобки; ' и \ экранируются обратной косой чертой
+        pattern = re.sub(r'([%_\[])', r'[\1]', keyword).replace('\\', '\\\\').replace("'", "\\'")
+        clauses += [f"Name LIKE '%{pattern}%'", f"DisplayName LIKE '%{pattern}%'"]
+    return ' OR '.join(clauses)
+
+def parse_wmic_rawxml(output):
+    """Разбирает вывод wmic /format:rawxml в список словарей {свойство: значение}. None, если это не XML."""
+    try:
+        root = ET.fromstring(output.strip())
+    except ET.ParseError:
+        return None
+    records = []
+    for instance in root.iter('INSTANCE'):
+        record = {}
+        for prop in instance.iter('PROPERTY'):
+            value = prop.find('VALUE')
+            record[prop.get('NAME')] = (value.text or '') if value is not None else ''
+        records.append(record)
+    return records
+
+def discover_services(keywords):
+    """
+    Записи служб (Name, DisplayName, State, PathName, StartName), подходящих по ключевым словам.
+    Фильтр выполняется в самом запросе к WMI. Результат запоминается на весь запуск, чтобы последующие
+    запросы (учетная запись службы) брали данные из того же снимка. None, если список получить не удалось.
+    """
+    key = tuple(keywords)
+    if key not in service_discovery_cache:
+        records = get_service_control().list_services(keywords)
+        if records is None: return None
+        service_discovery_cache[key] = records
+    return service_discovery_cache[key]
+
+def find_discovered_service(service_name):
+    """Запись службы из снимка поиска или None, если служба в нем не встречалась."""
+    for records in service_discovery_cache.values():
+        for record in records:
+            if record.get('Name', '').lower() == service_name.lower(): return record
     return None
 
+def get_service_status_wmic(service_name):
+    """Получает текущий статус службы через выбранный способ управления службами (SCM или wmic)."""
+    return get_service_control().status(service_name)
+
 def get_service_logon_account_wmic(service_name):
-    """Получает учетную запись службы, используя wmic."""
-    output = run_command(f'wmic service where Name="{service_name}" get StartName /value', shell=True, check=False, text=False)
-    if output:
-        account_match = re.search(r'^StartName=(.+)$', output.strip(), re.MULTILINE)
-        if account_match: return account_match.group(1).strip()
-    return None
+    """Получает учетную запись службы: из снимка поиска служб, если служба в нем есть, иначе через SCM или wmic."""
+    record = find_discovered_service(service_name)
+    if record and record.get('StartName'): return record['StartName']
+    return get_service_control().logon_account(service_name)
 
 def set_service_logon_account_sc(service_name, account='LocalSystem', username=None, password=None):
     """Изменяет учетную запись службы на 'LocalSystem' с использованием sc.exe config."""
@@ -298,58 +447,573 @@ def set_service_logon_account_sc(service_name, account='LocalSystem', username=N
         cprint(f"!!! sc.exe config вернул FAILED при изменении учетной записи службы: {result}", 'error')
         return False
 
+    record = find_discovered_service(service_name)
+    if record: record['StartName'] = 'LocalSystem' if account.lower() == 'localsystem' else username
     cprint("Учетная запись службы успешно изменена.", 'success')
     return True
 
 
+# --- Управление службами ---
+# Все операции со службами идут через объект с методами status/start/stop/wait/logon_account:
+# NativeServiceControl обращается к диспетчеру служб напрямую, ShellServiceControl запускает wmic и PowerShell.
+# Для тестов без Windows через set_service_control подставляется FakeServiceControl из tests/fake_services.py.
+
+# Строки статусов как у wmic после capitalize(): по ним сравнивает остальной код
+SERVICE_STATES = {1: 'Stopped', 2: 'Start pending', 3: 'Stop pending', 4: 'Running',
+                  5: 'Continue pending', 6: 'Pause pending', 7: 'Paused'}
+
+# Цикл постоянного процесса PowerShell: по строке JSON-запроса {"id", "script"} со stdin
+# выполняет скрипт и пишет одну строку JSON-ответа {"id", "ok", "result"|"error"} в stdout
+POWERSHELL_WORKER_SCRIPT = r"""
+$ErrorActionPreference = 'Stop'
+$ProgressPreference = 'SilentlyContinue'
+[Console]::InputEncoding = [Text.Encoding]::UTF8
+[Console]::OutputEncoding = [Text.Encoding]::UTF8
+while ($null -ne ($line = [Console]::In.ReadLine())) {
+    if (-not $line.Trim()) { continue }
+    $request = $line | ConvertFrom-Json
+    try {
+        $result = Invoke-Expression $request.script
+        $response = @{ id = $request.id; ok = $true; result = $result }
+    } catch {
+        $response = @{ id = $request.id; ok = $false; error = $_.Exception.Message }
+    }
+    [Console]::Out.WriteLine((ConvertTo-Json -InputObject $response -Compress -Depth 4))
+    [Console]::Out.Flush()
+}
+"""
+
+class PowerShellWorkerError(Exception):
+    """Постоянный процесс PowerShell недоступен: не запустился, завис или завершился."""
+
+def ps_quote(value):
+    """Строка в одинарных кавычках PowerShell."""
+    return "'" + str(value).replace("'", "''") + "'"
+
+class PowerShellWorker:
+    """
+    Один долгоживущий процесс PowerShell для всех запросов к службам вместо запуска процесса на каждый вызов.
+    Запросы и ответы - по одной строке JSON. Если ответа нет за timeout секунд или процесс завершился,
+    процесс убивается и при следующем запросе запускается заново. После restarts таких сбоев подряд
+    worker отключается, и вызывающий код переходит на запуск отдельных процессов.
+    command - командная строка процесса (по умолчанию powershell с циклом POWERSHELL_WORKER_SCRIPT).
+    """
+    def __init__(self, command=None, timeout=30, restarts=3):
+        encoded = base64.b64encode(POWERSHELL_WORKER_SCRIPT.encode('utf-16-le')).decode('ascii')
+        self.command = command or ['powershell', '-NoLogo', '-NoProfile', '-NonInteractive', '-ExecutionPolicy', 'Bypass', '-EncodedCommand', encoded]
+        self.timeout = timeout
+        self.restarts = restarts
+        self.failures = 0
+        self.disabled = False
+        self.process = None
+        self.responses = None
+        self.next_id = 0
+        self.lock = threading.Lock()
+
+    def _start(self):
+        try:
+            self.process = subprocess.Popen(
+                self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0)
+            )
+        except OSError as e:
+            self.disabled = True
+            raise PowerShellWorkerError(f"не удалось запустить {self.command[0]}: {e}")
+        self.responses = queue.Queue()
+        threading.Thread(target=self._read_responses, args=(self.process, self.responses), daemon=True).start()
+
+    @staticmethod
+    def _read_responses(process, responses):
+        # Строки, которые не являются ответом (предупреждения и прочий вывод), пропускаются
+        for line in process.stdout:
+            try: response = json.loads(line.decode('utf-8', errors='replace'))
+            except ValueError: continue
+            if isinstance(response, dict) and 'id' in response: responses.put(response)
+        responses.put(None)
+
+    def _kill(self):
+        if self.process is None: return
+        try: self.process.kill()
+        except OSError: pass
+        try: self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired: pass
+        self.process = None
+
+    def _fail(self, reason):
+        self._kill()
+        self.failures += 1
+        if self.failures > self.restarts:
+            self.disabled = True
+            reason += f"; сбоев подряд: {self.failures}, процесс PowerShell больше не используется"
+        raise PowerShellWorkerError(reason)
+
+    def run(self, script, timeout=None):
+        """
+        Выполняет скрипт и возвращает (ok, результат или текст ошибки PowerShell).
+        Бросает PowerShellWorkerError, если процесс не ответил.
+        """
+        timeout = timeout or self.timeout
+        with self.lock:
+            if self.disabled: raise PowerShellWorkerError("процесс PowerShell отключен после сбоев")
+            if self.process is None or self.process.poll() is not None: self._start()
+            self.next_id += 1
+            request_id = self.next_id
+            try:
+                self.process.stdin.write(json.dumps({'id': request_id, 'script': script}).encode('utf-8') + b'\n')
+                self.process.stdin.flush()
+            except OSError as e:
+                self._fail(f"процесс PowerShell не принимает запросы: {e}")
+            deadline = time.monotonic() + timeout
+            while True:
+                try: response = self.responses.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty: self._fail(f"нет ответа от PowerShell за {timeout} с")
+                if response is None: self._fail("процесс PowerShell завершился")
+                if response.get('id') == request_id: break
+            self.failures = 0
+            if response.get('ok'): return True, response.get('result')
+            return False, response.get('error') or ''
+
+    def close(self):
+        with self.lock:
+            if self.process is None: return
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                pass
+            self._kill()
+
+class ShellServiceControl:
+    """
+    Управление службами через PowerShell и wmic. Если задан worker (PowerShellWorker), все запросы идут
+    через один постоянный процесс PowerShell (CIM); иначе или после отказа worker каждый вызов запускает
+    отдельный процесс wmic/PowerShell.
+    """
+    def __init__(self, worker=None):
+        self.worker = worker
+
+    @property
+    def label(self):
+        return 'PowerShell/CIM (постоянный процесс)' if self.worker and not self.worker.disabled else 'wmic/PowerShell'
+
+    def _run_worker(self, script, timeout=None):
+        """(ok, результат) от постоянного процесса или None, если его нет или он отказал."""
+        if not self.worker or self.worker.disabled: return None
+        try:
+            return self.worker.run(script, timeout)
+        except PowerShellWorkerError as e:
+            cprint(f"ПРЕДУПРЕЖДЕНИЕ: {e}. Запрос выполняется отдельным процессом.", 'warning')
+            return None
+
+    def _cim_service(self, service_name, prop):
+        wql_name = service_name.replace('\\', '\\\\').replace("'", "\\'")
+        wql_filter = ps_quote(f"Name='{wql_name}'")
+        return self._run_worker(f"(Get-CimInstance -ClassName Win32_Service -Filter {wql_filter}).{prop}")
+
+    def list_services(self, keywords=None):
+        """
+        Службы, у которых Name или DisplayName содержит одно из keywords (все службы, если keywords пусто):
+        словари со свойствами SERVICE_DISCOVERY_PROPERTIES. Фильтр передается в WQL. None при ошибке.
+        """
+        condition = build_service_wql_condition(keywords or [])
+        properties = ', '.join(SERVICE_DISCOVERY_PROPERTIES)
+        query = f"SELECT {properties} FROM Win32_Service" + (f" WHERE {condition}" if condition else '')
+        response = self._run_worker(f"@(Get-CimInstance -Query {ps_quote(query)} | Select-Object {properties})")
+        if response is not None:
+            ok, result = response
+            if not ok:
+                cprint(f"!!! Ошибка PowerShell при получении списка служб: {result}", 'error')
+                return None
+            if isinstance(result, dict): result = [result]
+            return [{key: record.get(key) or '' for key in SERVICE_DISCOVERY_PROPERTIES} for record in result or []]
+
+        # Список аргументов без shell: иначе cmd.exe может подставить переменные окружения вместо %...%
+        command = ['wmic', 'service'] + (['where', condition] if condition else []) + ['get', ','.join(SERVICE_DISCOVERY_PROPERTIES), '/format:rawxml']
+        output = run_command(command, shell=False, check=False, text=False)
+        if not output: return None
+        records = parse_wmic_rawxml(output)
+        if records is None:
+            cprint("!!! Не удалось разобрать вывод wmic /format:rawxml.", 'error')
+            return None
+        return [{key: record.get(key, '') for key in SERVICE_DISCOVERY_PROPERTIES} for record in records]
+
+    def status(self, service_name):
+        response = self._cim_service(service_name, 'State')
+        if response is not None:
+            ok, result = response
+            return result.capitalize() if ok and result else None
+        output = run_command(f'wmic service where Name="{service_name}" get State /value', shell=True, check=False, text=False)
+        if output:
+            state_match = re.search(r'^State=(.+)$', output.strip(), re.MULTILINE)
+            if state_match: return state_match.group(1).strip().capitalize()
+        return None
+
+    def logon_account(self, service_name):
+        response = self._cim_service(service_name, 'StartName')
+        if response is not None:
+            ok, result = response
+            return result if ok and result else None
+        output = run_command(f'wmic service where Name="{service_name}" get StartName /value', shell=True, check=False, text=False)
+        if output:
+            account_match = re.search(r'^StartName=(.+)$', output.strip(), re.MULTILINE)
+            if account_match: return account_match.group(1).strip()
+        return None
+
+    def _control(self, cmdlet, service_name, timeout=None, options=''):
+        command = f"{cmdlet} -Name {ps_quote(service_name)}{options}"
+        response = self._run_worker(command, timeout=timeout)
+        if response is not None:
+            ok, result = response
+            if not ok: cprint(f"!!! Ошибка PowerShell ({cmdlet}): {result}", 'error')
+            return ok
+        return run_command(['powershell', '-Command', command], shell=False, check=False, text=True, encoding='utf-8') is not None
+
+    def start(self, service_name):
+        # Start-Service ждет завершения запуска, поэтому таймаут как у ожидания статуса
+        return self._control('Start-Service', service_name, timeout=SERVICE_TIMEOUT)
+
+    def stop(self, service_name):
+        # Без ожидания: остановку ждет wait(), и зависшую службу можно завершить по таймауту
+        return self._control('Stop-Service', service_name, options=' -NoWait')
+
+    def process_id(self, service_name):
+        """PID процесса службы (0, если служба не запущена) или None, если его не удалось получить."""
+        response = self._cim_service(service_name, 'ProcessId')
+        if response is not None:
+            ok, result = response
+            return int(result) if ok and result is not None else None
+        output = run_command(f'wmic service where Name="{service_name}" get ProcessId /value', shell=True, check=False, text=False)
+        if output:
+            pid_match = re.search(r'^ProcessId=(\d+)', output.strip(), re.MULTILINE)
+            if pid_match: return int(pid_match.group(1))
+        return None
+
+    def kill(self, service_name):
+        return kill_process_tree(self.process_id(service_name))
+
+    def wait(self, service_name, target_status, timeout):
+        """Ждет статус до timeout секунд и возвращает последний полученный статус.
+        Через постоянный процесс опрос идет раз в SERVICE_WORKER_POLL_INTERVAL, иначе - один запрос за вызов."""
+        deadline = time.monotonic() + timeout
+        while True:
+            status = self.status(service_name)
+            remaining = deadline - time.monotonic()
+            if status is None or status == target_status or remaining <= 0: return status
+            polling = self.worker and not self.worker.disabled
+            time.sleep(min(SERVICE_WORKER_POLL_INTERVAL, remaining) if polling else remaining)
+            if not polling: return status
+
+    def close(self):
+        if self.worker: self.worker.close()
+
+class SERVICE_STATUS_PROCESS(ctypes.Structure):
+    _fields_ = [
+        ('dwServiceType', wintypes.DWORD), ('dwCurrentState', wintypes.DWORD),
+        ('dwControlsAccepted', wintypes.DWORD), ('dwWin32ExitCode', wintypes.DWORD),
+        ('dwServiceSpecificExitCode', wintypes.DWORD), ('dwCheckPoint', wintypes.DWORD),
+        ('dwWaitHint', wintypes.DWORD), ('dwProcessId', wintypes.DWORD), ('dwServiceFlags', wintypes.DWORD),
+    ]
+
+class QUERY_SERVICE_CONFIGW(ctypes.Structure):
+    _fields_ = [
+        ('dwServiceType', wintypes.DWORD), ('dwStartType', wintypes.DWORD), ('dwErrorControl', wintypes.DWORD),
+        ('lpBinaryPathName', wintypes.LPWSTR), ('lpLoadOrderGroup', wintypes.LPWSTR), ('dwTagId', wintypes.DWORD),
+        ('lpDependencies', wintypes.LPWSTR), ('lpServiceStartName', wintypes.LPWSTR), ('lpDisplayName', wintypes.LPWSTR),
+    ]
+
+class NativeServiceControl:
+    """
+    Управление службами через API диспетчера служб (advapi32) без запуска процессов.
+    Запрос статуса занимает микросекунды, поэтому ожидание опрашивает службу каждые
+    SERVICE_NATIVE_POLL_INTERVAL секунд и замечает смену статуса практически сразу.
+    """
+    label = 'SCM'
+    SC_MANAGER_CONNECT = 0x0001
+    SERVICE_QUERY_CONFIG = 0x0001
+    SERVICE_QUERY_STATUS = 0x0004
+    SERVICE_START = 0x0010
+    SERVICE_STOP = 0x0020
+    SC_STATUS_PROCESS_INFO = 0
+    SERVICE_CONTROL_STOP = 1
+    ERROR_INSUFFICIENT_BUFFER = 122
+    ERROR_SERVICE_ALREADY_RUNNING = 1056
+    ERROR_SERVICE_DOES_NOT_EXIST = 1060
+    ERROR_SERVICE_CANNOT_ACCEPT_CTRL = 1061
+    ERROR_SERVICE_NOT_ACTIVE = 1062
+
+    def __init__(self, shell=None, poll_interval=SERVICE_NATIVE_POLL_INTERVAL):
+        # На не-Windows ctypes.WinDLL отсутствует: AttributeError означает, что SCM недоступен
+        advapi32 = ctypes.WinDLL('advapi32', use_last_error=True)
+        advapi32.OpenSCManagerW.restype = ctypes.c_void_p
+        advapi32.OpenSCManagerW.argtypes = [wintypes.LPCWSTR, wintypes.LPCWSTR, wintypes.DWORD]
+        advapi32.OpenServiceW.restype = ctypes.c_void_p
+        advapi32.OpenServiceW.argtypes = [ctypes.c_void_p, wintypes.LPCWSTR, wintypes.DWORD]
+        advapi32.CloseServiceHandle.argtypes = [ctypes.c_void_p]
+        advapi32.QueryServiceStatusEx.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, wintypes.DWORD, ctypes.POINTER(wintypes.DWORD)]
+        advapi32.QueryServiceConfigW.argtypes = [ctypes.c_void_p, ctypes.c_void_p, wintypes.DWORD, ctypes.POINTER(wintypes.DWORD)]
+        advapi32.StartServiceW.argtypes = [ctypes.c_void_p, wintypes.DWORD, ctypes.c_void_p]
+        advapi32.ControlService.argtypes = [ctypes.c_void_p, wintypes.DWORD, ctypes.c_void_p]
+        self.advapi32 = advapi32
+        self.shell = shell or ShellServiceControl() # список служб с путями к exe берется из WMI
+        self.poll_interval = poll_interval
+        self.scm = advapi32.OpenSCManagerW(None, None, self.SC_MANAGER_CONNECT)
+        if not self.scm: raise ctypes.WinError(ctypes.get_last_error())
+
+    def _report_error(self, action, service_name, code):
+        cprint(f"!!! Ошибка SCM ({action}) для службы '{service_name}': [{code}] {ctypes.FormatError(code).strip()}", 'error')
+
+    @contextmanager
+    def _open(self, service_name, access):
+        """Открывает службу с нужными правами; при ошибке отдает None и код ошибки."""
+        handle = self.advapi32.OpenServiceW(self.scm, service_name, access)
+        if not handle:
+            yield None, ctypes.get_last_error()
+            return
+        try: yield handle, 0
+        finally: self.advapi32.CloseServiceHandle(handle)
+
+    def _query(self, handle):
+        status = SERVICE_STATUS_PROCESS()
+        needed = wintypes.DWORD()
+        if not self.advapi32.QueryServiceStatusEx(handle, self.SC_STATUS_PROCESS_INFO, ctypes.byref(status), ctypes.sizeof(status), ctypes.byref(needed)):
+            return None, ctypes.get_last_error()
+        return status, 0
+
+    def list_services(self, keywords=None):
+        return self.shell.list_services(keywords)
+
+    def status(self, service_name):
+        with self._open(service_name, self.SERVICE_QUERY_STATUS) as (handle, error):
+            if handle: status, error = self._query(handle)
+            if error:
+                if error != self.ERROR_SERVICE_DOES_NOT_EXIST: self._report_error('запрос статуса', service_name, error)
+                return None
+            return SERVICE_STATES.get(status.dwCurrentState)
+
+    def logon_account(self, service_name):
+        with self._open(service_name, self.SERVICE_QUERY_CONFIG) as (handle, error):
+            if not handle:
+                self._report_error('чтение настроек', service_name, error)
+                return None
+            needed = wintypes.DWORD()
+            self.advapi32.QueryServiceConfigW(handle, None, 0, ctypes.byref(needed))
+            error = ctypes.get_last_error()
+            if error != self.ERROR_INSUFFICIENT_BUFFER:
+                self._report_error('чтение настроек', service_name, error)
+                return None
+            buffer = ctypes.create_string_buffer(needed.value)
+            if not self.advapi32.QueryServiceConfigW(handle, buffer, needed, ctypes.byref(needed)):
+                self._report_error('чтение настроек', service_name, ctypes.get_last_error())
+                return None
+            return ctypes.cast(buffer, ctypes.POINTER(QUERY_SERVICE_CONFIGW)).contents.lpServiceStartName
+
+    def start(self, service_name):
+        with self._open(service_name, self.SERVICE_START) as (handle, error):
+            if handle and not self.advapi32.StartServiceW(handle, 0, None): error = ctypes.get_last_error()
+            # Как Start-Service: запуск уже работающей службы не ошибка
+            if error and error != self.ERROR_SERVICE_ALREADY_RUNNING:
+                self._report_error('запуск', service_name, error)
+                return False
+            return True
+
+    def stop(self, service_name):
+        with self._open(service_name, self.SERVICE_STOP) as (handle, error):
+            if handle and not self.advapi32.ControlService(handle, self.SERVICE_CONTROL_STOP, ctypes.byref(SERVICE_STATUS_PROCESS())):
+                error = ctypes.get_last_error()
+            # Служба уже останавливается (CANNOT_ACCEPT_CTRL в Stop pending) или остановлена - не ошибка
+            if error and error not in (self.ERROR_SERVICE_NOT_ACTIVE, self.ERROR_SERVICE_CANNOT_ACCEPT_CTRL):
+                self._report_error('остановка', service_name, error)
+                return False
+            return True
+
+    def process_id(self, service_name):
+        """PID процесса службы (0, если служба не запущена) или None при ошибке."""
+        with self._open(service_name, self.SERVICE_QUERY_STATUS) as (handle, error):
+            if handle: status, error = self._query(handle)
+            if error:
+                self._report_error('запрос PID', service_name, error)
+                return None
+            return status.dwProcessId
+
+    def kill(self, service_name):
+        return kill_process_tree(self.process_id(service_name))
+
+    def wait(self, service_name, target_status, timeout):
+        """Ждет статус до timeout секунд, держа службу открытой. Возвращает последний полученный статус."""
+        deadline = time.monotonic() + timeout
+        with self._open(service_name, self.SERVICE_QUERY_STATUS) as (handle, error):
+            while handle:
+                status, error = self._query(handle)
+                if error: break
+                current = SERVICE_STATES.get(status.dwCurrentState)
+                remaining = deadline - time.monotonic()
+                if current == target_status or remaining <= 0: return current
+                time.sleep(min(self.poll_interval, remaining))
+            if error != self.ERROR_SERVICE_DOES_NOT_EXIST: self._report_error('ожидание статуса', service_name, error)
+            return None
+
+    def close(self):
+        self.shell.close()
+        if self.scm:
+            self.advapi32.CloseServiceHandle(self.scm)
+            self.scm = None
+
+service_control = None
+# Политика остановки службы ([Services] stop_timeout, kill_on_timeout, kill_wait)
+service_stop_policy = {'timeout': 120, 'kill': True, 'kill_wait': 60}
+
+def create_service_control(backend='auto', worker=None):
+    """
+    Создает объект управления службами: native - SCM через ctypes, shell - PowerShell/wmic, auto - SCM, если доступен.
+    worker - постоянный процесс PowerShell для shell и для списка служб в native.
+    """
+    if backend not in SERVICE_CONTROL_BACKENDS:
+        cprint(f"ПРЕДУПРЕЖДЕНИЕ: Неизвестное значение [Services] control_backend = '{backend}'. Использую 'auto'.", 'warning')
+        backend = 'auto'
+    shell = ShellServiceControl(worker)
+    if backend == 'shell': return shell
+    try:
+        return NativeServiceControl(shell)
+    except (AttributeError, OSError) as e:
+        if backend == 'native':
+            cprint(f"ПРЕДУПРЕЖДЕНИЕ: Диспетчер служб недоступен через API ({e}). Использую PowerShell/wmic.", 'warning')
+        return shell
+
+def create_powershell_worker(config):
+    """Постоянный процесс PowerShell по настройкам [Services] или None, если shell_worker = no."""
+    if not get_config_bool(config, 'Services', 'shell_worker'): return None
+    return PowerShellWorker(
+        timeout=max(1, get_config_int(config, 'Services', 'worker_timeout')),
+        restarts=max(0, get_config_int(config, 'Services', 'worker_restarts'))
+    )
+
+def set_service_control(control):
+    """Устанавливает объект управления службами для всех операций со службами (закрывает предыдущий)."""
+    global service_control
+    if service_control is not None and service_control is not control: service_control.close()
+    service_control = control
+    return control
+
+def get_service_control():
+    """Возвращает текущий объект управления службами, создавая его по умолчанию при первом обращении."""
+    return service_control or set_service_control(create_service_control(worker=create_powershell_worker(None)))
+
+def configure_service_control(config):
+    """Выбирает способ управления службами по [Services] control_backend и shell_worker, читает политику остановки."""
+    service_stop_policy.update(
+        timeout=max(1, get_config_int(config, 'Services', 'stop_timeout')),
+        kill=get_config_bool(config, 'Services', 'kill_on_timeout'),
+        kill_wait=max(1, get_config_int(config, 'Services', 'kill_wait'))
+    )
+    control = set_service_control(create_service_control(
+        get_config_str(config, 'Services', 'control_backend').lower(), create_powershell_worker(config)
+    ))
+    cprint(f"Управление службами: {control.label}.", 'info')
+    return control
+
 def wait_for_service_status(service_name, target_status, timeout=SERVICE_TIMEOUT, poll_interval=SERVICE_POLL_INTERVAL):
-    """Ожидает перехода службы в заданный статус, используя wmic."""
+    """
+    Ожидает перехода службы в заданный статус. Точка выводится раз в poll_interval секунд,
+    а сама смена статуса замечается так быстро, как позволяет способ управления службами.
+    """
+    control = get_service_control()
     start_color('info')
     print(f"Ожидание статуса '{target_status}' для службы '{service_name}'...", end='', flush=True)
-    start_time = time.time()
-    while time.time() - start_time < timeout:
-        current_status = get_service_status_wmic(service_name) 
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        current_status = control.wait(service_name, target_status, max(0, min(poll_interval, remaining)))
         if current_status is None:
              cprint(f"\nОшибка: Служба '{service_name}' не найдена или недоступна.", 'error')
              return False
         if current_status == target_status:
             cprint(" Готово.", 'success')
             return True
+        if remaining <= poll_interval: break
         print(".", end='', flush=True)
-        time.sleep(poll_interval)
     end_color()
     cprint("\nТаймаут ожидания статуса службы.", 'warning')
     return False
 
 def start_service_ps(service_name):
-     """Запускает службу с использованием PowerShell."""
-     cprint(f"Попытка запуска службы '{service_name}' (через PowerShell)...", 'step')
-     return run_command(['powershell', '-Command', f"Start-Service -Name '{service_name}'"], shell=False, check=False, text=True, encoding='utf-8') is not None 
+     """Запускает службу через выбранный способ управления службами (SCM или PowerShell)."""
+     control = get_service_control()
+     cprint(f"Попытка запуска службы '{service_name}' (через {control.label})...", 'step')
+     return control.start(service_name)
 
 def stop_service_ps(service_name):
-     """Останавливает службу с использованием PowerShell."""
-     cprint(f"Попытка остановки службы '{service_name}' (через PowerShell)...", 'step')
-     return run_command(['powershell', '-Command', f"Stop-Service -Name '{service_name}'"], shell=False, check=False, text=True, encoding='utf-8') is not None
-
-
-def connect_ftp(ftp_url):
-    """Подключается к FTP серверу."""
+     """Останавливает службу через выбранный способ управления службами (SCM или PowerShell)."""
+     control = get_service_control()
+     cprint(f"Попытка остановки службы '{service_name}' (через {control.label})...", 'step')
+     return control.stop(service_name)
+
+def kill_process_tree(pid):
+    """Принудительно завершает процесс и все его дочерние процессы (taskkill /T /F). pid 0 - процесса нет."""
+    if pid is None: return False
+    if pid == 0: return True
+    cprint(f"Принудительное завершение дерева процессов PID {pid}...", 'warning')
+    return run_command(['taskkill', '/PID', str(pid), '/T', '/F'], shell=False, check=False, text=False) is not None
+
+def stop_service_escalating(service_name, timeout=None, kill=None, kill_wait=None):
+    """
+    Останавливает службу по этапам: запрос остановки, ожидание до timeout секунд, затем (если kill)
+    принудительное завершение дерева процессов службы и ожидание статуса Stopped до kill_wait секунд.
+    Так простой при зависшем на остановке Tomcat ограничен timeout + kill_wait, а не SERVICE_TIMEOUT.
+    Длительность каждого этапа выводится в конце. Возвращает True, если служба остановлена.
+    """
+    timeout = timeout or service_stop_policy['timeout']
+    kill = service_stop_policy['kill'] if kill is None else kill
+    kill_wait = kill_wait or service_stop_policy['kill_wait']
+    control = get_service_control()
+    stages = []
+
+    def stage(title, func):
+        started = time.perf_counter()
+        result = func()
+        stages.append((title, time.perf_counter() - started, result))
+        return result
+
+    # Неудачный запрос еще не значит, что служба зависла: она может уже останавливаться (Stop pending)
+    # и не принимать новых команд. Поэтому ожидание идет всегда, а принудительное завершение - только после него
+    if not stage("запрос остановки", lambda: stop_service_ps(service_name)):
+        cprint(f"Запрос остановки службы '{service_name}' не выполнен. Ожидаю, не остановится ли она сама.", 'warning')
+    stopped = stage("ожидание", lambda: wait_for_service_status(service_name, 'Stopped', timeout=timeout))
+    if not stopped and kill and get_service_status_wmic(service_name) is not None:
+        cprint(f"Служба не остановилась за {timeout} с. Завершаю ее процессы принудительно.", 'warning')
+        if stage("завершение процессов", lambda: control.kill(service_name)):
+            stopped = stage("ожидание после завершения", lambda: wait_for_service_status(service_name, 'Stopped', timeout=kill_wait))
+
+    summary = ', '.join(f"{title} {seconds:.1f} с{'' if result else ' (неудачно)'}" for title, seconds, result in stages)
+    cprint(f"Этапы остановки службы: {summary}; всего {sum(seconds for _, seconds, _ in stages):.1f} с.", 'info' if stopped else 'warning')
+    return stopped
+
+
+def parse_ftp_url(ftp_url):
+    """Разбирает FTP URL (допускает обратные слэши и 'ftp:/'), возвращает результат urlparse."""
+    normalized_url = ftp_url.replace('\\', '/')
+    if normalized_url.startswith('ftp:/') and not normalized_url.startswith('ftp://'):
+        # Заменяем только первое вхождение 'ftp:/' на 'ftp://'
+        normalized_url = normalized_url.replace('ftp:/', 'ftp://', 1)
+    return urlparse(normalized_url)
+
+def connect_ftp(ftp_url, quiet=False, timeout=None):
+    """
+    Подключается к FTP серверу.
+    :param quiet: Не выводить сообщения об успешном подключении (для дополнительных сессий).
+    :param timeout: Таймаут сокета в секундах (None - без таймаута).
+    """
     if not ftp_url: return None, None
     try:
-        normalized_url = ftp_url.replace('\\', '/')
-        if normalized_url.startswith('ftp:/') and not normalized_url.startswith('ftp://'):
-            # Заменяем только первое вхождение 'ftp:/' на 'ftp://'
-            normalized_url = normalized_url.replace('ftp:/', 'ftp://', 1)
-        parsed_url = urlparse(normalized_url)
+        parsed_url = parse_ftp_url(ftp_url)
         host = parsed_url.hostname
         port = parsed_url.port if parsed_url.port else 21
         username = parsed_url.username
         password = parsed_url.password
-        cprint(f"Подключение к FTP: {host}:{port}...", 'step')
-        ftp = ftplib.FTP()
+        if not quiet: cprint(f"Подключение к FTP: {host}:{port}...", 'step')
+        ftp = ftplib.FTP(timeout=timeout) if timeout else ftplib.FTP()
         ftp.connect(host, port)
         ftp.login(username, password)
-        cprint("Подключение успешно.", 'success')
+        if not quiet: cprint("Подключение успешно.", 'success')
         return ftp, parsed_url.path.lstrip('/')
     except ftplib.all_errors as e:
         cprint(f"Ошибка подключения к FTP: {e}", 'error')
@@ -358,11 +1022,863 @@ def connect_ftp(ftp_url):
         cprint(f"Неизвестная ошибка при подключении к FTP: {e}", 'error')
         return None, None
 
-def find_versions_on_ftp(ftp, base_path):
+def ftp_supports_rest(ftp):
+    """Проверяет, поддерживает ли FTP сервер докачку (команда REST)."""
+    try:
+        return ftp.sendcmd('REST 0').startswith('350')
+    except ftplib.all_errors:
+        return False
+
+def _ftp_fetch_range(ftp_url, remote_dir, filename, local_path, offset, length, progress, progress_lock):
+    """
+    Скачивает диапазон байт [offset, offset + length) файла в отдельной FTP-сессии
+    и записывает его в заранее созданный локальный файл по тому же смещению.
+    """
+    conn, _ = connect_ftp(ftp_url, quiet=True, timeout=FTP_TIMEOUT)
+    if conn is None:
+        raise ConnectionError("Не удалось открыть дополнительную FTP-сессию.")
+    try:
+        conn.cwd(remote_dir)
+        conn.voidcmd('TYPE I')
+        with conn.transfercmd(f'RETR {filename}', rest=offset) as sock, open(local_path, 'r+b') as local_file:
+            local_file.seek(offset)
+            remaining = length
+            while remaining > 0:
+                data = sock.recv(min(FTP_SEGMENT_BLOCK_SIZE, remaining))
+                if not data:
+                    raise EOFError(f"Соединение закрыто сервером, не получено {remaining} байт сегмента со смещения {offset}.")
+                local_file.write(data)
+                remaining -= len(data)
+                with progress_lock:
+                    progress.update(len(data))
+        # Канал данных закрыт досрочно (для всех сегментов, кроме последнего),
+        # поэтому сервер может ответить 426 - это ожидаемо.
+        try: conn.voidresp()
+        except ftplib.all_errors: pass
+    finally:
+        try: conn.close()
+        except: pass
+
+def download_ftp_segmented(ftp_url, remote_dir, filename, local_path, file_size, segments):
+    """
+    Скачивает файл с FTP в несколько параллельных сессий: каждая сессия получает
+    свой диапазон байт через REST и пишет его в заранее выделенный локальный файл.
+    При ошибке любого сегмента выбрасывает исключение.
     """
-    Ищет доступные версии обновлений на FTP, используя надежный метод проверки директорий.
+    segment_size = math.ceil(file_size / segments)
+    ranges = [(offset, min(segment_size, file_size - offset)) for offset in range(0, file_size, segment_size)]
+
+    with open(local_path, 'wb') as local_file:
+        local_file.truncate(file_size)
+
+    progress_lock = threading.Lock()
+    with tqdm(
+        total=file_size,
+        unit='B', unit_scale=True, unit_divisor=1024,
+        desc=f"{filename} [x{len(ranges)}]",
+        ascii=True
+    ) as progress:
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [
+                executor.submit(_ftp_fetch_range, ftp_url, remote_dir, filename, local_path, offset, length, progress, progress_lock)
+                for offset, length in ranges
+            ]
+            for future in as_completed(futures):
+                future.result()
+
+    if os.path.getsize(local_path) != file_size:
+        raise IOError(f"Размер скачанного файла не совпадает с размером на FTP ({file_size} байт).")
+
+def reconnect_ftp(ftp, ftp_url):
+    """
+    Переподключает существующий объект FTP (на месте, чтобы ссылки на него у вызывающего кода
+    остались рабочими). Возвращает True при успехе.
+    """
+    try: ftp.close()
+    except: pass
+    try:
+        parsed_url = parse_ftp_url(ftp_url)
+        ftp.connect(parsed_url.hostname, parsed_url.port if parsed_url.port else 21, timeout=FTP_TIMEOUT)
+        ftp.login(parsed_url.username, parsed_url.password)
+        cprint("  Переподключение к FTP выполнено.", 'info')
+        return True
+    except ftplib.all_errors as e:
+        cprint(f"  Не удалось переподключиться к FTP: {e}", 'warning')
+        return False
+
+def get_ftp_mdtm(ftp, filename):
+    """Возвращает время изменения файла на FTP (строка из ответа MDTM) или None, если команда не поддерживается."""
+    try:
+        return ftp.voidcmd(f'MDTM {filename}')[4:].strip()
+    except ftplib.all_errors:
+        return None
+
+def load_transfer_state(state_path):
+    """Читает файл состояния незавершенной передачи (.part.json)."""
+    try:
+        with open(state_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_transfer_state(state_path, state):
+    """Сохраняет файл состояния незавершенной передачи (.part.json)."""
+    try:
+        with open(state_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+    except OSError as e:
+        cprint(f"  ПРЕДУПРЕЖДЕНИЕ: Не удалось сохранить состояние загрузки '{state_path}': {e}", 'warning')
+
+class TransferStateWriter:
+    """
+    Обертка файла .part для скачивания одним потоком: каждые TRANSFER_STATE_INTERVAL байт сбрасывает
+    файл на диск и записывает в .part.json смещение, до которого данные точно записаны.
+    После аварийного завершения процесса докачка начинается с этого смещения.
+    """
+    def __init__(self, local_file, state_path, state):
+        self.local_file = local_file
+        self.state_path = state_path
+        self.state = state
+        self.written = state['offset']
+
+    def write(self, data):
+        self.local_file.write(data)
+        self.written += len(data)
+        if self.written - self.state['offset'] >= TRANSFER_STATE_INTERVAL: self.flush()
+
+    def flush(self):
+        self.local_file.flush()
+        os.fsync(self.local_file.fileno())
+        self.state['offset'] = self.written
+        save_transfer_state(self.state_path, self.state)
+
+def discard_partial_download(part_path):
+    """Удаляет частично скачанный файл и его файл состояния."""
+    for path in (part_path, part_path + '.json'):
+        if os.path.exists(path):
+            try: os.remove(path)
+            except OSError: pass
+
+def _retry_delay(attempt, retry_delay):
+    """Экспоненциальная задержка перед повторной попыткой (не больше RETRY_MAX_DELAY)."""
+    return min(retry_delay * 2 ** (attempt - 1), RETRY_MAX_DELAY)
+
+def ftp_retrieve_pipelined(ftp_conn, filename, local_file, progress, blocksize=FTP_BLOCK_SIZE, queue_blocks=FTP_WRITE_QUEUE_BLOCKS, rest=None):
+    """
+    Принимает файл по FTP (RETR) с двойной буферизацией: поток сокета только складывает
+    блоки в ограниченную очередь, а запись на диск и обновление прогресса выполняет
+    отдельный поток-писатель. Медленный диск не останавливает прием, пока очередь не заполнена.
+    Выводит, сколько времени ушло на ожидание сети и на запись на диск.
+    """
+    blocks = queue.Queue(maxsize=max(1, queue_blocks))
+    stats = {'bytes': 0, 'net_time': 0.0, 'disk_time': 0.0, 'stall_time': 0.0}
+    writer_error = []
+
+    def writer():
+        throttled = ThrottledProgress(progress)
+        while True:
+            block = blocks.get()
+            if block is None: break
+            if writer_error: continue # После ошибки только освобождаем очередь
+            try:
+                started = time.perf_counter()
+                local_file.write(block)
+                stats['disk_time'] += time.perf_counter() - started
+                throttled.update(len(block))
+            except Exception as e:
+                writer_error.append(e)
+        throttled.flush()
+
+    writer_thread = threading.Thread(target=writer, daemon=True)
+    writer_thread.start()
+    last_return = time.perf_counter()
+
+    def receive_callback(block):
+        nonlocal last_return
+        received = time.perf_counter()
+        stats['net_time'] += received - last_return
+        if writer_error:
+            raise RuntimeError(f"Ошибка записи на диск: {writer_error[0]}")
+        blocks.put(block) # Блокируется, только если писатель отстал на queue_blocks блоков
+        stats['bytes'] += len(block)
+        last_return = time.perf_counter()
+        stats['stall_time'] += last_return - received
+
+    try:
+        ftp_conn.retrbinary(f'RETR {filename}', receive_callback, blocksize=blocksize, rest=rest)
+    finally:
+        # Дожидаемся записи всех принятых блоков: от размера .part зависит докачка
+        blocks.put(None)
+        writer_thread.join()
+        local_file.flush()
+    if writer_error:
+        raise RuntimeError(f"Ошибка записи на диск: {writer_error[0]}")
+
+    if stats['bytes']:
+        mb = stats['bytes'] / 1024 / 1024
+        net_speed = mb / stats['net_time'] if stats['net_time'] else float('inf')
+        disk_speed = mb / stats['disk_time'] if stats['disk_time'] else float('inf')
+        bottleneck = 'диск' if stats['stall_time'] > 0.1 * max(stats['net_time'], 1e-9) else 'сеть'
+        cprint(
+            f"  Сеть: {net_speed:.1f} МБ/с (ожидание данных {stats['net_time']:.1f} с), "
+            f"диск: {disk_speed:.1f} МБ/с (запись {stats['disk_time']:.1f} с), "
+            f"ожидание очереди записи {stats['stall_time']:.1f} с. Узкое место: {bottleneck}.",
+            'info'
+        )
+    return stats
+
+def ftp_download_resumable(ftp_conn, ftp_url, remote_dir, filename, local_path, segments=1, retries=0, retry_delay=1,
+                           blocksize=FTP_BLOCK_SIZE, queue_blocks=FTP_WRITE_QUEUE_BLOCKS):
+    """
+    Скачивает файл с FTP через '<local_path>.part' с файлом состояния '<local_path>.part.json'
+    (смещение, размер и MDTM файла на сервере). При обрыве связи переподключается и докачивает
+    с того же места (REST + RETR). Частичный файл сохраняется между запусками и используется,
+    только если размер и MDTM файла на сервере не изменились; докачка идет со смещения из файла
+    состояния, а не с размера .part. Сегментная загрузка помечается в состоянии как недокачиваемая:
+    файл заранее выделен на полный размер и может содержать незаполненные диапазоны, поэтому
+    такой .part при следующем запуске удаляется.
+    Возвращает размер файла; после исчерпания попыток выбрасывает исключение.
+    :param blocksize: Размер блока приема по FTP.
+    :param queue_blocks: Емкость очереди блоков между приемом и записью на диск.
+    """
+    part_path = local_path + '.part'
+    state_path = part_path + '.json'
+    attempt = 0
+    while True:
+        try:
+            ftp_conn.cwd(remote_dir)
+            ftp_conn.voidcmd('TYPE I') # SIZE в ASCII-режиме многие серверы отклоняют
+            file_size = ftp_conn.size(filename)
+            remote_mtime = get_ftp_mdtm(ftp_conn, filename)
+
+            offset = 0
+            state = load_transfer_state(state_path)
+            if os.path.exists(part_path):
+                part_size = os.path.getsize(part_path)
+                saved_offset = state.get('offset') if state else None
+                if (state and not state.get('segmented') and state.get('remote_size') == file_size
+                        and state.get('remote_mtime') == remote_mtime
+                        and isinstance(saved_offset, int) and 0 <= saved_offset <= part_size <= file_size):
+                    offset = saved_offset
+                    # Данные после сохраненного смещения могли не дойти до диска - отрезаем их
+                    if part_size > offset:
+                        with open(part_path, 'r+b') as part_file: part_file.truncate(offset)
+                else:
+                    discard_partial_download(part_path)
+            if offset:
+                cprint(f"  Найдена незавершенная загрузка '{filename}': докачка с {offset} из {file_size} байт.", 'info')
+            state = {'remote_size': file_size, 'remote_mtime': remote_mtime, 'offset': offset}
+            save_transfer_state(state_path, state)
+
+            downloaded = False
+            if offset == 0 and segments > 1 and ftp_url and file_size and file_size >= FTP_SEGMENT_MIN_SIZE:
+                if ftp_supports_rest(ftp_conn):
+                    save_transfer_state(state_path, dict(state, segmented=True))
+                    try:
+                        download_ftp_segmented(ftp_url, remote_dir, filename, part_path, file_size, segments)
+                        downloaded = True
+                    except Exception as e:
+                        # После сегментной загрузки в файле могут остаться "дыры", докачивать его нельзя
+                        cprint(f"ПРЕДУПРЕЖДЕНИЕ: Сегментная загрузка не удалась ({e}). Скачиваю одним потоком.", 'warning')
+                        discard_partial_download(part_path)
+                        save_transfer_state(state_path, state)
+                else:
+                    cprint("  FTP сервер не поддерживает REST. Скачиваю одним потоком.", 'info')
+
+            if not downloaded:
+                with open(part_path, 'ab') as local_file:
+                    with tqdm(
+                        total=file_size, initial=offset,
+                        unit='B', unit_scale=True, unit_divisor=1024,
+                        desc=filename,
+                        ascii=True # Для лучшей совместимости с консолями
+                    ) as progress:
+                        ftp_retrieve_pipelined(
+                            ftp_conn, filename, TransferStateWriter(local_file, state_path, state), progress,
+                            blocksize=blocksize, queue_blocks=queue_blocks, rest=offset or None
+                        )
+
+            if os.path.getsize(part_path) != file_size:
+                raise EOFError(f"Получено {os.path.getsize(part_path)} байт из {file_size}.")
+            os.replace(part_path, local_path)
+            discard_partial_download(part_path)
+            return file_size
+
+        except ftplib.error_perm:
+            raise # Постоянная ошибка (нет файла, нет прав) - повтор не поможет
+        except ftplib.all_errors as e:
+            attempt += 1
+            # После приема одним потоком все принятые блоки уже записаны (ftp_retrieve_pipelined
+            # дожидается записи), поэтому размер .part - надежное смещение для докачки
+            state = load_transfer_state(state_path)
+            if state and not state.get('segmented') and os.path.exists(part_path):
+                state['offset'] = os.path.getsize(part_path)
+                save_transfer_state(state_path, state)
+            if attempt > retries or not ftp_url:
+                raise
+            delay = _retry_delay(attempt, retry_delay)
+            cprint(f"\n  Обрыв передачи '{filename}': {e}. Повтор {attempt}/{retries} через {delay} с...", 'warning')
+            time.sleep(delay)
+            reconnect_ftp(ftp_conn, ftp_url)
+
+def ftp_upload_resumable(ftp_conn, ftp_url, remote_dir, local_path, remote_name, retries=0, retry_delay=1, progress=None):
+    """
+    Загружает файл на FTP. При обрыве связи переподключается, узнает размер уже
+    загруженной части (SIZE) и дозагружает остаток через APPE (или REST + STOR,
+    если APPE не поддерживается).
+    :param progress: Общий прогресс-бар (при параллельной загрузке нескольких файлов).
+    """
+    file_size = os.path.getsize(local_path)
+    attempt = 0
+    while True:
+        try:
+            ftp_conn.cwd(remote_dir)
+            ftp_conn.voidcmd('TYPE I')
+            offset = 0
+            if attempt > 0:
+                try: offset = ftp_conn.size(remote_name) or 0
+                except ftplib.all_errors: offset = 0
+                if offset > file_size: offset = 0
+                if offset: cprint(f"  Дозагрузка '{remote_name}' с {offset} из {file_size} байт.", 'info')
+
+            with open(local_path, 'rb') as f:
+                f.seek(offset)
+                with nullcontext(progress) if progress else tqdm(
+                    total=file_size, initial=offset, unit='B', unit_scale=True, unit_divisor=1024,
+                    desc=remote_name, ascii=True
+                ) as file_progress:
+                    # Создаем коллбэк, который будет передавать РАЗМЕР блока, а не сам блок
+                    def progress_callback(chunk):
+                        file_progress.update(len(chunk))
+
+                    if not offset:
+                        ftp_conn.storbinary(f'STOR {remote_name}', f, callback=progress_callback)
+                    else:
+                        try:
+                            ftp_conn.storbinary(f'APPE {remote_name}', f, callback=progress_callback)
+                        except ftplib.error_perm:
+                            f.seek(offset)
+                            ftp_conn.storbinary(f'STOR {remote_name}', f, callback=progress_callback, rest=offset)
+
+            try: remote_size = ftp_conn.size(remote_name)
+            except ftplib.all_errors: remote_size = None
+            if remote_size is not None and remote_size != file_size:
+                raise EOFError(f"На FTP загружено {remote_size} байт из {file_size}.")
+            return
+
+        except ftplib.error_perm:
+            raise
+        except ftplib.all_errors as e:
+            attempt += 1
+            if attempt > retries or not ftp_url:
+                raise
+            delay = _retry_delay(attempt, retry_delay)
+            cprint(f"\n  Обрыв загрузки '{remote_name}': {e}. Повтор {attempt}/{retries} через {delay} с...", 'warning')
+            time.sleep(delay)
+            reconnect_ftp(ftp_conn, ftp_url)
+
+# --- Копирование файлов (SMB и локальные диски) ---
+
+class LockedProgress:
+    """Общий прогресс-бар для нескольких потоков: обновления выполняются под блокировкой."""
+    def __init__(self, progress):
+        self.progress = progress
+        self.lock = threading.Lock()
+
+    def update(self, n):
+        with self.lock:
+            self.progress.update(n)
+
+class ThrottledProgress:
+    """Обертка над tqdm: накапливает переданные байты и обновляет прогресс-бар не чаще interval секунд."""
+    def __init__(self, progress, interval=PROGRESS_UPDATE_INTERVAL):
+        self.progress = progress
+        self.interval = interval
+        self.pending = 0
+        self.last_update = time.monotonic()
+
+    def update(self, n):
+        self.pending += n
+        now = time.monotonic()
+        if now - self.last_update >= self.interval:
+            self.progress.update(self.pending)
+            self.pending = 0
+            self.last_update = now
+
+    def flush(self):
+        if self.pending:
+            self.progress.update(self.pending)
+            self.pending = 0
+
+def _copy_file_data(fsrc, fdst, progress, block_size):
+    """
+    Копирует данные между открытыми (без буферизации) файлами с текущих позиций.
+    Сначала пробует копирование средствами ядра (copy_file_range, sendfile), где ОС это
+    поддерживает, затем - чтение в один заранее выделенный буфер через readinto.
+    """
+    src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+    # Системные вызовы сдвигают позиции файлов только на реально скопированные байты,
+    # поэтому при ошибке можно продолжить следующим способом с того же места.
+    kernel_copies = []
+    if hasattr(os, 'copy_file_range'):
+        kernel_copies.append(lambda: os.copy_file_range(src_fd, dst_fd, block_size))
+    if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+        kernel_copies.append(lambda: os.sendfile(dst_fd, src_fd, None, block_size))
+    for kernel_copy in kernel_copies:
+        try:
+            while True:
+                copied = kernel_copy()
+                if not copied: return
+                progress.update(copied)
+        except OSError:
+            continue
+
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    while True:
+        read = fsrc.readinto(buffer)
+        if not read: return
+        chunk = view[:read]
+        while chunk:
+            written = fdst.write(chunk)
+            chunk = chunk[written:]
+        progress.update(read)
+
+def copy_file(src_path, dst_path, desc, block_size=DEFAULT_BLOCK_SIZE, offset=0, progress=None):
+    """
+    Копирует файл с прогресс-баром. При offset > 0 продолжает копирование с этого смещения,
+    сохраняя уже записанное начало файла назначения. Возвращает размер файла.
+    :param progress: Общий прогресс-бар вместо отдельного для этого файла.
+    """
+    file_size = os.path.getsize(src_path)
+    with open(src_path, 'rb', buffering=0) as fsrc, open(dst_path, 'r+b' if offset else 'wb', buffering=0) as fdst:
+        if offset:
+            fsrc.seek(offset)
+            fdst.seek(offset)
+            fdst.truncate()
+        with nullcontext(progress) if progress else tqdm(
+            total=file_size, initial=offset, unit='B', unit_scale=True, unit_divisor=1024,
+            desc=desc, ascii=True
+        ) as file_progress:
+            throttled = ThrottledProgress(file_progress)
+            _copy_file_data(fsrc, fdst, throttled, block_size)
+            throttled.flush()
+    return file_size
+
+def copy_file_resumable(src_path, dst_path, desc, retries=0, retry_delay=1, block_size=DEFAULT_BLOCK_SIZE, progress=None):
+    """
+    Копирует файл (SMB) с прогресс-баром. При ошибке ввода-вывода повторяет попытку,
+    продолжая с текущего размера файла назначения.
+    """
+    file_size = os.path.getsize(src_path)
+    attempt = 0
+    while True:
+        try:
+            offset = 0
+            if attempt > 0 and os.path.exists(dst_path):
+                offset = min(os.path.getsize(dst_path), file_size)
+            copy_file(src_path, dst_path, desc, block_size=block_size, offset=offset, progress=progress)
+            return
+        except (FileNotFoundError, PermissionError):
+            raise
+        except OSError as e:
+            attempt += 1
+            if attempt > retries:
+                raise
+            delay = _retry_delay(attempt, retry_delay)
+            cprint(f"\n  Ошибка копирования '{desc}': {e}. Повтор {attempt}/{retries} через {delay} с...", 'warning')
+            time.sleep(delay)
+
+def _read_range_crc(path, offset, length, block_size):
+    """Считает CRC32 диапазона байт файла."""
+    crc = 0
+    with open(path, 'rb', buffering=0) as f:
+        f.seek(offset)
+        buffer = bytearray(min(block_size, length) or 1)
+        view = memoryview(buffer)
+        while length > 0:
+            read = f.readinto(view[:min(block_size, length)])
+            if not read:
+                raise IOError(f"Файл '{path}' короче ожидаемого.")
+            crc = zlib.crc32(view[:read], crc)
+            length -= read
+    return crc
+
+def copy_file_parallel(src_path, dst_path, desc, workers=4, range_size=16 * 1024 * 1024, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Копирует большой файл с SMB несколькими потоками: каждый поток читает свои диапазоны байт
+    позиционным чтением (os.pread или отдельный дескриптор + seek) и пишет их в заранее
+    выделенный файл назначения. На сетевой шаре с высокой задержкой несколько запросов
+    в полете дают кратный прирост скорости по сравнению с последовательным чтением.
+    После копирования проверяет результат: размер и дата изменения источника не должны
+    измениться, а CRC32 каждого диапазона в файле назначения должен совпасть с прочитанным.
+    Возвращает размер файла.
+    """
+    source_stat = os.stat(src_path)
+    file_size = source_stat.st_size
+    ranges = [(offset, min(range_size, file_size - offset)) for offset in range(0, file_size, range_size)]
+    with open(dst_path, 'wb') as fdst:
+        fdst.truncate(file_size)
+
+    local = threading.local()
+    handles = []
+    handles_lock = threading.Lock()
+    progress_lock = threading.Lock()
+    has_pread = hasattr(os, 'pread') and hasattr(os, 'pwrite')
+
+    def get_handles():
+        # Каждому потоку - свои дескрипторы: позиции файлов у потоков не пересекаются
+        if not hasattr(local, 'src'):
+            local.src = open(src_path, 'rb', buffering=0)
+            local.dst = open(dst_path, 'r+b', buffering=0)
+            local.view = memoryview(bytearray(min(block_size, range_size)))
+            with handles_lock: handles.extend((local.src, local.dst))
+        return local.src, local.dst, local.view
+
+    def copy_range(offset, length):
+        fsrc, fdst, view = get_handles()
+        crc = 0
+        position, remaining = offset, length
+        if not has_pread:
+            fsrc.seek(offset)
+            fdst.seek(offset)
+        while remaining > 0:
+            chunk_size = min(len(view), remaining)
+            if has_pread:
+                chunk = memoryview(os.pread(fsrc.fileno(), chunk_size, position))
+            else:
+                chunk = view[:fsrc.readinto(view[:chunk_size])]
+            read = len(chunk)
+            if not read:
+                raise IOError(f"Файл '{src_path}' стал короче во время копирования.")
+            crc = zlib.crc32(chunk, crc)
+            written_total = 0
+            while written_total < read:
+                part = chunk[written_total:]
+                written_total += os.pwrite(fdst.fileno(), part, position + written_total) if has_pread else fdst.write(part)
+            position += read
+            remaining -= read
+            with progress_lock: throttled.update(read)
+        return offset, length, crc
+
+    range_crcs = []
+    started = time.perf_counter()
+    try:
+        with tqdm(
+            total=file_size, unit='B', unit_scale=True, unit_divisor=1024,
+            desc=f"{desc} [x{min(workers, len(ranges))}]", ascii=True
+        ) as progress:
+            throttled = ThrottledProgress(progress)
+            with ThreadPoolExecutor(max_workers=max(1, min(workers, len(ranges)))) as executor:
+                futures = [executor.submit(copy_range, offset, length) for offset, length in ranges]
+                for future in as_completed(futures):
+                    range_crcs.append(future.result())
+            throttled.flush()
+    finally:
+        for handle in handles:
+            try: handle.close()
+            except OSError: pass
+    elapsed = time.perf_counter() - started
+
+    current_stat = os.stat(src_path)
+    if (current_stat.st_size, current_stat.st_mtime) != (file_size, source_stat.st_mtime):
+        raise IOError(f"Файл '{src_path}' изменился во время копирования.")
+    if os.path.getsize(dst_path) != file_size:
+        raise IOError(f"Размер скопированного файла не совпадает с исходным ({file_size} байт).")
+    for offset, length, crc in range_crcs:
+        if _read_range_crc(dst_path, offset, length, block_size) != crc:
+            raise IOError(f"Контрольная сумма диапазона {offset}-{offset + length} в '{dst_path}' не совпадает с источником.")
+    if elapsed > 0:
+        cprint(f"  Скопировано {format_size(file_size)} за {elapsed:.1f} с ({file_size / 1024 / 1024 / elapsed:.1f} МБ/с), проверка CRC32 пройдена.", 'info')
+    return file_size
+
+# --- Локальный кэш архивов и установщиков ---
+
+ARCHIVE_CACHE_INDEX = 'cache_index.json'
+FICLONE = 0x40049409 # ioctl для reflink-копирования (Linux: Btrfs, XFS)
+# Статистика кэша за текущий запуск
+archive_cache_stats = {'hits': 0, 'misses': 0, 'bytes_saved': 0}
+
+def place_file(src_path, dst_path):
+    """
+    Размещает файл из кэша по пути назначения без копирования данных, если это возможно:
+    жесткая ссылка, затем reflink, и только потом обычное копирование.
+    Возвращает использованный способ: 'hardlink', 'reflink' или 'copy'.
+    """
+    if os.path.lexists(dst_path):
+        os.remove(dst_path)
+    try:
+        os.link(src_path, dst_path)
+        return 'hardlink'
+    except OSError:
+        pass
+    try:
+        import fcntl
+        with open(src_path, 'rb') as fsrc, open(dst_path, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        shutil.copystat(src_path, dst_path)
+        return 'reflink'
+    except (ImportError, OSError):
+        if os.path.exists(dst_path):
+            os.remove(dst_path)
+    shutil.copy2(src_path, dst_path)
+    return 'copy'
+
+def load_archive_cache_index(cache_dir):
+    """Читает индекс кэша архивов."""
+    try:
+        with open(os.path.join(cache_dir, ARCHIVE_CACHE_INDEX), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        index.setdefault('entries', {})
+        index.setdefault('stats', {'hits': 0, 'misses': 0})
+        return index
+    except (OSError, ValueError):
+        return {'entries': {}, 'stats': {'hits': 0, 'misses': 0}}
+
+def save_archive_cache_index(cache_dir, index):
+    """Атомарно сохраняет индекс кэша архивов."""
+    index_path = os.path.join(cache_dir, ARCHIVE_CACHE_INDEX)
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, index_path)
+
+def archive_cache_key(source, version, name, size, mtime):
+    """Ключ записи кэша: источник, версия, имя файла, размер и время изменения на источнике."""
+    raw = f"{source}|{version}|{name}|{size}|{mtime}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()[:32]
+
+def evict_archive_cache(cache_dir, index, max_bytes, keep_key=None):
+    """Удаляет давно не использованные записи (LRU), пока размер кэша превышает лимит."""
+    entries = index['entries']
+    total = sum(entry['size'] for entry in entries.values())
+    for key in sorted(entries, key=lambda k: entries[k]['last_used']):
+        if total <= max_bytes: break
+        if key == keep_key: continue
+        entry = entries.pop(key)
+        total -= entry['size']
+        shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+        cprint(f"  Кэш: удален устаревший файл '{entry['name']}' (версия {entry['version']}).", 'info')
+
+def get_cached_file(settings, source, version, name, size, mtime, fetch_func):
+    """
+    Возвращает путь к файлу в локальном кэше, при промахе скачивая его через fetch_func(dest_path).
+    Ключ - источник, версия, имя, размер и время изменения файла на источнике, поэтому
+    перевыложенный на источнике файл с тем же именем не будет взят из кэша.
+    """
+    cache_dir = settings['cache_dir']
+    key = archive_cache_key(source, version, name, size, mtime)
+    entry_path = os.path.join(cache_dir, key, name)
+    os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+
+    index = load_archive_cache_index(cache_dir)
+    entry = index['entries'].get(key)
+    if entry and os.path.isfile(entry_path) and os.path.getsize(entry_path) == size:
+        cprint(f"  Кэш: '{name}' найден в локальном кэше, скачивание не требуется.", 'success')
+        archive_cache_stats['hits'] += 1
+        archive_cache_stats['bytes_saved'] += size
+        index['stats']['hits'] += 1
+    else:
+        cprint(f"  Кэш: '{name}' отсутствует в локальном кэше.", 'info')
+        fetch_func(entry_path)
+        archive_cache_stats['misses'] += 1
+        index['stats']['misses'] += 1
+
+    # Индекс перечитываем: за время скачивания его мог изменить другой экземпляр утилиты
+    stats = index['stats']
+    index = load_archive_cache_index(cache_dir)
+    index['stats'] = stats
+    index['entries'][key] = {
+        'source': source, 'version': version, 'name': name,
+        'size': size, 'mtime': mtime, 'last_used': time.time()
+    }
+    evict_archive_cache(cache_dir, index, settings['cache_max_bytes'], keep_key=key)
+    save_archive_cache_index(cache_dir, index)
+    return entry_path
+
+def get_remote_file_facts(source, source_path, name, ftp_conn=None):
+    """Возвращает (размер, время изменения) файла на FTP или SMB для ключа кэша."""
+    if source == 'ftp':
+        ftp_conn.cwd('/' + source_path.strip('/'))
+        ftp_conn.voidcmd('TYPE I')
+        return ftp_conn.size(name), get_ftp_mdtm(ftp_conn, name)
+    stat = os.stat(os.path.join(source_path, name))
+    return stat.st_size, int(stat.st_mtime)
+
+def report_archive_cache(settings):
+    """Выводит статистику кэша за текущий запуск."""
+    if settings['cache_max_bytes'] <= 0: return
+    if not archive_cache_stats['hits'] and not archive_cache_stats['misses']: return
+    index = load_archive_cache_index(settings['cache_dir'])
+    total = sum(entry['size'] for entry in index['entries'].values())
+    cprint(
+        f"Кэш архивов: попаданий {archive_cache_stats['hits']}, промахов {archive_cache_stats['misses']}, "
+        f"сэкономлено {archive_cache_stats['bytes_saved'] / 1024 / 1024:.1f} МБ; "
+        f"занято {total / 1024 / 1024:.1f} из {settings['cache_max_bytes'] / 1024 / 1024:.0f} МБ "
+        f"(всего попаданий {index['stats']['hits']}, промахов {index['stats']['misses']}).",
+        'info'
+    )
+
+VERSION_DIR_PATTERN = r'^[\d\.]+$'
+
+def is_update_archive(filename):
+    """Проверяет, похоже ли имя файла на архив обновления RMS/Chain."""
+    name = filename.lower()
+    return name.endswith('.zip') and ('chain' in name or 'rms' in name)
+
+def format_size(size_bytes):
+    """Форматирует размер в байтах для вывода пользователю."""
+    if size_bytes is None: return '?'
+    for unit in ['Б', 'КБ', 'МБ']:
+        if size_bytes < 1024: return f"{size_bytes:.0f} {unit}" if unit == 'Б' else f"{size_bytes:.1f} {unit}"
+        size_bytes /= 1024
+    return f"{size_bytes:.2f} ГБ"
+
+def format_archive_list(version_info):
+    """Список архивов версии для меню, с размером и датой, если они известны."""
+    archive_info = version_info.get('archive_info', {})
+    parts = []
+    for archive in version_info['archives']:
+        facts = archive_info.get(archive)
+        if not facts:
+            parts.append(archive)
+            continue
+        details = [format_size(facts.get('size'))]
+        modified = facts.get('modified')
+        if modified and len(modified) >= 12:
+            details.append(f"{modified[0:4]}-{modified[4:6]}-{modified[6:8]} {modified[8:10]}:{modified[10:12]}")
+        parts.append(f"{archive} [{', '.join(details)}]")
+    return ', '.join(parts)
+
+def _ftp_mlsd_files(ftp, path):
+    """
+    Возвращает {имя: {'size': ..., 'modified': ...}} для файлов в директории FTP по данным MLSD.
+    Время 'modified' - строка YYYYMMDDHHMMSS (UTC), как ее отдает сервер.
+    """
+    files = {}
+    for name, facts in ftp.mlsd(path, facts=['type', 'size', 'modify']):
+        if facts.get('type', '').lower() != 'file': continue
+        size = facts.get('size')
+        files[name] = {
+            'size': int(size) if size and size.isdigit() else None,
+            'modified': facts.get('modify', '').split('.')[0] or None
+        }
+    return files
+
+def _ftp_version_entry(base_path, version, files, dir_modified=None):
+    """Формирует запись available_versions для версии на FTP или None, если архивов нет."""
+    found_archives = sorted(f for f in files if is_update_archive(f))
+    if not found_archives: return None
+    return {
+        'source': 'ftp',
+        'version': version,
+        'path': f"{base_path}/{version}".strip('/'),
+        'archives': found_archives,
+        'archive_info': {name: files[name] for name in found_archives},
+        'modified': dir_modified
+    }
+
+def find_versions_on_ftp(ftp, base_path, ftp_url=None, workers=1, cached_versions=None, quiet=False):
+    """
+    Ищет доступные версии обновлений на FTP.
+    Если сервер поддерживает MLSD, директории определяются по факту 'type' из одного листинга
+    базовой директории, а содержимое папок версий читается параллельно в нескольких
+    FTP-сессиях (не больше workers). Иначе используется поиск через NLST и CWD.
+    :param cached_versions: Результат прошлого сканирования; папки версий, у которых не
+                            изменилось время модификации (MLSD 'modify'), повторно не читаются.
+    :param quiet: Не выводить найденные версии (фоновое обновление каталога).
+    """
+    if not quiet: cprint(f"Поиск доступных версий на FTP в директории /{base_path}...", 'step')
+    cached_versions = cached_versions or {}
+    try:
+        base_listing = list(ftp.mlsd(base_path, facts=['type', 'modify']))
+    except ftplib.error_perm:
+        if not quiet: cprint("  FTP сервер не поддерживает MLSD. Использую поиск через NLST.", 'info')
+        return _find_versions_on_ftp_nlst(ftp, base_path, quiet=quiet)
+    except ftplib.all_errors as e:
+        cprint(f"Не удалось получить список элементов в директории '{base_path}': {e}", 'error')
+        return {}
+
+    version_dirs = {
+        name: facts.get('modify', '').split('.')[0] or None
+        for name, facts in base_listing
+        if facts.get('type', '').lower() == 'dir' and re.match(VERSION_DIR_PATTERN, name)
+    }
+    manifest_modified = next(
+        (facts.get('modify', '').split('.')[0] for name, facts in base_listing
+         if name == MANIFEST_FILE_NAME and facts.get('type', '').lower() == 'file'),
+        None
+    )
+    if manifest_modified:
+        manifest = read_manifest_ftp(ftp, base_path)
+        if manifest and manifest_is_fresh(manifest, version_dirs, manifest_modified):
+            if not quiet: cprint(f"  Используется индекс '{MANIFEST_FILE_NAME}' ({len(manifest['versions'])} папок версий).", 'info')
+            return versions_from_manifest(manifest, 'ftp', base_path, version_dirs)
+        if not quiet: cprint(f"  Индекс '{MANIFEST_FILE_NAME}' устарел или поврежден. Сканирую папки версий.", 'warning')
+
+    available_versions = {}
+    for version, dir_modified in list(version_dirs.items()):
+        cached = cached_versions.get(f"FTP {version}")
+        if dir_modified and cached and cached.get('modified') == dir_modified:
+            available_versions[f"FTP {version}"] = cached
+            del version_dirs[version]
+    if available_versions and not quiet:
+        cprint(f"  Без изменений с прошлого сканирования (взято из каталога): {len(available_versions)} папок версий.", 'info')
+    if not version_dirs:
+        return available_versions
+
+    local = threading.local()
+    sessions = []
+    sessions_lock = threading.Lock()
+
+    def get_session():
+        # Каждому потоку - своя FTP-сессия; если открыть ее не удалось, работаем через основную под блокировкой
+        if not hasattr(local, 'conn'):
+            conn = None
+            if ftp_url and workers > 1:
+                conn, _ = connect_ftp(ftp_url, quiet=True, timeout=FTP_TIMEOUT)
+            local.conn = conn
+            if conn is not None:
+                with sessions_lock: sessions.append(conn)
+        return local.conn
+
+    main_conn_lock = threading.Lock()
+
+    def list_version(version):
+        path = f"{base_path}/{version}".strip('/')
+        conn = get_session()
+        if conn is not None:
+            return version, _ftp_mlsd_files(conn, path)
+        with main_conn_lock:
+            return version, _ftp_mlsd_files(ftp, path)
+
+    pool_size = max(1, min(workers, len(version_dirs)))
+    try:
+        with ThreadPoolExecutor(max_workers=pool_size) as executor:
+            futures = {executor.submit(list_version, version): version for version in version_dirs}
+            for future in as_completed(futures):
+                version = futures[future]
+                try:
+                    _, files = future.result()
+                except Exception as e:
+                    cprint(f"  Ошибка при чтении директории версии '{version}' на FTP: {e}", 'warning')
+                    continue
+                entry = _ftp_version_entry(base_path, version, files, version_dirs[version])
+                if entry:
+                    if not quiet: cprint(f"  Найдена версия '{version}' на FTP с архивами: {', '.join(entry['archives'])}", 'success')
+                    available_versions[f"FTP {version}"] = entry
+    finally:
+        for conn in sessions:
+            try: conn.quit()
+            except: pass
+
+    return available_versions
+
+def _find_versions_on_ftp_nlst(ftp, base_path, quiet=False):
+    """
+    Ищет доступные версии обновлений на FTP, используя надежный метод проверки директорий
+    (NLST + CWD). Используется, если сервер не поддерживает MLSD.
     """
-    cprint(f"Поиск доступных версий на FTP в директории /{base_path}...", 'step')
     available_versions = {}
     
     try:
@@ -384,7 +1900,7 @@ def find_versions_on_ftp(ftp, base_path):
         # 3. Итерируемся по каждому элементу, чтобы найти папки с версиями
         for version_dir in items_in_base_dir:
             # Пропускаем элементы, которые не похожи на номер версии
-            if not re.match(r'^[\d\.]+$', os.path.basename(version_dir)):
+            if not re.match(VERSION_DIR_PATTERN, os.path.basename(version_dir)):
                 continue
 
             try:
@@ -395,10 +1911,10 @@ def find_versions_on_ftp(ftp, base_path):
                 
                 # Получаем список архивов внутри папки версии
                 files_in_dir = ftp.nlst()
-                found_archives = [f for f in files_in_dir if f.lower().endswith('.zip') and ('chain' in f.lower() or 'rms' in f.lower())]
+                found_archives = [f for f in files_in_dir if is_update_archive(f)]
                 
                 if found_archives:
-                    cprint(f"  Найдена версия '{os.path.basename(version_dir)}' на FTP с архивами: {', '.join(found_archives)}", 'success')
+                    if not quiet: cprint(f"  Найдена версия '{os.path.basename(version_dir)}' на FTP с архивами: {', '.join(found_archives)}", 'success')
                     # Собираем полный путь для последующих операций
                     full_ftp_path = f"{base_path}/{os.path.basename(version_dir)}".strip('/')
                     unique_key = f"FTP {os.path.basename(version_dir)}"
@@ -428,48 +1944,421 @@ def find_versions_on_ftp(ftp, base_path):
 
     return available_versions
 
-def find_versions_on_smb(smb_path):
-    """Ищет доступные версии обновлений на SMB ресурсе."""
+def _smb_version_entry(smb_path, version_dir, dir_mtime):
+    """Читает папку версии на SMB одним scandir и формирует запись available_versions или None."""
+    version_full_path = os.path.join(smb_path, version_dir)
+    archive_info = {}
+    with os.scandir(version_full_path) as entries:
+        for entry in entries:
+            if not is_update_archive(entry.name) or not entry.is_file(): continue
+            # На Windows stat() для элементов scandir берется из листинга без дополнительного запроса
+            entry_stat = entry.stat()
+            archive_info[entry.name] = {
+                'size': entry_stat.st_size,
+                'modified': time.strftime('%Y%m%d%H%M%S', time.gmtime(entry_stat.st_mtime))
+            }
+    if not archive_info: return None
+    return {
+        'source': 'smb', 'version': version_dir, 'path': version_full_path,
+        'archives': sorted(archive_info), 'archive_info': archive_info,
+        'modified': dir_mtime
+    }
+
+def find_versions_on_smb(smb_path, cached_versions=None, quiet=False, workers=1):
+    """
+    Ищет доступные версии обновлений на SMB ресурсе.
+    Корень читается одним os.scandir (тип и время изменения берутся из листинга),
+    папки версий читаются параллельно в пуле из workers потоков.
+    :param cached_versions: Результат прошлого сканирования; папки версий, время изменения
+                            которых не изменилось, повторно не читаются.
+    :param quiet: Не выводить найденные версии (фоновое обновление каталога).
+    """
     if not smb_path: return {}
-    cprint(f"Поиск доступных версий на SMB ресурсе в директории '{smb_path}'...", 'spep')
+    if not quiet: cprint(f"Поиск доступных версий на SMB ресурсе в директории '{smb_path}'...", 'spep')
+    cached_versions = cached_versions or {}
     available_versions = {}
+    reused = 0
     try:
-        if not os.path.isdir(smb_path):
+        version_dirs = {}
+        manifest_mtime = None
+        try:
+            with os.scandir(smb_path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir():
+                            if re.match(VERSION_DIR_PATTERN, entry.name):
+                                version_dirs[entry.name] = int(entry.stat().st_mtime)
+                        elif entry.name == MANIFEST_FILE_NAME:
+                            manifest_mtime = int(entry.stat().st_mtime)
+                    except OSError:
+                        continue
+        except OSError:
             cprint(f"Ошибка: SMB путь '{smb_path}' не является доступной директорией или недоступен.", 'error')
             return {}
-        items = os.listdir(smb_path)
-        directories = []
-        for item in items:
-             full_item_path = os.path.join(smb_path, item)
-             if os.path.isdir(full_item_path): directories.append(item)
-
-        for version_dir in directories:
-            if not re.match(r'^[\d\.]+$', version_dir): continue 
-            version_full_path = os.path.join(smb_path, version_dir)
-            found_archives = []
-            try:
-                files_in_dir = os.listdir(version_full_path)
-                found_archives = [f for f in files_in_dir if f.lower().endswith('.zip') and ('chain' in f.lower() or 'rms' in f.lower())]
-            except OSError as e:
-                cprint(f"  Ошибка доступа к директории '{version_full_path}' на SMB: {e}. Пропускаю.", 'warning')
-                continue
-            except Exception as e:
-                cprint(f"  Неизвестная ошибка при доступе к директории '{version_full_path}' на SMB: {e}. Пропускаю.", 'warning')
-                continue
 
-            if found_archives:
-                cprint(f"  Найдена версия '{version_dir}' на SMB с архивами: {', '.join(found_archives)}", 'success')
-                unique_key = f"SMB {version_dir}"
-                available_versions[unique_key] = {
-                    'source': 'smb', 'version': version_dir, 'path': version_full_path, 'archives': found_archives 
+        if manifest_mtime is not None:
+            manifest = read_manifest_smb(smb_path)
+            if manifest and manifest_is_fresh(manifest, version_dirs, manifest_mtime):
+                if not quiet: cprint(f"  Используется индекс '{MANIFEST_FILE_NAME}' ({len(manifest['versions'])} папок версий).", 'info')
+                return versions_from_manifest(manifest, 'smb', smb_path, version_dirs)
+            if not quiet: cprint(f"  Индекс '{MANIFEST_FILE_NAME}' устарел или поврежден. Сканирую папки версий.", 'warning')
+
+        to_scan = []
+        for version_dir, dir_mtime in version_dirs.items():
+            unique_key = f"SMB {version_dir}"
+            cached = cached_versions.get(unique_key)
+            if cached and cached.get('modified') == dir_mtime:
+                available_versions[unique_key] = cached
+                reused += 1
+            else:
+                to_scan.append(version_dir)
+
+        if to_scan:
+            with ThreadPoolExecutor(max_workers=max(1, min(workers, len(to_scan)))) as executor:
+                futures = {
+                    executor.submit(_smb_version_entry, smb_path, version_dir, version_dirs[version_dir]): version_dir
+                    for version_dir in to_scan
                 }
+                for future in as_completed(futures):
+                    version_dir = futures[future]
+                    version_full_path = os.path.join(smb_path, version_dir)
+                    try:
+                        entry = future.result()
+                    except OSError as e:
+                        cprint(f"  Ошибка доступа к директории '{version_full_path}' на SMB: {e}. Пропускаю.", 'warning')
+                        continue
+                    except Exception as e:
+                        cprint(f"  Неизвестная ошибка при доступе к директории '{version_full_path}' на SMB: {e}. Пропускаю.", 'warning')
+                        continue
+                    if entry:
+                        if not quiet: cprint(f"  Найдена версия '{version_dir}' на SMB с архивами: {', '.join(entry['archives'])}", 'success')
+                        available_versions[f"SMB {version_dir}"] = entry
     except Exception as e:
         cprint(f"Неизвестная ошибка при поиске версий на SMB ресурсе: {e}", 'error')
+    if reused and not quiet:
+        cprint(f"  Без изменений с прошлого сканирования (взято из каталога): {reused} папок версий.", 'info')
+    return available_versions
+
+# --- Каталог найденных версий (кэш результатов поиска) ---
+
+VERSION_CATALOG_FILE = 'version_catalog.json'
+
+def catalog_source_key(source, location):
+    """Ключ источника в каталоге версий (для FTP - без логина и пароля)."""
+    if source == 'ftp':
+        parsed_url = parse_ftp_url(location)
+        return f"ftp://{parsed_url.hostname}:{parsed_url.port or 21}{parsed_url.path}"
+    return f"smb:{os.path.normcase(os.path.abspath(location))}"
+
+def load_version_catalog(cache_dir):
+    """Читает каталог версий с диска."""
+    try:
+        with open(os.path.join(cache_dir, VERSION_CATALOG_FILE), 'r', encoding='utf-8') as f:
+            catalog = json.load(f)
+        catalog.setdefault('sources', {})
+        return catalog
+    except (OSError, ValueError):
+        return {'sources': {}}
+
+def save_version_catalog(cache_dir, catalog):
+    """Атомарно сохраняет каталог версий."""
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        catalog_path = os.path.join(cache_dir, VERSION_CATALOG_FILE)
+        tmp_path = f"{catalog_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(catalog, f, ensure_ascii=False)
+        os.replace(tmp_path, catalog_path)
+    except OSError as e:
+        cprint(f"ПРЕДУПРЕЖДЕНИЕ: Не удалось сохранить каталог версий: {e}", 'warning')
+
+def get_fresh_catalog_versions(catalog, source_keys, ttl):
+    """
+    Возвращает (версии, возраст в секундах) из каталога, если для всех источников есть
+    запись не старше ttl. Иначе возвращает (None, None).
+    """
+    if not source_keys: return None, None
+    versions = {}
+    oldest = time.time()
+    for key in source_keys:
+        source_entry = catalog['sources'].get(key)
+        if not source_entry or time.time() - source_entry.get('scanned_at', 0) > ttl:
+            return None, None
+        versions.update(source_entry['versions'])
+        oldest = min(oldest, source_entry['scanned_at'])
+    return versions, time.time() - oldest
+
+def scan_update_sources(catalog, ftp_conn, ftp_url, ftp_base_path, smb_path, workers, revalidate=True, quiet=False):
+    """
+    Сканирует FTP и SMB, обновляет записи каталога и возвращает объединенный список версий.
+    При revalidate=True повторно читаются только папки версий, изменившиеся с прошлого сканирования.
+    """
+    available_versions = {}
+    if ftp_conn:
+        key = catalog_source_key('ftp', ftp_url)
+        previous = catalog['sources'].get(key, {}).get('versions') if revalidate else None
+        versions = find_versions_on_ftp(ftp_conn, ftp_base_path, ftp_url=ftp_url, workers=workers, cached_versions=previous, quiet=quiet)
+        catalog['sources'][key] = {'scanned_at': time.time(), 'versions': versions}
+        available_versions.update(versions)
+    if smb_path:
+        key = catalog_source_key('smb', smb_path)
+        previous = catalog['sources'].get(key, {}).get('versions') if revalidate else None
+        versions = find_versions_on_smb(smb_path, cached_versions=previous, quiet=quiet, workers=workers)
+        catalog['sources'][key] = {'scanned_at': time.time(), 'versions': versions}
+        available_versions.update(versions)
+    return available_versions
+
+def start_background_catalog_refresh(cache_dir, ftp_url, use_ftp, smb_path, workers):
+    """
+    Запускает фоновое обновление каталога версий в отдельном потоке с собственной FTP-сессией.
+    Возвращает словарь {'thread': ..., 'versions': ...}; 'versions' заполняется по завершении.
+    """
+    result = {'versions': None}
+
+    def refresh():
+        conn = None
+        try:
+            if use_ftp:
+                conn, base_path = connect_ftp(ftp_url, quiet=True, timeout=FTP_TIMEOUT)
+            else:
+                base_path = ''
+            catalog = load_version_catalog(cache_dir)
+            versions = scan_update_sources(catalog, conn, ftp_url, base_path, smb_path, workers, quiet=True)
+            save_version_catalog(cache_dir, catalog)
+            result['versions'] = versions
+        except Exception as e:
+            cprint(f"\n  (Ошибка фонового обновления каталога версий: {e})", 'warning')
+        finally:
+            if conn:
+                try: conn.quit()
+                except: pass
+
+    result['thread'] = threading.Thread(target=refresh, daemon=True)
+    result['thread'].start()
+    return result
+
+# --- Индекс дистрибутивов (index.json) на стороне публикации ---
+
+def is_distribution_file(filename):
+    """Файлы, которые попадают в индекс: архивы обновлений и установщики."""
+    return is_update_archive(filename) or filename in INSTALLER_SUBDIRS
+
+def hash_file_sha256(path, chunk_size=1024 * 1024):
+    """Считает SHA-256 файла потоково."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def manifest_is_fresh(manifest, version_dirs, manifest_modified):
+    """
+    Индекс актуален, если набор папок версий совпадает с индексом и ни одна папка
+    не изменялась после записи index.json. Время папок и индекса берется из одного
+    листинга базовой директории, поэтому сравнивается в одном формате.
+    """
+    if not isinstance(manifest, dict) or manifest.get('format') != MANIFEST_FORMAT: return False
+    if set(manifest.get('versions', {})) != set(version_dirs): return False
+    return all(modified is not None and modified <= manifest_modified for modified in version_dirs.values())
+
+def versions_from_manifest(manifest, source, base_path, version_dirs):
+    """Строит available_versions по индексу без обхода папок версий."""
+    available_versions = {}
+    for version, version_info in manifest['versions'].items():
+        files = version_info.get('files', {})
+        archives = sorted(name for name in files if is_update_archive(name))
+        if not archives: continue
+        if source == 'ftp':
+            unique_key, path = f"FTP {version}", f"{base_path}/{version}".strip('/')
+        else:
+            unique_key, path = f"SMB {version}", os.path.join(base_path, version)
+        available_versions[unique_key] = {
+            'source': source,
+            'version': version,
+            'path': path,
+            'archives': archives,
+            'archive_info': {name: files[name] for name in archives},
+            'installer_info': {name: files[name] for name in files if name in INSTALLER_SUBDIRS},
+            'modified': version_dirs.get(version)
+        }
     return available_versions
 
+def indexed_sha256(version_info, info_key, name, ftp_conn=None):
+    """
+    SHA-256 файла из index.json, если файл не менялся после построения индекса, иначе None.
+    Свежесть индекса проверяется по времени папок версий, но перезапись файла под тем же именем
+    время папки не меняет, поэтому размер и время изменения самого файла сверяются с индексом отдельно.
+    :param info_key: 'archive_info' или 'installer_info'.
+    """
+    facts = version_info.get(info_key, {}).get(name) or {}
+    if not facts.get('sha256'): return None
+    try:
+        if version_info['source'] == 'ftp':
+            # Полный путь вместо CWD: текущая директория сессии остается прежней
+            remote_path = f"/{version_info['path'].strip('/')}/{name}"
+            ftp_conn.voidcmd('TYPE I')
+            size, modified = ftp_conn.size(remote_path), (get_ftp_mdtm(ftp_conn, remote_path) or '').split('.')[0] or None
+        else:
+            file_stat = os.stat(os.path.join(version_info['path'], name))
+            size, modified = file_stat.st_size, time.strftime('%Y%m%d%H%M%S', time.gmtime(file_stat.st_mtime))
+    except ftplib.all_errors as e:
+        cprint(f"  ПРЕДУПРЕЖДЕНИЕ: Не удалось сверить '{name}' с {MANIFEST_FILE_NAME}: {e}. SHA-256 из индекса не используется.", 'warning')
+        return None
+    if size != facts.get('size') or modified != facts.get('modified'):
+        cprint(f"  ПРЕДУПРЕЖДЕНИЕ: '{name}' изменен после построения {MANIFEST_FILE_NAME} (размер или время не совпадают). "
+               f"SHA-256 из индекса не используется; обновите индекс командой build-index.", 'warning')
+        return None
+    return facts['sha256']
+
+def read_manifest_smb(root):
+    """Читает index.json из корня дистрибутивов на SMB. Возвращает None, если файла нет или он поврежден."""
+    try:
+        with open(os.path.join(root, MANIFEST_FILE_NAME), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        return manifest if isinstance(manifest, dict) and isinstance(manifest.get('versions'), dict) else None
+    except (OSError, ValueError):
+        return None
+
+def read_manifest_ftp(ftp, base_path):
+    """Читает index.json из корня дистрибутивов на FTP. Возвращает None, если файла нет или он поврежден."""
+    buffer = io.BytesIO()
+    try:
+        ftp.retrbinary(f"RETR {f'{base_path}/' if base_path else ''}{MANIFEST_FILE_NAME}", buffer.write)
+        manifest = json.loads(buffer.getvalue().decode('utf-8'))
+        return manifest if isinstance(manifest, dict) and isinstance(manifest.get('versions'), dict) else None
+    except ftplib.all_errors:
+        return None
+    except ValueError:
+        return None
+
+def _manifest_file_facts(size, modified, previous_facts):
+    """Факты о файле для индекса; хэш переиспользуется из прошлого индекса, если файл не менялся."""
+    facts = {'size': size, 'modified': modified}
+    if previous_facts and previous_facts.get('size') == size and previous_facts.get('modified') == modified and previous_facts.get('sha256'):
+        facts['sha256'] = previous_facts['sha256']
+    return facts
+
+def _hash_manifest_files(manifest, jobs, hash_func, workers):
+    """Параллельно считает SHA-256 для файлов, которых нет в прошлом индексе."""
+    if not jobs: return
+    cprint(f"Расчет SHA-256 для {len(jobs)} файлов...", 'step')
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(hash_func, location): (version, name) for version, name, location in jobs}
+        for future in as_completed(futures):
+            version, name = futures[future]
+            facts = manifest['versions'][version]['files'][name]
+            facts['sha256'] = future.result()
+            cprint(f"  {version}/{name} ({format_size(facts['size'])})", 'info')
+
+def build_manifest_smb(root, workers, previous=None):
+    """Сканирует корень дистрибутивов на SMB/локальном диске и строит индекс."""
+    previous_versions = (previous or {}).get('versions', {})
+    manifest = {'format': MANIFEST_FORMAT, 'generated': time.strftime('%Y-%m-%d %H:%M:%S'), 'versions': {}}
+    jobs = []
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if not entry.is_dir() or not re.match(VERSION_DIR_PATTERN, entry.name): continue
+            previous_files = previous_versions.get(entry.name, {}).get('files', {})
+            files = {}
+            with os.scandir(entry.path) as version_entries:
+                for file_entry in version_entries:
+                    if not file_entry.is_file() or not is_distribution_file(file_entry.name): continue
+                    file_stat = file_entry.stat()
+                    modified = time.strftime('%Y%m%d%H%M%S', time.gmtime(file_stat.st_mtime))
+                    files[file_entry.name] = _manifest_file_facts(file_stat.st_size, modified, previous_files.get(file_entry.name))
+                    if 'sha256' not in files[file_entry.name]:
+                        jobs.append((entry.name, file_entry.name, file_entry.path))
+            manifest['versions'][entry.name] = {'files': files}
+    _hash_manifest_files(manifest, jobs, hash_file_sha256, workers)
+    return manifest
+
+def build_manifest_ftp(ftp, ftp_url, base_path, workers, previous=None):
+    """Сканирует корень дистрибутивов на FTP (нужна поддержка MLSD) и строит индекс."""
+    previous_versions = (previous or {}).get('versions', {})
+    manifest = {'format': MANIFEST_FORMAT, 'generated': time.strftime('%Y-%m-%d %H:%M:%S'), 'versions': {}}
+    jobs = []
+    for name, facts in ftp.mlsd(base_path, facts=['type']):
+        if facts.get('type', '').lower() != 'dir' or not re.match(VERSION_DIR_PATTERN, name): continue
+        version_path = f"{base_path}/{name}".strip('/')
+        previous_files = previous_versions.get(name, {}).get('files', {})
+        files = {}
+        for filename, file_facts in _ftp_mlsd_files(ftp, version_path).items():
+            if not is_distribution_file(filename): continue
+            files[filename] = _manifest_file_facts(file_facts['size'], file_facts['modified'], previous_files.get(filename))
+            if 'sha256' not in files[filename]:
+                jobs.append((name, filename, f"{version_path}/{filename}"))
+        manifest['versions'][name] = {'files': files}
+
+    def hash_remote_file(remote_path):
+        conn, _ = connect_ftp(ftp_url, quiet=True, timeout=FTP_TIMEOUT)
+        if conn is None: raise ConnectionError("Не удалось открыть дополнительную FTP-сессию.")
+        try:
+            digest = hashlib.sha256()
+            conn.retrbinary(f'RETR {remote_path}', digest.update, blocksize=FTP_SEGMENT_BLOCK_SIZE)
+            return digest.hexdigest()
+        finally:
+            try: conn.quit()
+            except: pass
+
+    _hash_manifest_files(manifest, jobs, hash_remote_file, workers)
+    return manifest
+
+def run_build_index(config, source=None):
+    """Подкоманда build-index: сканирует корень дистрибутивов один раз и записывает index.json."""
+    smb_path = config['SMB'].get('path', '').strip()
+    ftp_url = config['FTP'].get('url', '').strip()
+    source = source or ('smb' if smb_path else 'ftp')
+    workers = get_config_int(config, 'Transfer', 'discovery_workers')
+
+    try:
+        if source == 'smb':
+            if not smb_path:
+                cprint("SMB Path не указан в config.ini.", 'error')
+                return False
+            cprint(f"Построение индекса для '{smb_path}'...", 'step')
+            manifest = build_manifest_smb(smb_path, workers, previous=read_manifest_smb(smb_path))
+            payload = json.dumps(manifest, ensure_ascii=False, indent=1)
+            manifest_path = os.path.join(smb_path, MANIFEST_FILE_NAME)
+            with open(manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(payload)
+            os.replace(manifest_path + '.tmp', manifest_path)
+        else:
+            ftp_conn, base_path = connect_ftp(ftp_url, timeout=FTP_TIMEOUT)
+            if not ftp_conn: return False
+            try:
+                cprint(f"Построение индекса для FTP /{base_path}...", 'step')
+                manifest = build_manifest_ftp(ftp_conn, ftp_url, base_path, workers, previous=read_manifest_ftp(ftp_conn, base_path))
+                payload = json.dumps(manifest, ensure_ascii=False, indent=1)
+                if base_path: ftp_conn.cwd(base_path)
+                ftp_conn.storbinary(f'STOR {MANIFEST_FILE_NAME}.tmp', io.BytesIO(payload.encode('utf-8')))
+                try:
+                    ftp_conn.rename(f'{MANIFEST_FILE_NAME}.tmp', MANIFEST_FILE_NAME)
+                except ftplib.error_perm:
+                    # Часть серверов не перезаписывает существующий файл при RNTO
+                    ftp_conn.delete(MANIFEST_FILE_NAME)
+                    ftp_conn.rename(f'{MANIFEST_FILE_NAME}.tmp', MANIFEST_FILE_NAME)
+            finally:
+                try: ftp_conn.quit()
+                except: pass
+    except Exception as e:
+        cprint(f"Ошибка при построении индекса: {e}", 'error')
+        return False
+
+    versions_count = len(manifest['versions'])
+    files_count = sum(len(v['files']) for v in manifest['versions'].values())
+    cprint(f"Индекс '{MANIFEST_FILE_NAME}' записан: {versions_count} папок версий, {files_count} файлов, {format_size(len(payload))}.", 'success')
+    return True
+
 
-def download_update_archive(version_info, download_dir, ftp_conn=None):
-    """Скачивает или копирует архив обновления в зависимости от источника."""
+def download_update_archive(version_info, download_dir, ftp_conn=None, ftp_url=None, settings=None):
+    """
+    Скачивает или копирует архив обновления в зависимости от источника.
+    Если включен локальный кэш ([Cache] max_size_mb > 0), архив берется из кэша или
+    сначала скачивается в него, а в download_dir размещается жесткой ссылкой.
+    :param ftp_url: URL FTP для открытия дополнительных сессий и переподключения.
+    :param settings: Параметры передачи (get_transfer_settings).
+    """
+    settings = settings or get_transfer_settings(None)
     source = version_info['source']
     source_path = version_info['path']
     archive_name = version_info['selected_archive'] 
@@ -477,28 +2366,47 @@ def download_update_archive(version_info, download_dir, ftp_conn=None):
     
     os.makedirs(download_dir, exist_ok=True)
 
+    def fetch_from_source(dest_path):
+        if source == 'ftp':
+            absolute_ftp_path = '/' + source_path.strip('/')
+            ftp_download_resumable(
+                ftp_conn, ftp_url, absolute_ftp_path, archive_name, dest_path,
+                segments=settings['ftp_segments'], retries=settings['retries'], retry_delay=settings['retry_delay'],
+                blocksize=settings['ftp_blocksize'], queue_blocks=settings['write_queue_blocks']
+            )
+        else:
+            smb_file_path = os.path.join(source_path, archive_name)
+            try:
+                if settings['smb_workers'] > 1 and os.path.getsize(smb_file_path) >= SMB_PARALLEL_MIN_SIZE:
+                    copy_file_parallel(
+                        smb_file_path, dest_path, archive_name, workers=settings['smb_workers'],
+                        range_size=settings['smb_range_size'], block_size=settings['block_size']
+                    )
+                else:
+                    copy_file(smb_file_path, dest_path, archive_name, block_size=settings['block_size'])
+            except Exception:
+                if os.path.exists(dest_path):
+                    try: os.remove(dest_path)
+                    except: pass
+                raise
+
+    def fetch(dest_path):
+        if settings['cache_max_bytes'] <= 0:
+            fetch_from_source(dest_path)
+            return
+        size, mtime = get_remote_file_facts(source, source_path, archive_name, ftp_conn)
+        cached_path = get_cached_file(settings, source, version_info['version'], archive_name, size, mtime, fetch_from_source)
+        method = place_file(cached_path, dest_path)
+        if method != 'hardlink':
+            cprint(f"  Архив размещен из кэша способом '{method}'.", 'info')
+
     if source == 'ftp':
         if ftp_conn is None:
              cprint("Ошибка: FTP соединение не установлено для скачивания с FTP.", 'error')
              return None
         cprint(f"Скачивание '{archive_name}' из '{source_path}' (FTP) в '{local_file_path}'...", 'step')
         try:
-            absolute_ftp_path = '/' + source_path.strip('/')
-            ftp_conn.cwd(absolute_ftp_path)
-
-            file_size = ftp_conn.size(archive_name)
-            with open(local_file_path, 'wb') as local_file:
-                with tqdm(
-                    total=file_size,
-                    unit='B', unit_scale=True, unit_divisor=1024,
-                    desc=archive_name,
-                    ascii=True # Для лучшей совместимости с консолями
-                ) as progress:
-                    def progress_callback(chunk):
-                        local_file.write(chunk)
-                        progress.update(len(chunk))
-                    
-                    ftp_conn.retrbinary(f'RETR {archive_name}', progress_callback)
+            fetch(local_file_path)
             cprint("Скачивание завершено.", 'success')
             try:
                 ftp_conn.cwd('/')
@@ -508,33 +2416,16 @@ def download_update_archive(version_info, download_dir, ftp_conn=None):
         
         except Exception as e:
             cprint(f"Неизвестная ошибка при скачивании файла с FTP: {e}", 'error')
-            try: ftp_conn.cwd('..')
+            cprint("Частично скачанный файл (.part) сохранен, загрузка продолжится при следующем запуске.", 'warning')
+            try: ftp_conn.cwd('/')
             except: pass
-            if os.path.exists(local_file_path): os.remove(local_file_path)
             return None
 
     elif source == 'smb':
         smb_file_path = os.path.join(source_path, archive_name)
         cprint(f"Копирование '{smb_file_path}' (SMB) в '{local_file_path}'...", 'step')
         try:
-            file_size = os.path.getsize(smb_file_path)
-            chunk_size = 1024 * 1024
-
-            with open(smb_file_path, 'rb') as fsrc:
-                with open(local_file_path, 'wb') as fdst:
-                    with tqdm(
-                        total=file_size,
-                        unit='B', unit_scale=True, unit_divisor=1024,
-                        desc=archive_name,
-                        ascii=True
-                    ) as progress:
-                        while True:
-                            chunk = fsrc.read(chunk_size)
-                            if not chunk:
-                                break
-                            fdst.write(chunk)
-                            progress.update(len(chunk))
-            
+            fetch(local_file_path)
             cprint("Копирование завершено.", 'success')
             return local_file_path
         except FileNotFoundError:
@@ -553,11 +2444,119 @@ def download_update_archive(version_info, download_dir, ftp_conn=None):
         cprint(f"Неизвестный источник обновления: {source}", 'error')
         return None
 
+BACKUP_STRATEGIES = ('auto', 'rename', 'hardlink', 'copy')
 
-def backup_server_folders(server_dir, backup_base_dir):
+def choose_backup_strategy(server_dir, backup_base_dir, requested='auto', keep_originals=False):
+    """
+    Выбирает способ снимка папок сервера в бэкап. Возвращает (стратегия, причина).
+    - 'rename'   - перемещение папки целиком (мгновенно, только в пределах одного тома);
+    - 'hardlink' - ферма жестких ссылок: снимок без копирования данных, оригинал остается на месте
+                   (только в пределах одного тома);
+    - 'copy'     - параллельное копирование дерева пулом потоков (между томами).
+    При keep_originals (инкрементальный режим) оригиналы должны остаться на месте, поэтому
+    'auto' выбирает 'hardlink' на одном томе и None (бэкап только заменяемых файлов) на разных.
+    """
+    os.makedirs(backup_base_dir, exist_ok=True)
+    same_volume = is_same_volume(server_dir, backup_base_dir)
+    volume_note = "папка бэкапов на том же томе, что и сервер" if same_volume else "папка бэкапов на другом томе"
+    if requested not in BACKUP_STRATEGIES:
+        cprint(f"ПРЕДУПРЕЖДЕНИЕ: Неизвестная стратегия бэкапа '{requested}'. Использую 'auto'.", 'warning')
+        requested = 'auto'
+    if requested == 'auto':
+        if keep_originals:
+            return ('hardlink', volume_note) if same_volume else (None, volume_note + ", сохраняются только заменяемые файлы")
+        return ('rename' if same_volume else 'copy'), volume_note
+    if requested in ('rename', 'hardlink') and not same_volume:
+        cprint(f"ПРЕДУПРЕЖДЕНИЕ: Стратегия '{requested}' невозможна: {volume_note}. Использую 'copy'.", 'warning')
+        return 'copy', volume_note
+    if requested == 'rename' and keep_originals:
+        return 'hardlink', "в инкрементальном режиме оригиналы остаются на месте"
+    return requested, "задано в config.ini"
+
+def snapshot_tree(src_path, dest_path, strategy, workers=8):
     """
-    Создает бэкап. Для папок 'exploded', 'tools', 'tomcat9' - перемещает их целиком.
+    Создает снимок дерева src_path в dest_path жесткими ссылками ('hardlink') или копированием
+    ('copy'). Папки создаются заранее, файлы обрабатываются пулом потоков (крупные - первыми);
+    мелкие файлы раздаются потокам пачками, чтобы накладные расходы пула не превышали копирование.
+    Возвращает (число файлов, объем в байтах).
+    """
+    directories, files = [], []
+    for root, dirnames, filenames in os.walk(src_path):
+        rel_root = os.path.relpath(root, src_path)
+        directories.append(rel_root)
+        for filename in filenames:
+            source_file = os.path.join(root, filename)
+            files.append((os.path.join(rel_root, filename), os.lstat(source_file).st_size))
+    for rel_root in directories:
+        os.makedirs(os.path.join(dest_path, rel_root), exist_ok=True)
+    files.sort(key=lambda item: item[1], reverse=True)
+    total_bytes = sum(size for _, size in files)
+
+    batches, batch, batch_bytes = [], [], 0
+    for rel_path, size in files:
+        batch.append(rel_path)
+        batch_bytes += size
+        if len(batch) >= SNAPSHOT_BATCH_FILES or batch_bytes >= SNAPSHOT_BATCH_BYTES:
+            batches.append((batch, batch_bytes))
+            batch, batch_bytes = [], 0
+    if batch: batches.append((batch, batch_bytes))
+
+    def snapshot_batch(rel_paths):
+        for rel_path in rel_paths:
+            source_file, dest_file = os.path.join(src_path, rel_path), os.path.join(dest_path, rel_path)
+            if strategy == 'hardlink':
+                os.link(source_file, dest_file, follow_symlinks=False)
+            else:
+                shutil.copy2(source_file, dest_file, follow_symlinks=False)
+
+    progress_lock = threading.Lock()
+    with tqdm(
+        total=total_bytes, unit='B', unit_scale=True, unit_divisor=1024,
+        desc=f"  {os.path.basename(src_path)}", ascii=True, mininterval=PROGRESS_UPDATE_INTERVAL,
+        disable=strategy == 'hardlink' or not total_bytes
+    ) as progress:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = {executor.submit(snapshot_batch, rel_paths): size for rel_paths, size in batches}
+            for future in as_completed(futures):
+                future.result()
+                with progress_lock: progress.update(futures[future])
+    if strategy == 'copy':
+        # Время изменения папок выставляем после того, как в них записаны файлы
+        for rel_root in reversed(directories):
+            shutil.copystat(os.path.join(src_path, rel_root), os.path.join(dest_path, rel_root))
+    return len(files), total_bytes
+
+def snapshot_folder(src_path, dest_path, strategy, workers=8, keep_original=False):
+    """
+    Переносит (или при keep_original - снимает) папку в бэкап выбранной стратегией и выводит
+    скорость. При 'copy' и 'hardlink' без keep_original оригинал удаляется после успешного снимка;
+    при ошибке частичный снимок удаляется, а оригинал остается на месте.
+    """
+    started = time.perf_counter()
+    if strategy == 'rename':
+        os.rename(src_path, dest_path)
+        cprint(f"    Переименование: {time.perf_counter() - started:.2f} с.", 'info')
+        return
+    try:
+        files_count, total_bytes = snapshot_tree(src_path, dest_path, strategy, workers)
+    except Exception:
+        shutil.rmtree(dest_path, ignore_errors=True)
+        raise
+    elapsed = time.perf_counter() - started
+    if not keep_original:
+        shutil.rmtree(src_path)
+    speed = f", {total_bytes / 1024 / 1024 / elapsed:.1f} МБ/с" if strategy == 'copy' and elapsed > 0 else ""
+    cprint(f"    {files_count} файлов ({format_size(total_bytes)}) за {elapsed:.1f} с{speed}.", 'info')
+
+def backup_server_folders(server_dir, backup_base_dir, folders=None, strategy='auto', keep_originals=False, workers=8, service_name=None):
+    """
+    Создает бэкап. Для папок 'exploded', 'tools', 'tomcat9' - перемещает их целиком
+    (способ выбирается choose_backup_strategy: переименование, жесткие ссылки или копирование).
     Для папки 'logs' - оставляет ее на месте, но перемещает ее содержимое в бэкап.
+    :param folders: Какие папки забирать в бэкап (по умолчанию REQUIRED_BACKUP_FOLDERS).
+    :param strategy: Стратегия снимка из [Update] backup_strategy.
+    :param keep_originals: Снять папки, не убирая их с места (инкрементальный режим).
+    :param service_name: Служба сервера - записывается в backup_info.json для отката.
     """
     timestamp = time.strftime('%Y%m%d_%H%M%S')
     backup_target_dir = os.path.join(backup_base_dir, f"iiko_backup_{timestamp}")
@@ -581,11 +2580,13 @@ def backup_server_folders(server_dir, backup_base_dir):
                 cprint(f"    ПРЕДУПРЕЖДЕНИЕ: Не удалось удалить файл '{installer_path}': {e}", 'warning')
 
     os.makedirs(backup_target_dir, exist_ok=True)
+    chosen_strategy, reason = choose_backup_strategy(server_dir, backup_base_dir, strategy, keep_originals)
+    cprint(f"  Стратегия бэкапа: {chosen_strategy or 'только заменяемые файлы'} ({reason}).", 'info')
     
     # Список папок, которые были перемещены целиком (для отката)
     moved_folders = []
     try:
-        for folder_name in REQUIRED_BACKUP_FOLDERS:
+        for folder_name in (folders or REQUIRED_BACKUP_FOLDERS):
             src_path = os.path.join(server_dir, folder_name)
             
             if not os.path.exists(src_path):
@@ -613,13 +2614,24 @@ def backup_server_folders(server_dir, backup_base_dir):
                 cprint(f"    Содержимое папки '{folder_name}' успешно перемещено. Сама папка сохранена.", 'success')
                 # Важно: мы не добавляем 'logs' в список moved_folders, так как сама папка не перемещалась
 
-            else:
+            elif chosen_strategy:
                 dest_path = os.path.join(backup_target_dir, folder_name)
-                cprint(f"  Перемещение папки '{folder_name}'...", 'info')
-                shutil.move(src_path, dest_path)
-                moved_folders.append(folder_name) # Добавляем в список для отката
+                action = "Снимок" if keep_originals else "Перемещение"
+                cprint(f"  {action} папки '{folder_name}' ({chosen_strategy})...", 'info')
+                snapshot_folder(src_path, dest_path, chosen_strategy, workers=workers, keep_original=keep_originals)
+                if not keep_originals:
+                    moved_folders.append(folder_name) # Добавляем в список для отката
                 cprint("    Успешно.", 'success')
         
+        write_backup_info(backup_target_dir, {
+            'created': timestamp,
+            'service_name': service_name,
+            'server_dir': os.path.abspath(server_dir),
+            'deploy_mode': 'incremental' if keep_originals else 'full',
+            'strategy': chosen_strategy,
+            'snapshot': bool(keep_originals and chosen_strategy),
+            'folders': moved_folders,
+        })
         return backup_target_dir
         
     except Exception as e:
@@ -638,71 +2650,635 @@ def backup_server_folders(server_dir, backup_base_dir):
                 cprint(f"!!! НЕ УДАЛОСЬ вернуть папку '{folder_name}': {rollback_e}", 'error')
         return None
 
-def perform_update(server_info, downloaded_archive_path, backup_base_dir, selected_version_info, ftp_conn=None):
+# --- Откат обновления из бэкапа ---
+
+def write_backup_info(backup_path, info):
+    """Записывает '<backup_path>/backup_info.json' - описание бэкапа, по которому выполняется откат."""
+    try:
+        with open(os.path.join(backup_path, BACKUP_INFO_FILE), 'w', encoding='utf-8') as f:
+            json.dump(info, f, ensure_ascii=False, indent=1)
+    except OSError as e:
+        cprint(f"  ПРЕДУПРЕЖДЕНИЕ: Не удалось записать '{BACKUP_INFO_FILE}': {e}", 'warning')
+
+def read_backup_info(backup_path):
+    """Читает backup_info.json. Возвращает None, если файла нет или он поврежден."""
+    try:
+        with open(os.path.join(backup_path, BACKUP_INFO_FILE), 'r', encoding='utf-8') as f:
+            info = json.load(f)
+        return info if isinstance(info, dict) else None
+    except (OSError, ValueError):
+        return None
+
+def list_backups(backup_base_dir):
+    """Возвращает бэкапы с backup_info.json из backup_base_dir, новые первыми: [(путь, info)]."""
+    backups = []
+    if not os.path.isdir(backup_base_dir): return backups
+    for entry in os.scandir(backup_base_dir):
+        if entry.is_dir() and entry.name.startswith('iiko_backup_'):
+            info = read_backup_info(entry.path)
+            if info: backups.append((entry.path, info))
+    backups.sort(key=lambda item: item[1].get('created', ''), reverse=True)
+    return backups
+
+def _move_path(src_path, dest_path):
+    """Перемещает файл или папку; на одном томе - переименованием."""
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    if is_same_volume(os.path.dirname(src_path), os.path.dirname(dest_path)):
+        os.rename(src_path, dest_path)
+    else:
+        shutil.move(src_path, dest_path)
+
+def restore_from_backup(backup_path, info):
+    """
+    Возвращает файлы сервера из бэкапа. Новые (неудачные) файлы сначала убираются
+    переименованием в соседнюю с сервером папку '.<сервер>_failed_<время>' (тот же том),
+    затем из бэкапа возвращаются папки целиком (режим full) или заменяемые и удаленные файлы
+    по incremental.json (режим incremental). Возвращает путь к папке с неудачной версией.
+    """
+    server_dir = info['server_dir']
+    failed_dir = os.path.join(
+        os.path.dirname(os.path.abspath(server_dir)),
+        f".{os.path.basename(os.path.abspath(server_dir))}_failed_{time.strftime('%Y%m%d_%H%M%S')}"
+    )
+    os.makedirs(failed_dir, exist_ok=True)
+
+    incremental_record_path = os.path.join(backup_path, INCREMENTAL_MANIFEST)
+    if info.get('deploy_mode') == 'incremental':
+        with open(incremental_record_path, 'r', encoding='utf-8') as f:
+            record = json.load(f)
+        for rel_path in record.get('added', []) + record.get('replaced', []):
+            installed_path = os.path.join(server_dir, *rel_path.split('/'))
+            if os.path.lexists(installed_path):
+                _move_path(installed_path, os.path.join(failed_dir, *rel_path.split('/')))
+        for rel_path in record.get('replaced', []) + record.get('removed', []):
+            backup_file = os.path.join(backup_path, *rel_path.split('/'))
+            installed_path = os.path.join(server_dir, *rel_path.split('/'))
+            if info.get('snapshot'):
+                # Снимок должен остаться полным - возвращаем ссылку (или копию), а не сам файл
+                os.makedirs(os.path.dirname(installed_path), exist_ok=True)
+                try:
+                    os.link(backup_file, installed_path)
+                except OSError:
+                    shutil.copy2(backup_file, installed_path)
+            else:
+                _move_path(backup_file, installed_path)
+        cprint(f"  Возвращено файлов: {len(record.get('replaced', [])) + len(record.get('removed', []))}, "
+               f"убрано добавленных: {len(record.get('added', []))}.", 'success')
+        return failed_dir
+
+    for folder_name in info.get('folders', []):
+        backup_folder = os.path.join(backup_path, folder_name)
+        if not os.path.isdir(backup_folder):
+            raise FileNotFoundError(f"Папка '{folder_name}' отсутствует в бэкапе '{backup_path}'.")
+        installed_folder = os.path.join(server_dir, folder_name)
+        if os.path.lexists(installed_folder):
+            _move_path(installed_folder, os.path.join(failed_dir, folder_name))
+        _move_path(backup_folder, installed_folder)
+        cprint(f"  Папка '{folder_name}' возвращена из бэкапа.", 'success')
+    return failed_dir
+
+def rollback_update(backup_path, info=None):
+    """
+    Откатывает сервер к состоянию из бэкапа: останавливает службу, убирает новые файлы,
+    возвращает прежние, запускает службу. Выводит время восстановления (от начала отката
+    до состояния Running). Возвращает True, если служба запущена на прежней версии.
+    """
+    info = info or read_backup_info(backup_path)
+    if not info or not info.get('server_dir'):
+        cprint(f"!!! В '{backup_path}' нет {BACKUP_INFO_FILE} - автоматический откат невозможен, восстановите файлы вручную.", 'error')
+        return False
+    service_name = info.get('service_name')
+    started = time.perf_counter()
+    cprint(f"\n--- Откат сервера '{info['server_dir']}' из бэкапа '{backup_path}' ---", 'header')
+
+    if service_name and get_service_status_wmic(service_name) != 'Stopped':
+        cprint("Остановка службы...", 'step')
+        if not stop_service_escalating(service_name):
+            cprint("!!! Не удалось остановить службу. Откат прерван.", 'error')
+            return False
+
+    try:
+        failed_dir = restore_from_backup(backup_path, info)
+    except Exception as e:
+        cprint(f"!!! ОШИБКА при возврате файлов из бэкапа: {e}", 'error')
+        cprint(f"!!! Бэкап: '{backup_path}'. Восстановите оставшиеся файлы вручную.", 'error')
+        return False
+    info['rolled_back'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    write_backup_info(backup_path, info)
+
+    if service_name:
+        cprint("Запуск службы...", 'step')
+        if not start_service_ps(service_name) or not wait_for_service_status(service_name, 'Running', timeout=90):
+            cprint("!!! Файлы возвращены, но служба не запустилась. Проверьте сервер вручную.", 'error')
+            cprint(f"  Неудачная версия сохранена в '{failed_dir}'.", 'warning')
+            return False
+    try: shutil.rmtree(failed_dir)
+    except OSError as e: cprint(f"  ПРЕДУПРЕЖДЕНИЕ: Не удалось удалить '{failed_dir}': {e}", 'warning')
+    cprint(f"Откат выполнен. Время восстановления: {time.perf_counter() - started:.1f} с.", 'success')
+    return True
+
+def run_rollback_command(config, backup_path=None):
+    """Подкоманда 'rollback': откат из указанного бэкапа или из выбранного в списке."""
+    if not backup_path:
+        backups = list_backups(config['General']['backup_dir'])
+        if not backups:
+            cprint(f"В '{config['General']['backup_dir']}' нет бэкапов с {BACKUP_INFO_FILE}.", 'warning')
+            return False
+        cprint("\nДоступные бэкапы:", 'step')
+        for i, (path, info) in enumerate(backups, 1):
+            status = f", откат уже выполнен {info['rolled_back']}" if info.get('rolled_back') else ""
+            cprint(f"{i}. {os.path.basename(path)} (служба: {info.get('service_name')}, режим: {info.get('deploy_mode')}{status})", 'info')
+        choice = prompt(f"Выберите номер бэкапа для отката (1-{len(backups)}) или Enter для отмены: ").strip()
+        if not choice.isdigit() or not 1 <= int(choice) <= len(backups):
+            cprint("Откат отменен.", 'warning')
+            return False
+        backup_path = backups[int(choice) - 1][0]
+    info = read_backup_info(backup_path)
+    if info and info.get('rolled_back'):
+        cprint(f"!!! Из этого бэкапа уже выполнен откат ({info['rolled_back']}).", 'error')
+        return False
+    return rollback_update(backup_path, info)
+
+def is_same_volume(path_a, path_b):
+    """Проверяет, находятся ли два существующих пути на одном томе (перемещение между ними - переименование)."""
+    try:
+        return os.stat(path_a).st_dev == os.stat(path_b).st_dev
+    except OSError:
+        return False
+
+def get_staging_dir(server_dir, download_dir):
+    """
+    Возвращает папку для распаковки обновления. Предпочтительно - соседняя с папкой сервера
+    папка на том же томе, чтобы развертывание в Шаге 4 было переименованием папок, а не копированием.
+    Если создать ее нельзя (нет прав), используется '<download_dir>/extracted_update'.
+    """
+    server_dir = os.path.abspath(server_dir)
+    staging_dir = os.path.join(os.path.dirname(server_dir), f".{os.path.basename(server_dir)}_update_stage")
+    try:
+        if os.path.exists(staging_dir): shutil.rmtree(staging_dir)
+        os.makedirs(staging_dir)
+        return staging_dir
+    except OSError as e:
+        fallback_dir = os.path.join(download_dir, 'extracted_update')
+        cprint(f"  Не удалось создать папку распаковки рядом с сервером ({e}). Используется '{fallback_dir}'.", 'warning')
+        if os.path.exists(fallback_dir): shutil.rmtree(fallback_dir)
+        os.makedirs(fallback_dir, exist_ok=True)
+        return fallback_dir
+
+def member_path_parts(member_name):
+    """
+    Разбивает имя элемента архива на части пути. Абсолютные пути, имена дисков
+    и '..' отбрасываются так же, как в ZipFile.extract.
+    """
+    parts = [part for part in re.split(r'[\\/]+', member_name) if part not in ('', '.', '..')]
+    if parts and re.match(r'^[A-Za-z]:$', parts[0]):
+        parts = parts[1:]
+    return parts
+
+def safe_member_path(dest_dir, member_name):
+    """Возвращает путь извлечения элемента архива внутри dest_dir; путь вне dest_dir - ошибка."""
+    target = os.path.abspath(os.path.join(dest_dir, *member_path_parts(member_name)))
+    root = os.path.abspath(dest_dir)
+    if target != root and not target.startswith(root + os.sep):
+        raise ValueError(f"Недопустимый путь в архиве: '{member_name}'")
+    return target
+
+def _extract_members(archive_path, members, block_size, progress, progress_lock):
+    """Извлекает часть элементов архива через собственный дескриптор ZipFile потока. Возвращает байты."""
+    extracted = 0
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    with zipfile.ZipFile(archive_path, 'r') as zip_ref:
+        for info, target in members:
+            # ZipExtFile проверяет CRC32 по мере чтения и выбрасывает BadZipFile при несовпадении
+            with zip_ref.open(info) as source, open(target, 'wb') as dest:
+                while True:
+                    read = source.readinto(buffer)
+                    if not read: break
+                    dest.write(view[:read])
+            mtime = time.mktime(info.date_time + (0, 0, -1))
+            os.utime(target, (mtime, mtime))
+            extracted += info.file_size
+            with progress_lock: progress.update(1)
+    return extracted
+
+def extract_archive_parallel(archive_path, dest_dir, workers=4, block_size=DEFAULT_BLOCK_SIZE, names=None):
+    """
+    Распаковывает ZIP-архив в несколько потоков. Центральный каталог делится между потоками
+    по объему данных, у каждого потока свой дескриптор ZipFile. Папки создаются заранее,
+    у файлов сохраняется время изменения из архива, CRC32 каждого файла проверяется при чтении.
+    Возвращает словарь со статистикой (files, bytes, seconds).
+    :param names: Если задан - распаковываются только элементы с этими именами.
+    """
+    started = time.perf_counter()
+    with zipfile.ZipFile(archive_path, 'r') as zip_ref:
+        infos = zip_ref.infolist()
+    if names is not None:
+        infos = [info for info in infos if info.filename in names]
+
+    files, directories = [], {os.path.abspath(dest_dir)}
+    for info in infos:
+        target = safe_member_path(dest_dir, info.filename)
+        if info.is_dir():
+            directories.add(target)
+        else:
+            directories.add(os.path.dirname(target))
+            files.append((info, target))
+    for directory in sorted(directories):
+        os.makedirs(directory, exist_ok=True)
+
+    # Крупные файлы раздаются первыми, каждому потоку - самая легкая на данный момент партия
+    workers = max(1, min(workers, len(files)))
+    batches = [[] for _ in range(workers)]
+    batch_sizes = [0] * workers
+    for info, target in sorted(files, key=lambda item: item[0].compress_size, reverse=True):
+        index = batch_sizes.index(min(batch_sizes))
+        batches[index].append((info, target))
+        batch_sizes[index] += info.compress_size + 4096 # Учитываем накладные расходы на файл
+
+    total_bytes = 0
+    progress_lock = threading.Lock()
+    if not files:
+        return {'files': 0, 'bytes': 0, 'seconds': time.perf_counter() - started}
+    with tqdm(total=len(files), unit='файл', desc="Распаковка", ascii=True, mininterval=PROGRESS_UPDATE_INTERVAL) as progress:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(_extract_members, archive_path, batch, block_size, progress, progress_lock)
+                for batch in batches if batch
+            ]
+            for future in as_completed(futures):
+                total_bytes += future.result()
+
+    # Время изменения папок из архива выставляем после записи файлов в них
+    for info in infos:
+        if info.is_dir():
+            mtime = time.mktime(info.date_time + (0, 0, -1))
+            os.utime(safe_member_path(dest_dir, info.filename), (mtime, mtime))
+
+    seconds = time.perf_counter() - started
+    if seconds > 0:
+        cprint(
+            f"  Распаковано {len(files)} файлов ({format_size(total_bytes)}) за {seconds:.1f} с: "
+            f"{total_bytes / 1024 / 1024 / seconds:.1f} МБ/с, {len(files) / seconds:.0f} файлов/с, потоков: {workers}.",
+            'info'
+        )
+    return {'files': len(files), 'bytes': total_bytes, 'seconds': seconds}
+
+@contextmanager
+def timed_stage(timings, name):
+    """Замеряет длительность блока и добавляет ее в словарь timings под именем этапа."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0) + time.perf_counter() - started
+
+def report_stage_timings(timings, title="Длительность этапов:", downtime=None):
+    """
+    Выводит длительность этапов, накопленную timed_stage.
+    :param downtime: Словарь с отметками 'started'/'ended' (time.perf_counter) простоя службы.
+    """
+    if not timings: return
+    cprint(f"\n{title}", 'step')
+    for name, seconds in timings.items():
+        print(f"  {name}: {seconds:.1f} с")
+    print(f"  Всего: {sum(timings.values()):.1f} с")
+    if downtime and 'started' in downtime:
+        if 'ended' in downtime:
+            cprint(f"  Простой службы (от остановки до запуска): {downtime['ended'] - downtime['started']:.1f} с", 'success')
+        else:
+            cprint(f"  Служба остановлена {time.perf_counter() - downtime['started']:.1f} с назад и не запущена.", 'warning')
+
+# --- Инкрементальное развертывание ---
+
+def get_archive_root_prefix(infos):
+    """
+    Возвращает имя корневой папки архива с '/' на конце, если все элементы лежат в одной папке
+    (так же, как Шаг 4 выбирает единственную папку после распаковки), иначе пустую строку.
+    """
+    top_level, has_nested = set(), False
+    for info in infos:
+        parts = member_path_parts(info.filename)
+        if not parts: continue
+        top_level.add(parts[0])
+        has_nested = has_nested or len(parts) > 1 or info.is_dir()
+    if len(top_level) == 1 and has_nested:
+        return top_level.pop() + '/'
+    return ''
+
+def plan_incremental_deploy(archive_path, server_dir, workers=4, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Сравнивает центральный каталог архива (размер + CRC32) с установленными файлами
+    в папках FOLDERS_TO_REPLACE. Файлы с другим размером считаются измененными без чтения,
+    у файлов того же размера CRC32 считается в несколько потоков.
+    Возвращает план: списки changed/added/removed (пути относительно server_dir через '/'),
+    число и объем неизмененных файлов и элементы архива по относительному пути.
+    """
+    with zipfile.ZipFile(archive_path, 'r') as zip_ref:
+        infos = zip_ref.infolist()
+    prefix_parts = member_path_parts(get_archive_root_prefix(infos))
+
+    archive_files, archive_dirs = {}, set()
+    for info in infos:
+        parts = member_path_parts(info.filename)[len(prefix_parts):]
+        if not parts or parts[0] not in FOLDERS_TO_REPLACE: continue
+        rel_path = '/'.join(parts)
+        if info.is_dir():
+            archive_dirs.add(rel_path)
+        else:
+            archive_files[rel_path] = info
+            archive_dirs.update('/'.join(parts[:i]) for i in range(1, len(parts)))
+
+    installed = {}
+    for folder_name in FOLDERS_TO_REPLACE:
+        folder_path = os.path.join(server_dir, folder_name)
+        for root, _, filenames in os.walk(folder_path):
+            rel_root = os.path.relpath(root, server_dir).replace(os.sep, '/')
+            for filename in filenames:
+                installed[f"{rel_root}/{filename}"] = os.path.join(root, filename)
+
+    plan = {
+        'changed': [], 'added': [], 'removed': sorted(set(installed) - set(archive_files)),
+        'unchanged': 0, 'unchanged_bytes': 0, 'members': archive_files, 'dirs': archive_dirs,
+    }
+    same_size = []
+    for rel_path, info in archive_files.items():
+        if rel_path not in installed:
+            plan['added'].append(rel_path)
+        elif os.path.getsize(installed[rel_path]) != info.file_size:
+            plan['changed'].append(rel_path)
+        else:
+            same_size.append(rel_path)
+
+    def compare(rel_path):
+        info = archive_files[rel_path]
+        return rel_path, _read_range_crc(installed[rel_path], 0, info.file_size, block_size) == info.CRC
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for rel_path, equal in executor.map(compare, same_size):
+            if equal:
+                plan['unchanged'] += 1
+                plan['unchanged_bytes'] += archive_files[rel_path].file_size
+            else:
+                plan['changed'].append(rel_path)
+    plan['changed'].sort()
+    plan['added'].sort()
+    plan['write_bytes'] = sum(archive_files[rel_path].file_size for rel_path in plan['changed'] + plan['added'])
+    plan['removed_bytes'] = sum(os.path.getsize(installed[rel_path]) for rel_path in plan['removed'])
+    return plan
+
+def report_incremental_plan(plan):
+    """Выводит сводку плана инкрементального развертывания."""
+    total_bytes = plan['write_bytes'] + plan['unchanged_bytes']
+    saved_percent = plan['unchanged_bytes'] * 100 / total_bytes if total_bytes else 0
+    cprint(f"  Без изменений: {plan['unchanged']} файлов ({format_size(plan['unchanged_bytes'])})", 'info')
+    cprint(f"  Изменено: {len(plan['changed'])}, добавлено: {len(plan['added'])} файлов (запись {format_size(plan['write_bytes'])})", 'info')
+    cprint(f"  Удаляется: {len(plan['removed'])} файлов ({format_size(plan['removed_bytes'])})", 'info')
+    cprint(f"  Не требуется записывать: {format_size(plan['unchanged_bytes'])} ({saved_percent:.0f}% объема обновления).", 'success')
+
+def get_removed_custom_libs(plan):
+    """Возвращает имена библиотек из CUSTOM_LIBS_DIR, которых нет в новой версии."""
+    prefix = CUSTOM_LIBS_DIR + '/'
+    return [rel_path[len(prefix):] for rel_path in plan['removed']
+            if rel_path.startswith(prefix) and '/' not in rel_path[len(prefix):]]
+
+def _remove_empty_dirs(server_dir, rel_path, keep_dirs):
+    """Удаляет опустевшие папки над удаленным файлом, если их нет в новой версии."""
+    parts = rel_path.split('/')[:-1]
+    while len(parts) > 1 and '/'.join(parts) not in keep_dirs:
+        try:
+            os.rmdir(os.path.join(server_dir, *parts))
+        except OSError:
+            return
+        parts.pop()
+
+def stage_incremental_deploy(plan, archive_path, staging_dir, workers=4, block_size=DEFAULT_BLOCK_SIZE):
+    """Распаковывает в staging_dir только новые и измененные по плану файлы."""
+    return extract_archive_parallel(
+        archive_path, staging_dir, workers=workers, block_size=block_size,
+        names={plan['members'][rel_path].filename for rel_path in plan['changed'] + plan['added']}
+    )
+
+def _move_to_backup(installed_path, backup_path):
+    """Убирает файл сервера в бэкап. Если снимок жесткими ссылками уже содержит его, файл просто удаляется."""
+    if os.path.lexists(backup_path):
+        os.remove(installed_path)
+        return
+    os.makedirs(os.path.dirname(backup_path), exist_ok=True)
+    shutil.move(installed_path, backup_path)
+
+def apply_incremental_deploy(plan, server_dir, staging_dir, backup_dir, keep=()):
+    """
+    Применяет план (файлы уже распакованы stage_incremental_deploy): переносит заменяемые
+    и удаляемые оригиналы в backup_dir (с сохранением относительных путей) и ставит новые
+    файлы на место. Список изменений записывается в '<backup_dir>/incremental.json'
+    (в том числе при ошибке), чтобы бэкап можно было вернуть.
+    :param keep: Относительные пути файлов, которые нужно оставить, хотя их нет в новой версии.
+    """
+    to_write = plan['changed'] + plan['added']
+    added = set(plan['added'])
+    record = {'mode': 'incremental', 'replaced': [], 'added': [], 'removed': []}
+    try:
+        for rel_path in to_write:
+            installed_path = os.path.join(server_dir, *rel_path.split('/'))
+            if rel_path in added:
+                record['added'].append(rel_path)
+            else:
+                _move_to_backup(installed_path, os.path.join(backup_dir, *rel_path.split('/')))
+                record['replaced'].append(rel_path)
+            os.makedirs(os.path.dirname(installed_path), exist_ok=True)
+            shutil.move(safe_member_path(staging_dir, plan['members'][rel_path].filename), installed_path)
+        for rel_path in plan['removed']:
+            installed_path = os.path.join(server_dir, *rel_path.split('/'))
+            # Старые установщики удаляются при создании бэкапа, после составления плана
+            if rel_path in keep or not os.path.lexists(installed_path): continue
+            _move_to_backup(installed_path, os.path.join(backup_dir, *rel_path.split('/')))
+            record['removed'].append(rel_path)
+            _remove_empty_dirs(server_dir, rel_path, plan['dirs'])
+    finally:
+        with open(os.path.join(backup_dir, INCREMENTAL_MANIFEST), 'w', encoding='utf-8') as f:
+            json.dump(record, f, ensure_ascii=False, indent=1)
+    cprint(
+        f"  Заменено: {len(record['replaced'])}, добавлено: {len(record['added'])}, "
+        f"удалено: {len(record['removed'])} файлов. Оригиналы сохранены в бэкапе.", 'success'
+    )
+    return record
+
+def run_deploy_dry_run(server_info, archive_path, settings):
+    """Показывает план инкрементального развертывания без остановки службы и изменения файлов."""
+    cprint(f"\n--- Пробный запуск (--dry-run): сравнение архива с '{server_info['server_dir']}' ---", 'header')
+    try:
+        plan = plan_incremental_deploy(
+            archive_path, server_info['server_dir'], workers=settings['extract_workers'], block_size=settings['block_size']
+        )
+    except (OSError, zipfile.BadZipFile) as e:
+        cprint(f"Ошибка при сравнении архива с установленной версией: {e}", 'error')
+        return False
+    report_incremental_plan(plan)
+    custom_libs = get_removed_custom_libs(plan)
+    if custom_libs:
+        cprint(f"  Библиотеки, отсутствующие в новой версии (при обновлении будет предложено их оставить): {', '.join(custom_libs)}", 'warning')
+    return True
+
+def verify_file_sha256(path, expected_sha256):
+    """Сверяет SHA-256 файла с ожидаемым (из index.json). Без ожидаемого значения проверка пропускается."""
+    if not expected_sha256: return True
+    actual_sha256 = hash_file_sha256(path)
+    if actual_sha256.lower() != expected_sha256.lower():
+        cprint(f"  SHA-256 файла '{os.path.basename(path)}' не совпадает с индексом: {actual_sha256} вместо {expected_sha256}.", 'error')
+        return False
+    return True
+
+def place_staged_installers(staged_dir, server_dir):
+    """Переносит заранее загруженные установщики из staged_dir в 'exploded/update' сервера."""
+    for target_subdir in sorted(set(INSTALLER_SUBDIRS.values())):
+        source_folder = os.path.join(staged_dir, target_subdir)
+        if not os.path.isdir(source_folder): continue
+        destination_folder = os.path.join(server_dir, 'exploded', 'update', target_subdir)
+        os.makedirs(destination_folder, exist_ok=True)
+        for filename in os.listdir(source_folder):
+            destination_path = os.path.join(destination_folder, filename)
+            if os.path.exists(destination_path): os.remove(destination_path)
+            shutil.move(os.path.join(source_folder, filename), destination_path)
+
+def perform_update(server_info, downloaded_archive_path, backup_base_dir, selected_version_info, ftp_conn=None, ftp_url=None):
     """
     Выполняет процедуру обновления с мониторингом лога в отдельном потоке
     и обработкой Ctrl+C.
+    Все, что не требует остановки службы (проверка и распаковка архива, кастомные библиотеки,
+    установщики), выполняется заранее. Пока служба остановлена - только бэкап, перестановка
+    папок и запуск; длительность простоя выводится в итоговой сводке.
     """
-    # ... (весь код до Шага 5 остается без изменений) ...
     service_name = server_info['name']
     server_dir = server_info['server_dir']
     
+    timings = {}
+    downtime = {}
+    backup_path = None
+    
     cprint(f"\n--- Запуск процедуры обновления для сервера '{server_info['display_name']}' ---", 'step')
 
-    cprint("Шаг 1: Остановка службы...", 'step')
-    if not stop_service_ps(service_name) or not wait_for_service_status(service_name, 'Stopped'):
-        return False, None, False
-    cprint("Служба успешно остановлена.", 'success')
+    settings = get_transfer_settings(config)
+    deploy_mode = get_config_str(config, 'Update', 'deploy_mode').lower()
+    if deploy_mode not in ('full', 'incremental'):
+        cprint(f"ПРЕДУПРЕЖДЕНИЕ: Неизвестный режим развертывания '{deploy_mode}'. Использую 'full'.", 'warning')
+        deploy_mode = 'full'
+    incremental = deploy_mode == 'incremental'
 
-    cprint("\nШаг 2: Создание бэкапа (перемещением)...", 'step')
-    backup_path = backup_server_folders(server_dir, backup_base_dir)
-    if not backup_path:
-        start_service_ps(service_name)
-        return False, None, False
-    cprint(f"Бэкап создан в: {backup_path}", 'success')
-
-    extract_dir = os.path.join(config['General']['download_dir'], 'extracted_update')
+    extract_dir = get_staging_dir(server_dir, config['General']['download_dir'])
+    same_volume = is_same_volume(extract_dir, server_dir)
+    staged_installers_dir = os.path.join(extract_dir, '.installers')
     
     try:
-        cprint("\nШаг 3: Извлечение архива обновления...", 'step')
-        if os.path.exists(extract_dir): shutil.rmtree(extract_dir)
-        os.makedirs(extract_dir, exist_ok=True)
-        with zipfile.ZipFile(downloaded_archive_path, 'r') as zip_ref:
-            zip_ref.extractall(extract_dir)
-        cprint("Архив успешно извлечен.", 'success')
+        cprint("Шаг 1: Подготовка обновления (служба продолжает работать)...", 'step')
+        archive_name = os.path.basename(downloaded_archive_path)
+        expected_sha256 = indexed_sha256(selected_version_info, 'archive_info', archive_name, ftp_conn)
+        if expected_sha256:
+            cprint("\nШаг 1.1: Проверка SHA-256 архива по index.json...", 'step')
+            with timed_stage(timings, "Проверка архива"):
+                if not verify_file_sha256(downloaded_archive_path, expected_sha256):
+                    raise ValueError(f"Архив '{archive_name}' поврежден или не совпадает с опубликованным.")
+            cprint("Архив проверен.", 'success')
+
+        if incremental:
+            cprint("\nШаг 1.2: Сравнение архива с установленной версией...", 'step')
+            with timed_stage(timings, "Сравнение"):
+                plan = plan_incremental_deploy(
+                    downloaded_archive_path, server_dir, workers=settings['extract_workers'], block_size=settings['block_size']
+                )
+            report_incremental_plan(plan)
+            cprint(f"  Папка распаковки: '{extract_dir}'" + ("" if same_volume else " (другой том, развертывание будет копированием)"), 'info')
+            with timed_stage(timings, "Распаковка"):
+                stage_incremental_deploy(
+                    plan, downloaded_archive_path, extract_dir, workers=settings['extract_workers'], block_size=settings['block_size']
+                )
 
-        cprint("\nШаг 4: Развертывание новых файлов (перемещением)...", 'step')
-        # ... (код развертывания) ...
-        extracted_items = os.listdir(extract_dir)
-        source_base_dir = extract_dir
-        if len(extracted_items) == 1 and os.path.isdir(os.path.join(extract_dir, extracted_items[0])):
-            source_base_dir = os.path.join(extract_dir, extracted_items[0])
-            cprint(f"  Обнаружена корневая папка в архиве: '{extracted_items[0]}'. Работаем из нее.", 'info')
-            
-        # переносим кастомные .jar если есть
-        migrate_custom_libs(
-            backup_path=backup_path,
-            source_base_dir=source_base_dir
-        )
-        for folder_name in FOLDERS_TO_REPLACE:
-            src_path = os.path.join(source_base_dir, folder_name)
-            dest_path = os.path.join(server_dir, folder_name)
-            if os.path.exists(src_path):
-                shutil.move(src_path, dest_path)
+            cprint("\nШаг 1.3: Проверка на наличие кастомных библиотек...", 'step')
+            custom_libs = get_removed_custom_libs(plan)
+            keep = set()
+            if custom_libs:
+                keep = {f"{CUSTOM_LIBS_DIR}/{filename}" for filename in prompt_custom_libs(custom_libs)}
             else:
-                raise FileNotFoundError(f"Папка '{folder_name}' не найдена в извлеченном архиве по пути '{src_path}'")
-        cprint("Новые папки успешно развернуты.", 'success')
+                cprint("  Кастомные библиотеки не найдены. Состав идентичен.", 'success')
+        else:
+            cprint("\nШаг 1.2: Извлечение архива обновления...", 'step')
+            cprint(f"  Папка распаковки: '{extract_dir}'" + ("" if same_volume else " (другой том, развертывание будет копированием)"), 'info')
+            with timed_stage(timings, "Распаковка"):
+                extract_archive_parallel(
+                    downloaded_archive_path, extract_dir, workers=settings['extract_workers'], block_size=settings['block_size']
+                )
+            cprint("Архив успешно извлечен.", 'success')
+
+            extracted_items = os.listdir(extract_dir)
+            source_base_dir = extract_dir
+            if len(extracted_items) == 1 and os.path.isdir(os.path.join(extract_dir, extracted_items[0])):
+                source_base_dir = os.path.join(extract_dir, extracted_items[0])
+                cprint(f"  Обнаружена корневая папка в архиве: '{extracted_items[0]}'. Работаем из нее.", 'info')
+            for folder_name in FOLDERS_TO_REPLACE:
+                if not os.path.isdir(os.path.join(source_base_dir, folder_name)):
+                    raise FileNotFoundError(f"Папка '{folder_name}' не найдена в извлеченном архиве по пути '{os.path.join(source_base_dir, folder_name)}'")
+                
+            # переносим кастомные .jar если есть (сравнение с установленной версией, пока она на месте)
+            migrate_custom_libs(
+                installed_root=server_dir,
+                source_base_dir=source_base_dir
+            )
 
-        cprint("\nШаг 4.5: Загрузка дополнительных установщиков...", 'step')
-        if not download_and_place_installers(server_info, selected_version_info, ftp_conn):
+        cprint("\nШаг 1.4: Загрузка дополнительных установщиков...", 'step')
+        with timed_stage(timings, "Установщики"):
+            installers_ok = download_and_place_installers(
+                server_info, selected_version_info, ftp_conn, ftp_url=ftp_url, settings=settings, target_dir=staged_installers_dir
+            )
+        if not installers_ok:
             cprint("!!! ПРЕДУПРЕЖДЕНИЕ: Не удалось загрузить все необходимые установщики.", 'warning')
         else:
             cprint("Загрузка установщиков завершена.", 'success')
+        cprint("Обновление подготовлено. Далее служба будет остановлена.", 'success')
+
+        cprint("\nШаг 2: Остановка службы...", 'step')
+        downtime['started'] = time.perf_counter()
+        with timed_stage(timings, "Остановка службы"):
+            if not stop_service_escalating(service_name):
+                downtime.clear() # Служба не остановилась - простоя нет
+                return False, None, False
+        cprint("Служба успешно остановлена.", 'success')
+
+        cprint("\nШаг 3: Создание бэкапа (перемещением)...", 'step')
+        if incremental:
+            cprint("  Инкрементальный режим: папки сервера остаются на месте, заменяемые и удаляемые файлы попадут в бэкап.", 'info')
+        with timed_stage(timings, "Бэкап"):
+            backup_path = backup_server_folders(
+                server_dir, backup_base_dir, strategy=get_config_str(config, 'Update', 'backup_strategy').lower(),
+                keep_originals=incremental, workers=max(1, get_config_int(config, 'Update', 'backup_workers')),
+                service_name=service_name
+            )
+        if not backup_path:
+            start_service_ps(service_name)
+            return False, None, False
+        cprint(f"Бэкап создан в: {backup_path}", 'success')
+
+        cprint("\nШаг 4: Развертывание новых файлов (перемещением)...", 'step')
+        with timed_stage(timings, "Развертывание"):
+            if incremental:
+                apply_incremental_deploy(plan, server_dir, extract_dir, backup_path, keep=keep)
+            else:
+                for folder_name in FOLDERS_TO_REPLACE:
+                    src_path = os.path.join(source_base_dir, folder_name)
+                    dest_path = os.path.join(server_dir, folder_name)
+                    if same_volume and not os.path.exists(dest_path):
+                        os.rename(src_path, dest_path) # Один том: атомарное переименование папки
+                    else:
+                        shutil.move(src_path, dest_path)
+                cprint("Новые папки успешно развернуты.", 'success')
+            place_staged_installers(staged_installers_dir, server_dir)
 
         cprint(f"\nШаг 5: Запуск службы '{service_name}'...", 'step')
-        if not start_service_ps(service_name) or not wait_for_service_status(service_name, 'Running', timeout=90):
-             raise RuntimeError("Служба не перешла в состояние 'Running' после обновления.")
+        with timed_stage(timings, "Запуск службы"):
+            if not start_service_ps(service_name) or not wait_for_service_status(service_name, 'Running', timeout=90):
+                 raise RuntimeError("Служба не перешла в состояние 'Running' после обновления.")
+        downtime['ended'] = time.perf_counter()
         cprint("Служба запущена.", 'success')
+        report_stage_timings(timings, downtime=downtime)
         
         os.makedirs(os.path.join(server_dir, 'logs'), exist_ok=True)
         new_log_path = os.path.join(server_dir, 'logs', LOG_FILE_NAME)
@@ -781,6 +3357,17 @@ def perform_update(server_info, downloaded_archive_path, backup_base_dir, select
 
     except Exception as e:
         cprint(f"\n!!! КРИТИЧЕСКАЯ ОШИБКА В ПРОЦЕССЕ ОБНОВЛЕНИЯ: {e}", 'error')
+        if 'started' not in downtime:
+            cprint("Служба не останавливалась и продолжает работать.", 'info')
+        elif backup_path:
+            cprint("Автоматический откат к предыдущей версии...", 'warning')
+            with timed_stage(timings, "Откат"):
+                rolled_back = rollback_update(backup_path)
+            if rolled_back:
+                downtime['ended'] = time.perf_counter()
+                report_stage_timings(timings, downtime=downtime)
+                return False, None, False
+        report_stage_timings(timings, downtime=downtime)
         return False, backup_path, False
     finally:
         cprint("\n  Очистка временных файлов...", 'info')
@@ -791,14 +3378,49 @@ def perform_update(server_info, downloaded_archive_path, backup_base_dir, select
             try: os.remove(downloaded_archive_path)
             except Exception as e: print(f"  ПРЕДУПРЕЖДЕНИЕ: Не удалось удалить скачанный архив '{downloaded_archive_path}': {e}")
 
-def migrate_custom_libs(backup_path, source_base_dir):
+def prompt_custom_libs(extra_files):
+    """
+    Показывает библиотеки, отсутствующие в новой версии, и спрашивает, какие из них перенести.
+    Возвращает список выбранных имен файлов (пустой, если ничего не выбрано).
+    """
+    cprint("  ВНИМАНИЕ: Найдены библиотеки, отсутствующие в новой версии:", 'warning')
+    for i, filename in enumerate(extra_files, 1):
+        print(f"    {i}. {filename}")
+    
+    user_input = prompt("\nВведите номера файлов для переноса (через запятую, например: 1,3) или нажмите Enter, чтобы пропустить: ")
+
+    if not user_input.strip():
+        cprint("  Перенос кастомных библиотек пропущен пользователем.", 'info')
+        return []
+
+    # Парсим ввод пользователя
+    selected_indices = []
+    parts = user_input.split(',')
+    for part in parts:
+        try:
+            index = int(part.strip())
+            if 1 <= index <= len(extra_files):
+                selected_indices.append(index)
+            else:
+                cprint(f"  Номер {index} вне диапазона. Пропускаю.", 'warning')
+        except ValueError:
+            cprint(f"  Некорректный ввод '{part}'. Пропускаю.", 'warning')
+
+    if not selected_indices:
+        cprint("  Не выбрано ни одного корректного файла для переноса.", 'info')
+        return []
+    # -1, так как список для пользователя 1-based; sorted(set()) исключает дубликаты
+    return [extra_files[index - 1] for index in sorted(set(selected_indices))]
+
+def migrate_custom_libs(installed_root, source_base_dir):
     """
     Сравнивает библиотеки в старой и новой версии, и предлагает перенести недостающие.
+    :param installed_root: Папка с установленной версией (папка сервера или бэкап).
     """
-    cprint("\nШаг 3.5: Проверка на наличие кастомных библиотек...", 'step')
+    cprint("\nШаг 1.3: Проверка на наличие кастомных библиотек...", 'step')
 
-    # 1. Определяем пути к папкам /lib в старой (бэкап) и новой (распакованной) версиях
-    old_lib_path = os.path.join(backup_path, 'exploded', 'WEB-INF', 'lib')
+    # 1. Определяем пути к папкам /lib в старой (установленной) и новой (распакованной) версиях
+    old_lib_path = os.path.join(installed_root, 'exploded', 'WEB-INF', 'lib')
     new_lib_path = os.path.join(source_base_dir, 'exploded', 'WEB-INF', 'lib')
 
     # 2. Проверяем, существуют ли обе директории
@@ -824,38 +3446,14 @@ def migrate_custom_libs(backup_path, source_base_dir):
         return
 
     # 5. Если найдены различия, выводим их и запрашиваем действие у пользователя
-    cprint("  ВНИМАНИЕ: Найдены библиотеки, отсутствующие в новой версии:", 'warning')
-    for i, filename in enumerate(extra_files, 1):
-        print(f"    {i}. {filename}")
-    
-    user_input = prompt("\nВведите номера файлов для переноса (через запятую, например: 1,3) или нажмите Enter, чтобы пропустить: ")
-
-    if not user_input.strip():
-        cprint("  Перенос кастомных библиотек пропущен пользователем.", 'info')
-        return
-
-    # 6. Парсим ввод пользователя и переносим выбранные файлы
-    selected_indices = []
-    parts = user_input.split(',')
-    for part in parts:
-        try:
-            index = int(part.strip())
-            if 1 <= index <= len(extra_files):
-                selected_indices.append(index)
-            else:
-                cprint(f"  Номер {index} вне диапазона. Пропускаю.", 'warning')
-        except ValueError:
-            cprint(f"  Некорректный ввод '{part}'. Пропускаю.", 'warning')
-
-    if not selected_indices:
-        cprint("  Не выбрано ни одного корректного файла для переноса.", 'info')
+    selected_files = prompt_custom_libs(extra_files)
+    if not selected_files:
         return
 
+    # 6. Переносим выбранные файлы
     cprint("  Перенос выбранных библиотек...", 'step')
-    for index in set(selected_indices): # Используем set для исключения дубликатов
+    for filename_to_move in selected_files:
         try:
-            filename_to_move = extra_files[index - 1] # -1, так как список для пользователя 1-based
-            
             src_file = os.path.join(old_lib_path, filename_to_move)
             dest_file = os.path.join(new_lib_path, filename_to_move)
             
@@ -867,72 +3465,1178 @@ def migrate_custom_libs(backup_path, source_base_dir):
     
     cprint("  Перенос завершен.", 'success')
 
-def upload_backup(config, source_versions_root, local_backup_path, service_name, source_type, ftp_conn=None):
+# --- Архиватор бэкапа ---
+
+class BackupZipWriter:
     """
-    Архивирует, загружает бэкап с прогресс-баром и удаляет локальную копию.
+    Пишет ZIP в файловый объект без seek/tell: после данных каждого элемента идет дескриптор
+    данных с CRC32 и размерами. Поэтому данные можно сжимать заранее в других потоках и
+    дописывать по порядку. Большие архивы и элементы записываются в формате ZIP64.
     """
-    if not os.path.isdir(local_backup_path):
-        cprint(f"Ошибка: Директория бэкапа '{local_backup_path}' не найдена.", 'error')
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.offset = 0
+        self.entries = []
+        self.member = None
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.offset += len(data)
+
+    def begin_member(self, arcname, st, method, prefix=b''):
+        """Пишет локальный заголовок элемента; prefix - служебные байты перед данными (LZMA)."""
+        name = arcname.encode('utf-8')
+        flags = 0x08 # CRC и размеры - в дескрипторе после данных
+        if len(name) != len(arcname): flags |= 0x800 # имя в UTF-8
+        if method == zipfile.ZIP_LZMA: flags |= 0x02 # поток LZMA с маркером конца
+        # Сжатые данные несжимаемого файла немного больше исходных, поэтому берем запас
+        zip64 = st.st_size + st.st_size // 16 + 1024 > ZIP64_LIMIT
+        version = max(63 if method == zipfile.ZIP_LZMA else 20, 45 if zip64 else 0)
+        extra = struct.pack('<HHQQ', 1, 16, 0, 0) if zip64 else b''
+        size_field = 0xFFFFFFFF if zip64 else 0
+        dos_date, dos_time = zip_dos_datetime(st.st_mtime)
+        self.member = {'name': name, 'flags': flags, 'method': method, 'version': version, 'zip64': zip64,
+                       'date': dos_date, 'time': dos_time, 'mode': st.st_mode, 'offset': self.offset, 'compressed': 0}
+        self._write(struct.pack('<IHHHHHIIIHH', 0x04034b50, version, flags, method, dos_time, dos_date,
+                                0, size_field, size_field, len(name), len(extra)) + name + extra)
+        if prefix: self.write_data(prefix)
+
+    def write_data(self, data):
+        self._write(data)
+        self.member['compressed'] += len(data)
+
+    def end_member(self, crc, size):
+        member = self.member
+        member['crc'], member['size'] = crc, size
+        if member['zip64']:
+            descriptor = struct.pack('<IIQQ', 0x08074b50, crc, member['compressed'], size)
+        elif max(member['compressed'], size) > ZIP64_LIMIT:
+            raise IOError(f"Файл '{member['name'].decode('utf-8')}' вырос во время архивации больше 2 ГБ.")
+        else:
+            descriptor = struct.pack('<IIII', 0x08074b50, crc, member['compressed'], size)
+        self._write(descriptor)
+        self.entries.append(member)
+        self.member = None
+
+    def add_dir(self, arcname, st):
+        self.begin_member(arcname.rstrip('/') + '/', st, zipfile.ZIP_STORED)
+        self.end_member(0, 0)
+
+    def close(self):
+        """Пишет центральный каталог (и записи ZIP64, если они нужны)."""
+        create_system = 0 if os.name == 'nt' else 3
+        cd_offset = self.offset
+        for member in self.entries:
+            size, compressed, offset = member['size'], member['compressed'], member['offset']
+            zip64_fields = []
+            if size > ZIP64_LIMIT: zip64_fields.append(size); size = 0xFFFFFFFF
+            if compressed > ZIP64_LIMIT: zip64_fields.append(compressed); compressed = 0xFFFFFFFF
+            if offset > ZIP64_LIMIT: zip64_fields.append(offset); offset = 0xFFFFFFFF
+            extra = struct.pack('<HH' + 'Q' * len(zip64_fields), 1, 8 * len(zip64_fields), *zip64_fields) if zip64_fields else b''
+            version = max(member['version'], 45) if zip64_fields else member['version']
+            external_attr = (member['mode'] & 0xFFFF) << 16
+            if stat.S_ISDIR(member['mode']): external_attr |= 0x10
+            self._write(struct.pack('<IBBBBHHHHIIIHHHHHII', 0x02014b50, version, create_system, version, 0,
+                                    member['flags'], member['method'], member['time'], member['date'], member['crc'],
+                                    compressed, size, len(member['name']), len(extra), 0, 0, 0, external_attr, offset)
+                        + member['name'] + extra)
+        cd_size = self.offset - cd_offset
+        count = len(self.entries)
+        if count >= 0xFFFF or cd_size > ZIP64_LIMIT or cd_offset > ZIP64_LIMIT:
+            zip64_end_offset = self.offset
+            self._write(struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, count, count, cd_size, cd_offset))
+            self._write(struct.pack('<IIQI', 0x07064b50, 0, zip64_end_offset, 1))
+            count, cd_size, cd_offset = min(count, 0xFFFF), min(cd_size, 0xFFFFFFFF), min(cd_offset, 0xFFFFFFFF)
+        self._write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count, cd_size, cd_offset, 0))
+
+def zip_dos_datetime(mtime):
+    """Переводит время изменения файла в (дата, время) формата DOS для заголовков ZIP."""
+    t = time.localtime(mtime)
+    if t.tm_year < 1980: return (1 << 5) | 1, 0
+    return ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday, (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+
+def _deflate_chunk(data, level, last):
+    """
+    Сжимает часть файла независимым компрессором. Части, кроме последней, заканчиваются
+    Z_SYNC_FLUSH (граница байта без признака конца), поэтому их можно склеить в один поток.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+def _new_zip_lzma(level):
+    """
+    Возвращает (компрессор, заголовок) для метода LZMA в ZIP. Заголовок - версия LZMA SDK и 5 байт свойств
+    фильтра; свойства берутся из начала потока FORMAT_ALONE (.lzma), где они стоят в том же виде.
+    """
+    filters = [{'id': lzma.FILTER_LZMA1, 'preset': level}]
+    props = lzma.compress(b'', format=lzma.FORMAT_ALONE, filters=filters)[:5]
+    return lzma.LZMACompressor(lzma.FORMAT_RAW, filters=filters), struct.pack('<BBH', 9, 4, len(props)) + props
+
+def _lzma_member(data, level):
+    """Сжимает небольшой файл целиком (в потоке пула)."""
+    compressor, header = _new_zip_lzma(level)
+    return header + compressor.compress(data) + compressor.flush()
+
+def resolve_backup_format(settings):
+    """Проверяет [Backup] format; zstd без пакета zstandard заменяется на deflate."""
+    backup_format = settings['backup_format']
+    if backup_format not in BACKUP_FORMATS:
+        cprint(f"ПРЕДУПРЕЖДЕНИЕ: Неизвестный формат бэкапа '{backup_format}' ({', '.join(BACKUP_FORMATS)}). Использую deflate.", 'warning')
+        backup_format = 'deflate'
+    if backup_format == 'zstd' and zstandard is None:
+        cprint("ПРЕДУПРЕЖДЕНИЕ: Для формата zstd нужен пакет 'zstandard' (pip install zstandard). Использую deflate.", 'warning')
+        backup_format = 'deflate'
+    return backup_format
+
+def get_backup_archive_ext(backup_format):
+    return '.tar.zst' if backup_format == 'zstd' else '.zip'
+
+def iter_backup_files(local_backup_path):
+    """
+    Обходит папку бэкапа в стабильном порядке. Возвращает (путь, имя в архиве, stat) для папок
+    и файлов; имена начинаются с имени папки бэкапа, как у shutil.make_archive.
+    """
+    root_dir = os.path.dirname(os.path.abspath(local_backup_path))
+    for root, dirnames, filenames in os.walk(local_backup_path):
+        dirnames.sort()
+        yield root, os.path.relpath(root, root_dir).replace(os.sep, '/'), os.stat(root)
+        for filename in sorted(filenames):
+            path = os.path.join(root, filename)
+            if not os.path.isfile(path): continue
+            yield path, os.path.relpath(path, root_dir).replace(os.sep, '/'), os.stat(path)
+
+def write_backup_archive(fileobj, local_backup_path, settings):
+    """
+    Пишет архив папки бэкапа в файловый объект (файл или StreamPipe) в формате [Backup] format.
+    Возвращает статистику: files, bytes, stored_files, stored_bytes.
+    """
+    if settings['backup_format'] == 'zstd':
+        return _write_backup_tar_zst(fileobj, local_backup_path, settings)
+    return _write_backup_zip(fileobj, local_backup_path, settings)
+
+def _write_backup_zip(fileobj, local_backup_path, settings):
+    """
+    ZIP с параллельным сжатием. Файлы с расширениями из [Backup] store_extensions (.jar, .war,
+    .zip...) и пустые файлы сохраняются без сжатия. Остальные читаются частями по
+    BACKUP_CHUNK_SIZE; CRC32 считается при чтении, а части сжимаются в пуле потоков и
+    записываются строго по порядку. В очереди не больше 2 * workers частей, так что память
+    ограничена. deflate делит на части и большие файлы. В lzma поток не делится, поэтому
+    большие файлы сжимаются последовательно, а параллельно идут только файлы до одной части.
+    """
+    backup_format = settings['backup_format']
+    level = max(0, min(settings['backup_level'], 9))
+    workers = settings['compress_workers']
+    method = {'deflate': zipfile.ZIP_DEFLATED, 'lzma': zipfile.ZIP_LZMA}.get(backup_format, zipfile.ZIP_STORED)
+    writer = BackupZipWriter(fileobj)
+    stats = {'files': 0, 'bytes': 0, 'stored_files': 0, 'stored_bytes': 0}
+    pending = deque() # ('dir'|'begin'|'data'|'end', значение) в порядке записи
+
+    def drain(limit):
+        while len(pending) > limit:
+            kind, value = pending.popleft()
+            if kind == 'data': writer.write_data(value.result() if isinstance(value, Future) else value)
+            elif kind == 'begin': writer.begin_member(*value)
+            elif kind == 'end': writer.end_member(*value)
+            else: writer.add_dir(*value)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for path, arcname, st in iter_backup_files(local_backup_path):
+            if stat.S_ISDIR(st.st_mode):
+                pending.append(('dir', (arcname, st)))
+                continue
+            store = (method == zipfile.ZIP_STORED or st.st_size == 0
+                     or os.path.splitext(path)[1].lower() in settings['store_extensions'])
+            member_method = zipfile.ZIP_STORED if store else method
+            crc, size, lzma_compressor = 0, 0, None
+            with open(path, 'rb') as f:
+                data = f.read(BACKUP_CHUNK_SIZE)
+                if member_method == zipfile.ZIP_LZMA and len(data) == BACKUP_CHUNK_SIZE:
+                    lzma_compressor, header = _new_zip_lzma(level)
+                    pending.append(('begin', (arcname, st, member_method, header)))
+                else:
+                    pending.append(('begin', (arcname, st, member_method)))
+                while data:
+                    next_data = f.read(BACKUP_CHUNK_SIZE)
+                    crc = zlib.crc32(data, crc)
+                    size += len(data)
+                    if member_method == zipfile.ZIP_STORED:
+                        pending.append(('data', data))
+                    elif member_method == zipfile.ZIP_DEFLATED:
+                        pending.append(('data', pool.submit(_deflate_chunk, data, level, not next_data)))
+                    elif lzma_compressor is None:
+                        pending.append(('data', pool.submit(_lzma_member, data, level)))
+                    else:
+                        pending.append(('data', lzma_compressor.compress(data)))
+                        if not next_data: pending.append(('data', lzma_compressor.flush()))
+                    drain(2 * workers)
+                    data = next_data
+            pending.append(('end', (crc, size)))
+            stats['files'] += 1
+            stats['bytes'] += size
+            if store:
+                stats['stored_files'] += 1
+                stats['stored_bytes'] += size
+            drain(2 * workers)
+        drain(0)
+    writer.close()
+    return stats
+
+def _write_backup_tar_zst(fileobj, local_backup_path, settings):
+    """
+    tar-поток, сжатый zstd (пакет zstandard). zstd сжимает блоки в нескольких потоках
+    (threads = [Backup] workers) и сам сохраняет несжимаемые блоки как есть, поэтому
+    отдельной обработки .jar/.zip здесь нет.
+    """
+    workers = settings['compress_workers']
+    compressor = zstandard.ZstdCompressor(level=max(1, min(settings['backup_level'], 22)), threads=workers if workers > 1 else 0)
+    stats = {'files': 0, 'bytes': 0, 'stored_files': 0, 'stored_bytes': 0}
+    with compressor.stream_writer(fileobj, closefd=False) as zst_file:
+        with tarfile.open(fileobj=zst_file, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+            for path, arcname, st in iter_backup_files(local_backup_path):
+                tar.add(path, arcname=arcname, recursive=False)
+                if not stat.S_ISDIR(st.st_mode):
+                    stats['files'] += 1
+                    stats['bytes'] += st.st_size
+    return stats
+
+def report_backup_archive(stats, archive_bytes, backup_format, level):
+    """Выводит степень сжатия архива бэкапа."""
+    ratio = archive_bytes / stats['bytes'] * 100 if stats['bytes'] else 100
+    cprint(f"  Архив ({backup_format}, уровень {level}): {stats['files']} файлов, {stats['bytes'] / (1024 * 1024):.1f} MB -> "
+           f"{archive_bytes / (1024 * 1024):.1f} MB ({ratio:.0f}%).", 'info')
+    if stats['stored_files']:
+        cprint(f"  Без сжатия сохранено {stats['stored_files']} уже сжатых файлов ({stats['stored_bytes'] / (1024 * 1024):.1f} MB).", 'info')
+
+# --- Потоковая загрузка бэкапа (без временного архива) ---
+
+class StreamPipe:
+    """
+    Ограниченный канал между потоком, который пишет архив, и потоком, который отправляет его
+    на FTP/SMB. Запись копит данные в блоки по block_size байт и кладет их в очередь емкостью
+    max_blocks, поэтому в памяти одновременно не больше (max_blocks + 2) блоков. Со стороны
+    чтения ведет себя как файл (read), чтобы его можно было передать в storbinary.
+    """
+    def __init__(self, block_size=DEFAULT_BLOCK_SIZE, max_blocks=8):
+        self.block_size = block_size
+        self.blocks = queue.Queue(maxsize=max(1, max_blocks))
+        self.buffer = bytearray()
+        self.current = memoryview(b'')
+        self.error = None
+        self.reader_closed = threading.Event()
+        self.finished = False
+
+    # --- сторона записи (поток архиватора) ---
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._put(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close_writer(self, error=None):
+        """Завершает запись; error передается читающей стороне и прерывает отправку."""
+        if self.reader_closed.is_set(): return
+        if error is None and self.buffer:
+            self._put(bytes(self.buffer))
+        self.buffer = bytearray()
+        self.error = error
+        self._put(None)
+
+    def _put(self, block):
+        while True:
+            if self.reader_closed.is_set():
+                raise BrokenPipeError("Отправка архива прервана.")
+            try:
+                self.blocks.put(block, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    # --- сторона чтения (поток отправки) ---
+    def read(self, size=-1):
+        while not len(self.current):
+            if self.finished: return b''
+            block = self.blocks.get()
+            if block is None:
+                self.finished = True
+                if self.error is not None:
+                    raise IOError(f"Ошибка при создании архива: {self.error}")
+                return b''
+            self.current = memoryview(block)
+        if size is None or size < 0: size = len(self.current)
+        chunk, self.current = self.current[:size], self.current[size:]
+        return bytes(chunk)
+
+    def close_reader(self):
+        """Сообщает архиватору, что данные больше не нужны (ошибка отправки)."""
+        self.reader_closed.set()
+
+def _start_backup_stream(local_backup_path, settings):
+    """
+    Запускает поток архиватора, пишущий в новый StreamPipe. Возвращает (pipe, поток);
+    после завершения архивации статистика архива лежит в pipe.stats.
+    """
+    pipe = StreamPipe(settings['block_size'], settings['stream_blocks'])
+    pipe.stats = None
+
+    def producer():
+        try:
+            pipe.stats = write_backup_archive(pipe, local_backup_path, settings)
+            pipe.close_writer()
+        except BrokenPipeError:
+            pass # отправка прервана, читать архив уже некому
+        except Exception as e:
+            try: pipe.close_writer(error=e)
+            except BrokenPipeError: pass
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    return pipe, thread
+
+def stream_backup_upload(local_backup_path, send_func, archive_name, settings, reset_func=None):
+    """
+    Упаковывает папку бэкапа на лету и передает архив в send_func(pipe, progress) без
+    временного файла. При ошибке передачи архив формируется заново и отправляется с начала
+    (до [Transfer] retries раз); перед повтором вызывается reset_func.
+    Возвращает (число отправленных байт, статистика архива).
+    """
+    attempt = 0
+    while True:
+        pipe, producer = _start_backup_stream(local_backup_path, settings)
+        try:
+            with tqdm(unit='B', unit_scale=True, unit_divisor=1024, desc=archive_name, ascii=True) as progress:
+                sent = send_func(pipe, progress)
+            producer.join()
+            return sent, pipe.stats
+        except (OSError, EOFError, *ftplib.all_errors) as e:
+            pipe.close_reader()
+            producer.join()
+            if pipe.error is not None:
+                raise IOError(f"Ошибка при создании архива: {pipe.error}")
+            attempt += 1
+            if attempt > settings['retries']:
+                raise
+            delay = _retry_delay(attempt, settings['retry_delay'])
+            cprint(f"\n  Обрыв загрузки '{archive_name}': {e}. Архив будет отправлен заново через {delay} с ({attempt}/{settings['retries']})...", 'warning')
+            time.sleep(delay)
+            if reset_func: reset_func()
+        finally:
+            pipe.close_reader()
+            producer.join()
+
+def upload_backup_stream_smb(local_backup_path, destination_file_path, settings):
+    """Потоково пишет архив бэкапа в файл на SMB."""
+    archive_name = os.path.basename(destination_file_path)
+
+    def send(pipe, progress):
+        sent = 0
+        with open(destination_file_path, 'wb', buffering=0) as dest:
+            while True:
+                chunk = pipe.read(settings['block_size'])
+                if not chunk: break
+                view = memoryview(chunk)
+                while view:
+                    view = view[dest.write(view):]
+                sent += len(chunk)
+                progress.update(len(chunk))
+        return sent
+
+    try:
+        return stream_backup_upload(local_backup_path, send, archive_name, settings)
+    except Exception:
+        # Недописанный архив бесполезен: продолжить его нельзя
+        if os.path.exists(destination_file_path):
+            try: os.remove(destination_file_path)
+            except OSError: pass
+        raise
+
+def upload_backup_stream_ftp(ftp_conn, ftp_url, remote_dir, local_backup_path, archive_name, settings):
+    """Потоково передает архив бэкапа в соединение данных FTP (STOR)."""
+    def send(pipe, progress):
+        sent = [0]
+        ftp_conn.cwd(remote_dir)
+        ftp_conn.voidcmd('TYPE I')
+
+        def progress_callback(chunk):
+            sent[0] += len(chunk)
+            progress.update(len(chunk))
+
+        ftp_conn.storbinary(f'STOR {archive_name}', pipe, blocksize=settings['ftp_blocksize'], callback=progress_callback)
+        try: remote_size = ftp_conn.size(archive_name)
+        except ftplib.all_errors: remote_size = None
+        if remote_size is not None and remote_size != sent[0]:
+            raise EOFError(f"На FTP загружено {remote_size} байт из {sent[0]}.")
+        return sent[0]
+
+    def reset():
+        reconnect_ftp(ftp_conn, ftp_url)
+
+    try:
+        return stream_backup_upload(local_backup_path, send, archive_name, settings, reset_func=reset)
+    except Exception:
+        try: ftp_conn.delete(f"{remote_dir.rstrip('/')}/{archive_name}")
+        except ftplib.all_errors: pass
+        raise
+
+# --- Репозиторий бэкапов с дедупликацией ---
+
+class SmbBackupRepository:
+    """Репозиторий бэкапов (или папка для томов архива) на SMB или на локальном диске."""
+    def __init__(self, root, retries=0, retry_delay=1, block_size=DEFAULT_BLOCK_SIZE):
+        self.root = root
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.block_size = block_size
+
+    def clone(self):
+        """Экземпляр для другого потока (у SMB общего состояния нет)."""
+        return self
+
+    def close(self):
+        pass
+
+    def _path(self, rel_path):
+        return os.path.join(self.root, *rel_path.split('/'))
+
+    def read(self, rel_path):
+        with open(self._path(rel_path), 'rb') as f:
+            return f.read()
+
+    def write(self, rel_path, data, atomic=False):
+        path = self._path(rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + '.tmp' if atomic else path
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        if atomic: os.replace(temp_path, path)
+
+    def list(self, rel_dir):
+        path = self._path(rel_dir)
+        return sorted(os.listdir(path)) if os.path.isdir(path) else []
+
+    def upload_file(self, rel_path, local_path, progress=None):
+        path = self._path(rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        copy_file_resumable(local_path, path, rel_path, retries=self.retries, retry_delay=self.retry_delay,
+                            block_size=self.block_size, progress=progress)
+
+    def verify_upload(self, rel_path, size, sha256):
+        """Перечитывает загруженный файл и сверяет размер и SHA-256."""
+        path = self._path(rel_path)
+        return os.path.getsize(path) == size and hash_file_sha256(path) == sha256
+
+    def read_into(self, rel_path, sink):
+        """Пишет содержимое файла в sink.write, начиная с sink.written байт."""
+        with open(self._path(rel_path), 'rb') as f:
+            f.seek(sink.written)
+            shutil.copyfileobj(f, sink, self.block_size)
+
+class FtpBackupRepository:
+    """
+    Репозиторий бэкапов на FTP. Пути абсолютные, поэтому текущая папка соединения не важна.
+    При обрыве связи операция повторяется с переподключением (см. [Transfer] retries).
+    """
+    def __init__(self, ftp_conn, ftp_url, root, retries=5, retry_delay=2):
+        self.ftp_conn = ftp_conn
+        self.ftp_url = ftp_url
+        self.root = '/' + root.replace('\\', '/').strip('/')
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.known_dirs = set()
+        self.hash_command = None # HASH, XSHA256 или '' (сервер не считает SHA-256); определяется по FEAT
+
+    def clone(self):
+        """Экземпляр с отдельным FTP-соединением - для параллельной передачи."""
+        ftp_conn, _ = connect_ftp(self.ftp_url, quiet=True, timeout=FTP_TIMEOUT)
+        if not ftp_conn: raise ConnectionError("Не удалось открыть дополнительное FTP-соединение.")
+        return FtpBackupRepository(ftp_conn, self.ftp_url, self.root, self.retries, self.retry_delay)
+
+    def close(self):
+        try: self.ftp_conn.quit()
+        except: pass
+
+    def _path(self, rel_path):
+        return f"{self.root.rstrip('/')}/{rel_path}"
+
+    def _call(self, func, no_retry=(ftplib.error_perm,)):
+        attempt = 0
+        while True:
+            try:
+                return func()
+            except no_retry:
+                raise
+            except (OSError, EOFError, *ftplib.all_errors) as e:
+                attempt += 1
+                if attempt > self.retries: raise
+                delay = _retry_delay(attempt, self.retry_delay)
+                cprint(f"\n  Обрыв связи с FTP: {e}. Повтор через {delay} с ({attempt}/{self.retries})...", 'warning')
+                time.sleep(delay)
+                reconnect_ftp(self.ftp_conn, self.ftp_url)
+
+    def _makedirs(self, rel_dir):
+        if rel_dir in self.known_dirs: return
+        path = ''
+        for part in self._path(rel_dir).strip('/').split('/'):
+            path += '/' + part
+            try: self.ftp_conn.mkd(path)
+            except ftplib.error_perm: pass # папка уже есть
+        self.known_dirs.add(rel_dir)
+
+    def read(self, rel_path):
+        def retrieve():
+            buffer = io.BytesIO()
+            self.ftp_conn.retrbinary(f'RETR {self._path(rel_path)}', buffer.write)
+            return buffer.getvalue()
+        try:
+            return self._call(retrieve)
+        except ftplib.error_perm as e:
+            raise FileNotFoundError(f"На FTP нет файла '{self._path(rel_path)}': {e}")
+
+    def write(self, rel_path, data, atomic=False):
+        rel_dir = rel_path.rsplit('/', 1)[0] if '/' in rel_path else ''
+        path = self._path(rel_path)
+
+        def store():
+            self._makedirs(rel_dir)
+            if not atomic:
+                self.ftp_conn.storbinary(f'STOR {path}', io.BytesIO(data))
+                return
+            self.ftp_conn.storbinary(f'STOR {path}.tmp', io.BytesIO(data))
+            try:
+                self.ftp_conn.rename(f'{path}.tmp', path)
+            except ftplib.error_perm:
+                # Часть серверов не перезаписывает существующий файл при RNTO
+                self.ftp_conn.delete(path)
+                self.ftp_conn.rename(f'{path}.tmp', path)
+        self._call(store)
+
+    def list(self, rel_dir):
+        try:
+            names = self._call(lambda: self.ftp_conn.nlst(self._path(rel_dir)), no_retry=(ftplib.error_perm, ftplib.error_temp))
+        except (ftplib.error_perm, ftplib.error_temp):
+            return [] # папки нет (или она пуста - часть серверов отвечает на это 450)
+        return sorted(name.replace('\\', '/').rsplit('/', 1)[-1] for name in names)
+
+    def upload_file(self, rel_path, local_path, progress=None):
+        rel_dir, _, name = rel_path.rpartition('/')
+        self._call(lambda: self._makedirs(rel_dir))
+        ftp_upload_resumable(self.ftp_conn, self.ftp_url, self._path(rel_dir).rstrip('/') or '/', local_path, name,
+                             retries=self.retries, retry_delay=self.retry_delay, progress=progress)
+
+    def _server_hash_command(self):
+        """Команда, которой сервер сам считает SHA-256 файла (по ответу FEAT), или None."""
+        if self.hash_command is None:
+            self.hash_command = ''
+            try:
+                features = self.ftp_conn.sendcmd('FEAT').upper()
+            except ftplib.all_errors:
+                features = ''
+            if re.search(r'^\s*HASH\b.*SHA-256', features, re.MULTILINE):
+                try:
+                    self.ftp_conn.sendcmd('OPTS HASH SHA-256')
+                    self.hash_command = 'HASH'
+                except ftplib.all_errors:
+                    pass
+            if not self.hash_command and re.search(r'^\s*XSHA256\b', features, re.MULTILINE):
+                self.hash_command = 'XSHA256'
+        return self.hash_command or None
+
+    def _read_back_sha256(self, path):
+        """(размер, SHA-256) файла на сервере, прочитанного обратно. После обрыва чтение начинается заново."""
+        def retrieve():
+            digest, size = hashlib.sha256(), [0]
+            def consume(data):
+                digest.update(data)
+                size[0] += len(data)
+            self.ftp_conn.retrbinary(f'RETR {path}', consume)
+            return size[0], digest.hexdigest()
+        return self._call(retrieve)
+
+    def verify_upload(self, rel_path, size, sha256):
+        """
+        Сверяет загруженный файл с локальным по размеру (SIZE) и SHA-256. Хэш считает сам сервер, если
+        объявляет HASH или XSHA256 в FEAT; иначе файл читается обратно. False при расхождении.
+        """
+        path = self._path(rel_path)
+        try:
+            remote_size = self._call(lambda: self.ftp_conn.size(path))
+        except ftplib.error_perm:
+            remote_size = None # SIZE не поддерживается
+        if remote_size is not None and remote_size != size: return False
+
+        command = self._server_hash_command()
+        if command:
+            try:
+                # HASH: '213 SHA-256 0-1023 <хэш> <файл>', XSHA256: '250 <хэш>'. После переподключения
+                # HASH может вернуть хэш другого алгоритма - тогда 64 шестнадцатеричных символов нет
+                match = re.search(r'\b[0-9a-fA-F]{64}\b', self._call(lambda: self.ftp_conn.sendcmd(f'{command} {path}')))
+                if match: return match.group(0).lower() == sha256.lower()
+            except ftplib.error_perm:
+                pass
+        remote_size, remote_sha256 = self._read_back_sha256(path)
+        return remote_size == size and remote_sha256 == sha256
+
+    def read_into(self, rel_path, sink):
+        """Пишет содержимое файла в sink.write; после обрыва продолжает с sink.written (REST)."""
+        path = self._path(rel_path)
+        try:
+            self._call(lambda: self.ftp_conn.retrbinary(f'RETR {path}', sink.write, rest=sink.written or None))
+        except ftplib.error_perm as e:
+            raise FileNotFoundError(f"На FTP нет файла '{path}': {e}")
+
+def get_backup_destination_dir(source_versions_root):
+    """Папка для бэкапов на источнике обновлений: '<на два уровня выше корня версий>/temp/update_backups'."""
+    parent_of_root = os.path.dirname(source_versions_root)
+    grandparent_of_root = os.path.dirname(parent_of_root)
+    return os.path.join(grandparent_of_root, 'temp', 'update_backups')
+
+def open_backup_repository(source_type, destination_dir, settings, ftp_conn=None, ftp_url=None, subdir=BACKUP_REPO_DIR):
+    """Открывает репозиторий '<destination_dir>/repository' (или другую подпапку) на SMB или FTP."""
+    root = os.path.join(destination_dir, subdir) if subdir else destination_dir
+    if source_type == 'smb':
+        return SmbBackupRepository(root, settings['retries'], settings['retry_delay'], settings['block_size'])
+    if not ftp_conn: raise ConnectionError("FTP соединение не установлено.")
+    return FtpBackupRepository(ftp_conn, ftp_url, root, settings['retries'], settings['retry_delay'])
+
+def read_repository_index(repository):
+    """Возвращает множество хэшей частей, уже сохраненных в репозитории (из chunks.idx)."""
+    try:
+        data = repository.read(BACKUP_REPO_INDEX)
+    except (FileNotFoundError, OSError):
+        return set()
+    return {line.strip() for line in data.decode('ascii', 'ignore').splitlines() if len(line.strip()) == 64}
+
+def _pack_chunk(data, level, compress):
+    """Сжимает часть для хранения в репозитории: 'Z' + zlib или 'S' + исходные байты."""
+    if compress:
+        packed = zlib.compress(data, level)
+        if len(packed) < len(data): return b'Z' + packed
+    return b'S' + data
+
+def _unpack_chunk(blob):
+    if blob[:1] == b'Z': return zlib.decompress(blob[1:])
+    if blob[:1] == b'S': return blob[1:]
+    raise ValueError("Неизвестный формат части в репозитории.")
+
+def _chunk_path(digest):
+    return f"chunks/{digest[:2]}/{digest}"
+
+def upload_backup_dedup(repository, local_backup_path, snapshot_name, settings):
+    """
+    Сохраняет папку бэкапа в репозиторий с дедупликацией. Файлы делятся на части по
+    [Backup] chunk_size_kb, ключ части - SHA-256 ее содержимого. Загружаются только части,
+    которых еще нет в chunks.idx (и которые не встречались раньше в этом же бэкапе), затем
+    пишется снимок snapshots/<имя>.json со списком файлов и их частей, и в конце - индекс.
+    Если два сервера одновременно дописывают индекс, часть записей может потеряться; это
+    приводит только к повторной загрузке таких частей в следующий раз.
+    Возвращает статистику загрузки.
+    """
+    chunk_size = settings['chunk_size']
+    level = max(0, min(settings['backup_level'], 9))
+    known = read_repository_index(repository)
+    new_chunks = set()
+    stats = {'files': 0, 'bytes': 0, 'chunks': 0, 'new_chunks': 0, 'new_bytes': 0, 'uploaded_bytes': 0}
+    snapshot = {'format': BACKUP_REPO_FORMAT, 'name': snapshot_name, 'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'chunk_size': chunk_size, 'dirs': [], 'files': []}
+    pending = deque() # (хэш, размер, future сжатой части)
+
+    def drain(limit):
+        while len(pending) > limit:
+            digest, size, future = pending.popleft()
+            blob = future.result()
+            repository.write(_chunk_path(digest), blob)
+            stats['new_chunks'] += 1
+            stats['new_bytes'] += size
+            stats['uploaded_bytes'] += len(blob)
+            progress.update(size)
+
+    total_bytes = sum(st.st_size for _, _, st in iter_backup_files(local_backup_path) if not stat.S_ISDIR(st.st_mode))
+    with ThreadPoolExecutor(max_workers=settings['compress_workers']) as pool, \
+         tqdm(total=total_bytes, unit='B', unit_scale=True, unit_divisor=1024, desc=snapshot_name, ascii=True) as progress:
+        for path, arcname, st in iter_backup_files(local_backup_path):
+            rel_path = arcname.split('/', 1)[1] if '/' in arcname else ''
+            if stat.S_ISDIR(st.st_mode):
+                if rel_path: snapshot['dirs'].append({'path': rel_path, 'mtime': st.st_mtime})
+                continue
+            compress = os.path.splitext(path)[1].lower() not in settings['store_extensions']
+            chunks = []
+            size = 0
+            with open(path, 'rb') as f:
+                while True:
+                    data = f.read(chunk_size)
+                    if not data: break
+                    digest = hashlib.sha256(data).hexdigest()
+                    chunks.append(digest)
+                    size += len(data)
+                    if digest in known or digest in new_chunks:
+                        progress.update(len(data))
+                        continue
+                    new_chunks.add(digest)
+                    pending.append((digest, len(data), pool.submit(_pack_chunk, data, level, compress)))
+                    drain(2 * settings['compress_workers'])
+            snapshot['files'].append({'path': rel_path, 'size': size, 'mtime': st.st_mtime, 'chunks': chunks})
+            stats['files'] += 1
+            stats['bytes'] += size
+            stats['chunks'] += len(chunks)
+        drain(0)
+
+    snapshot['stats'] = stats
+    repository.write(f"snapshots/{snapshot_name}.json", json.dumps(snapshot, ensure_ascii=False).encode('utf-8'), atomic=True)
+    if new_chunks:
+        # Индекс пишется последним: части, на которые он ссылается, уже загружены
+        known = read_repository_index(repository) | new_chunks
+        repository.write(BACKUP_REPO_INDEX, ''.join(f"{digest}\n" for digest in sorted(known)).encode('ascii'), atomic=True)
+    return stats
+
+def report_dedup_upload(stats, seconds):
+    """Выводит коэффициент дедупликации и сэкономленный объем."""
+    ratio = stats['bytes'] / stats['new_bytes'] if stats['new_bytes'] else float('inf')
+    saved = stats['bytes'] - stats['uploaded_bytes']
+    ratio_text = f"{ratio:.1f}x" if stats['new_bytes'] else "все части уже были в репозитории"
+    cprint(f"  Файлов: {stats['files']}, объем {format_size(stats['bytes'])}, частей {stats['chunks']} (новых {stats['new_chunks']}).", 'info')
+    cprint(f"  Загружено {format_size(stats['uploaded_bytes'])} за {seconds:.1f} с. Дедупликация: {ratio_text}, "
+           f"сэкономлено {format_size(max(saved, 0))} ({max(saved, 0) / stats['bytes'] * 100 if stats['bytes'] else 0:.0f}%).", 'info')
+
+def list_repository_snapshots(repository):
+    """Имена снимков в репозитории (без .json), от старых к новым."""
+    return [name[:-5] for name in repository.list('snapshots') if name.endswith('.json')]
+
+def restore_backup_snapshot(repository, snapshot_name, target_dir):
+    """
+    Собирает снимок из репозитория в папку target_dir: части каждого файла читаются по порядку,
+    SHA-256 каждой части сверяется с ее именем, затем проверяется размер файла и
+    восстанавливается время изменения. Возвращает статистику (files, bytes).
+    """
+    snapshot = json.loads(repository.read(f"snapshots/{snapshot_name}.json").decode('utf-8'))
+    if snapshot.get('format') != BACKUP_REPO_FORMAT:
+        raise ValueError(f"Неподдерживаемый формат снимка '{snapshot_name}'.")
+    total_bytes = sum(entry['size'] for entry in snapshot['files'])
+    os.makedirs(target_dir, exist_ok=True)
+    with tqdm(total=total_bytes, unit='B', unit_scale=True, unit_divisor=1024, desc=snapshot_name, ascii=True) as progress:
+        for entry in snapshot['files']:
+            path = os.path.join(target_dir, *entry['path'].split('/'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                for digest in entry['chunks']:
+                    data = _unpack_chunk(repository.read(_chunk_path(digest)))
+                    if hashlib.sha256(data).hexdigest() != digest:
+                        raise IOError(f"Часть {digest} файла '{entry['path']}' повреждена.")
+                    f.write(data)
+                    progress.update(len(data))
+            if os.path.getsize(path) != entry['size']:
+                raise IOError(f"Размер восстановленного файла '{entry['path']}' не совпадает со снимком.")
+            os.utime(path, (entry['mtime'], entry['mtime']))
+        for entry in sorted(snapshot['dirs'], key=lambda d: d['path'].count('/'), reverse=True):
+            path = os.path.join(target_dir, *entry['path'].split('/'))
+            os.makedirs(path, exist_ok=True)
+            os.utime(path, (entry['mtime'], entry['mtime']))
+    return {'files': len(snapshot['files']), 'bytes': total_bytes}
+
+def run_restore_backup_command(config, snapshot_name=None, source=None, target_dir=None):
+    """
+    Подкоманда 'restore-backup': собирает выбранный снимок из репозитория бэкапов или
+    многотомный архив на SMB/FTP в локальную папку. Из нее затем можно выполнить
+    'rollback --backup <папка>'.
+    """
+    smb_path = config['SMB'].get('path', '').strip()
+    ftp_url = config['FTP'].get('url', '').strip()
+    source = source or ('smb' if smb_path else 'ftp')
+    settings = get_transfer_settings(config)
+    ftp_conn = None
+    try:
+        if source == 'smb':
+            if not smb_path:
+                cprint("SMB Path не указан в config.ini.", 'error')
+                return False
+            versions_root = smb_path
+        else:
+            ftp_conn, versions_root = connect_ftp(ftp_url, timeout=FTP_TIMEOUT)
+            if not ftp_conn: return False
+        destination_dir = get_backup_destination_dir(versions_root)
+        repository = open_backup_repository(source, destination_dir, settings, ftp_conn, ftp_url)
+        volumes_repository = open_backup_repository(source, destination_dir, settings, ftp_conn, ftp_url, subdir='')
+        volume_archives = list_volume_archives(volumes_repository)
+
+        if not snapshot_name:
+            snapshots = list_repository_snapshots(repository) + volume_archives
+            if not snapshots:
+                cprint(f"В папке бэкапов на {source.upper()} нет снимков и многотомных архивов.", 'warning')
+                return False
+            cprint("\nСнимки и многотомные архивы бэкапов:", 'step')
+            for i, name in enumerate(snapshots, 1):
+                cprint(f"{i}. {name}{' (тома)' if name in volume_archives else ''}", 'info')
+            choice = prompt(f"Выберите номер (1-{len(snapshots)}) или Enter для отмены: ").strip()
+            if not choice.isdigit() or not 1 <= int(choice) <= len(snapshots):
+                cprint("Восстановление отменено.", 'warning')
+                return False
+            snapshot_name = snapshots[int(choice) - 1]
+
+        started = time.monotonic()
+        if snapshot_name in volume_archives:
+            # Архив содержит папку бэкапа, поэтому распаковывается прямо в backup_dir
+            target_dir = target_dir or config['General']['backup_dir']
+            os.makedirs(target_dir, exist_ok=True)
+            archive_path = os.path.join(config['General']['download_dir'], snapshot_name)
+            os.makedirs(config['General']['download_dir'], exist_ok=True)
+            cprint(f"Сборка многотомного архива '{snapshot_name}'...", 'step')
+            manifest = restore_volume_archive(volumes_repository, snapshot_name, archive_path, settings['upload_workers'])
+            cprint(f"Архив собран из {len(manifest['volumes'])} томов, SHA-256 совпадает. Распаковка в '{target_dir}'...", 'step')
+            extract_backup_archive(archive_path, target_dir, settings)
+            os.remove(archive_path)
+            cprint(f"Архив восстановлен за {time.monotonic() - started:.1f} с.", 'success')
+            return True
+
+        target_dir = target_dir or os.path.join(config['General']['backup_dir'], snapshot_name)
+        if os.path.isdir(target_dir) and os.listdir(target_dir):
+            cprint(f"Папка '{target_dir}' уже существует и не пуста. Укажите другую через --target.", 'error')
+            return False
+        cprint(f"Восстановление снимка '{snapshot_name}' в '{target_dir}'...", 'step')
+        result = restore_backup_snapshot(repository, snapshot_name, target_dir)
+        cprint(f"Снимок восстановлен: {result['files']} файлов, {format_size(result['bytes'])} за {time.monotonic() - started:.1f} с.", 'success')
+        if read_backup_info(target_dir):
+            cprint(f"Для отката сервера к этой версии: rollback --backup \"{target_dir}\"", 'info')
+        return True
+    except Exception as e:
+        cprint(f"Ошибка при восстановлении снимка: {e}", 'error')
         return False
+    finally:
+        if ftp_conn:
+            try: ftp_conn.quit()
+            except: pass
 
-    cprint(f"\n--- Загрузка бэкапа на {source_type.upper()} ---", 'header')
+# --- Многотомные архивы бэкапа ---
 
-    timestamp = time.strftime('%Y%m%d_%H%M%S')
-    archive_base_name = f"{service_name}_backup_{timestamp}"
-    temp_archive_path = os.path.join(config['General']['download_dir'], archive_base_name)
-    
-    cprint(f"Создание ZIP-архива '{archive_base_name}.zip'...", 'step')
+class VolumeWriter:
+    """
+    Файловый объект для архиватора: режет поток архива на тома по volume_size байт
+    ('<архив>.001', '.002', ...) во временной папке и считает SHA-256 каждого тома и всего
+    архива. Готовый том передается в on_volume(номер, путь, размер, sha256). Перед началом
+    нового тома вызывается acquire() - так ограничивается число томов на диске.
+    """
+    def __init__(self, staging_dir, archive_name, volume_size, on_volume, acquire):
+        self.staging_dir = staging_dir
+        self.archive_name = archive_name
+        self.volume_size = volume_size
+        self.on_volume = on_volume
+        self.acquire = acquire
+        self.total_hash = hashlib.sha256()
+        self.total_size = 0
+        self.index = 0
+        self.file = None
+
+    def _open_volume(self):
+        self.acquire()
+        self.index += 1
+        self.path = os.path.join(self.staging_dir, f"{self.archive_name}.{self.index:03d}")
+        self.file = open(self.path, 'wb')
+        self.volume_hash = hashlib.sha256()
+        self.volume_written = 0
+
+    def _finish_volume(self):
+        self.file.close()
+        self.file = None
+        self.on_volume(self.index, self.path, self.volume_written, self.volume_hash.hexdigest())
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            if self.file is None: self._open_volume()
+            part = view[:self.volume_size - self.volume_written]
+            self.file.write(part)
+            self.volume_hash.update(part)
+            self.total_hash.update(part)
+            self.volume_written += len(part)
+            self.total_size += len(part)
+            view = view[len(part):]
+            if self.volume_written == self.volume_size: self._finish_volume()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.file is not None: self._finish_volume()
+
+    def abort(self):
+        """Закрывает и удаляет недописанный том (при ошибке архивации)."""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            try: os.remove(self.path)
+            except OSError: pass
+
+class HashingWriter:
+    """Пишет данные в открытый файл, считая SHA-256 и число записанных байт."""
+    def __init__(self, fileobj, progress=None):
+        self.fileobj = fileobj
+        self.progress = progress
+        self.hash = hashlib.sha256()
+        self.written = 0
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.hash.update(data)
+        self.written += len(data)
+        if self.progress: self.progress.update(len(data))
+        return len(data)
+
+def _per_thread_repositories(repository):
+    """Возвращает (get, close_all): у каждого потока пула свой экземпляр репозитория (свое FTP-соединение)."""
+    local = threading.local()
+    clones = []
+    clones_lock = threading.Lock()
+
+    def get():
+        if not hasattr(local, 'repository'):
+            local.repository = repository.clone()
+            with clones_lock: clones.append(local.repository)
+        return local.repository
+
+    def close_all():
+        for clone in clones:
+            if clone is not repository: clone.close()
+    return get, close_all
+
+def upload_backup_volumes(repository, local_backup_path, archive_name, settings, staging_dir):
+    """
+    Упаковывает бэкап в архив, разрезанный на тома по [Backup] volume_size_mb, и загружает
+    тома параллельно: upload_workers потоков, у каждого на FTP свое соединение. Том удаляется
+    с диска сразу после загрузки, поэтому одновременно на диске не больше upload_workers + 1
+    томов. Загруженный том сверяется по SHA-256: на SMB он перечитывается, на FTP хэш считает сервер
+    (HASH/XSHA256) или том читается обратно. Последним пишется '<архив>.volumes.json' с
+    размерами и SHA-256 томов и всего архива. Возвращает (манифест, статистика архива).
+    """
+    workers = settings['upload_workers']
+    slots = threading.Semaphore(workers + 1)
+    get_repository, close_repositories = _per_thread_repositories(repository)
+    volumes = {}
+    futures = []
+
+    def upload_volume(index, path, size, sha256):
+        try:
+            name = os.path.basename(path)
+            volume_repository = get_repository()
+            volume_repository.upload_file(name, path, progress)
+            if not volume_repository.verify_upload(name, size, sha256):
+                raise IOError(f"Том '{name}' на сервере не совпадает с загруженным (SHA-256).")
+            volumes[index] = {'name': name, 'size': size, 'sha256': sha256}
+        finally:
+            if os.path.exists(path): os.remove(path)
+            slots.release()
+
+    def on_volume(index, path, size, sha256):
+        for future in futures:
+            if future.done() and future.exception():
+                # Какой-то том не загрузился - дальше архивировать бессмысленно
+                os.remove(path)
+                slots.release()
+                raise future.exception()
+        futures.append(executor.submit(upload_volume, index, path, size, sha256))
+
+    writer = VolumeWriter(staging_dir, archive_name, settings['volume_size'], on_volume, slots.acquire)
     try:
-        final_archive_path = shutil.make_archive(
-            base_name=temp_archive_path, format='zip',
-            root_dir=os.path.dirname(local_backup_path), base_dir=os.path.basename(local_backup_path)
-        )
-        cprint(f"Архив успешно создан: '{final_archive_path}'", 'success')
+        with ThreadPoolExecutor(max_workers=workers) as executor, \
+             tqdm(unit='B', unit_scale=True, unit_divisor=1024, desc=archive_name, ascii=True) as bar:
+            progress = LockedProgress(bar)
+            try:
+                stats = write_backup_archive(writer, local_backup_path, settings)
+                writer.close()
+            except Exception:
+                writer.abort()
+                raise
+            for future in futures: future.result()
+    finally:
+        close_repositories()
+
+    manifest = {'format': VOLUME_MANIFEST_FORMAT, 'archive': archive_name, 'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'volume_size': settings['volume_size'], 'size': writer.total_size, 'sha256': writer.total_hash.hexdigest(),
+                'volumes': [volumes[index] for index in sorted(volumes)]}
+    repository.write(archive_name + VOLUME_MANIFEST_SUFFIX, json.dumps(manifest, ensure_ascii=False, indent=1).encode('utf-8'), atomic=True)
+    return manifest, stats
+
+def list_volume_archives(repository):
+    """Имена многотомных архивов (по файлам '<архив>.volumes.json')."""
+    return [name[:-len(VOLUME_MANIFEST_SUFFIX)] for name in repository.list('') if name.endswith(VOLUME_MANIFEST_SUFFIX)]
+
+def restore_volume_archive(repository, archive_name, target_path, workers=4):
+    """
+    Собирает многотомный архив в файл target_path: тома скачиваются параллельно и пишутся
+    каждый со своего смещения, SHA-256 каждого тома сверяется с манифестом, затем - SHA-256
+    собранного архива. Возвращает манифест.
+    """
+    manifest = json.loads(repository.read(archive_name + VOLUME_MANIFEST_SUFFIX).decode('utf-8'))
+    if manifest.get('format') != VOLUME_MANIFEST_FORMAT:
+        raise ValueError(f"Неподдерживаемый формат манифеста томов '{archive_name}'.")
+    with open(target_path, 'wb') as f:
+        f.truncate(manifest['size'])
+
+    get_repository, close_repositories = _per_thread_repositories(repository)
+
+    def fetch_volume(volume, offset):
+        with open(target_path, 'r+b') as f:
+            f.seek(offset)
+            sink = HashingWriter(f, progress)
+            get_repository().read_into(volume['name'], sink)
+        if sink.written != volume['size'] or sink.hash.hexdigest() != volume['sha256']:
+            raise IOError(f"Том '{volume['name']}' поврежден: SHA-256 или размер не совпадает с манифестом.")
+
+    offsets = [0]
+    for volume in manifest['volumes'][:-1]:
+        offsets.append(offsets[-1] + volume['size'])
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor, \
+             tqdm(total=manifest['size'], unit='B', unit_scale=True, unit_divisor=1024, desc=archive_name, ascii=True) as bar:
+            progress = LockedProgress(bar)
+            futures = [executor.submit(fetch_volume, volume, offset) for volume, offset in zip(manifest['volumes'], offsets)]
+            for future in as_completed(futures):
+                future.result()
+    finally:
+        close_repositories()
+    if hash_file_sha256(target_path) != manifest['sha256']:
+        raise IOError(f"SHA-256 собранного архива '{archive_name}' не совпадает с манифестом.")
+    return manifest
+
+def extract_backup_archive(archive_path, dest_dir, settings):
+    """Распаковывает архив бэкапа (.zip или .tar.zst) в dest_dir."""
+    if not archive_path.endswith('.tar.zst'):
+        return extract_archive_parallel(archive_path, dest_dir, settings['extract_workers'], settings['block_size'])
+    if zstandard is None:
+        raise RuntimeError("Для распаковки .tar.zst нужен пакет 'zstandard' (pip install zstandard).")
+    with open(archive_path, 'rb') as f, zstandard.ZstdDecompressor().stream_reader(f) as reader, \
+         tarfile.open(fileobj=reader, mode='r|') as tar:
+        for member in tar:
+            safe_member_path(dest_dir, member.name)
+            if member.isfile() or member.isdir():
+                tar.extract(member, dest_dir)
+
+def report_stream_upload(sent_bytes, seconds):
+    """Выводит объем и скорость потоковой загрузки бэкапа."""
+    speed = sent_bytes / seconds / (1024 * 1024) if seconds > 0 else 0
+    cprint(f"  Отправлено {sent_bytes / (1024 * 1024):.1f} MB за {seconds:.1f} с ({speed:.1f} MB/s), временный архив не создавался.", 'info')
+
+def upload_backup_to_repository(settings, destination_dir, local_backup_path, snapshot_name, source_type, ftp_conn=None, ftp_url=None):
+    """Загружает бэкап в репозиторий с дедупликацией ([Backup] dedup = yes) и удаляет локальную копию."""
+    cprint(f"Загрузка снимка '{snapshot_name}' в репозиторий бэкапов...", 'step')
+    started = time.monotonic()
+    try:
+        repository = open_backup_repository(source_type, destination_dir, settings, ftp_conn, ftp_url)
+        stats = upload_backup_dedup(repository, local_backup_path, snapshot_name, settings)
     except Exception as e:
-        cprint(f"Ошибка при создании ZIP-архива: {e}", 'error')
+        cprint(f"Ошибка при загрузке бэкапа в репозиторий: {e}", 'error')
+        cprint(f"Локальная папка бэкапа сохранена: {local_backup_path}", 'warning')
         return False
+    report_dedup_upload(stats, time.monotonic() - started)
+    cprint(f"Загрузка на {source_type.upper()} завершена.", 'success')
 
+    cprint(f"Очистка локальной папки бэкапа: '{local_backup_path}'...", 'step')
     try:
-        parent_of_root = os.path.dirname(source_versions_root)
-        grandparent_of_root = os.path.dirname(parent_of_root)
-        destination_dir = os.path.join(grandparent_of_root, 'temp', 'update_backups')
+        shutil.rmtree(local_backup_path)
+        cprint("Локальный бэкап успешно удален.", 'success')
+    except Exception as e:
+        cprint(f"ПРЕДУПРЕЖДЕНИЕ: Не удалось удалить локальную папку бэкапа: {e}", 'warning')
+    return True
+
+def upload_backup_in_volumes(config, settings, destination_dir, local_backup_path, archive_name, source_type, ftp_conn=None, ftp_url=None):
+    """Загружает бэкап многотомным архивом ([Backup] volume_size_mb > 0) и удаляет локальную копию."""
+    cprint(f"Упаковка и параллельная загрузка '{archive_name}' томами по {format_size(settings['volume_size'])} "
+           f"({settings['upload_workers']} потоков)...", 'step')
+    started = time.monotonic()
+    try:
+        repository = open_backup_repository(source_type, destination_dir, settings, ftp_conn, ftp_url, subdir='')
+        manifest, stats = upload_backup_volumes(repository, local_backup_path, archive_name, settings, config['General']['download_dir'])
+    except Exception as e:
+        cprint(f"Ошибка при загрузке бэкапа: {e}", 'error')
+        cprint(f"Локальная папка бэкапа сохранена: {local_backup_path}", 'warning')
+        return False
+    report_backup_archive(stats, manifest['size'], settings['backup_format'], settings['backup_level'])
+    seconds = time.monotonic() - started
+    cprint(f"  Загружено томов: {len(manifest['volumes'])}, {format_size(manifest['size'])} за {seconds:.1f} с "
+           f"({manifest['size'] / (1024 * 1024) / seconds if seconds > 0 else 0:.1f} MB/s).", 'info')
+    cprint(f"Загрузка на {source_type.upper()} завершена.", 'success')
+
+    cprint(f"Очистка локальной папки бэкапа: '{local_backup_path}'...", 'step')
+    try:
+        shutil.rmtree(local_backup_path)
+        cprint("Локальный бэкап успешно удален.", 'success')
+    except Exception as e:
+        cprint(f"ПРЕДУПРЕЖДЕНИЕ: Не удалось удалить локальную папку бэкапа: {e}", 'warning')
+    return True
+
+def upload_backup(config, source_versions_root, local_backup_path, service_name, source_type, ftp_conn=None, ftp_url=None):
+    """
+    Архивирует, загружает бэкап с прогресс-баром и удаляет локальную копию.
+    По умолчанию ([Backup] stream = yes) ZIP формируется на лету и сразу уходит на FTP/SMB,
+    временный архив на диск не пишется; при обрыве архив отправляется заново.
+    При stream = no архив сначала создается в download_dir, а загрузка продолжается
+    с места остановки (см. [Transfer] retries). При [Backup] volume_size_mb > 0 архив
+    загружается томами параллельно, при [Backup] dedup = yes - в репозиторий с дедупликацией.
+    """
+    if not os.path.isdir(local_backup_path):
+        cprint(f"Ошибка: Директория бэкапа '{local_backup_path}' не найдена.", 'error')
+        return False
+
+    cprint(f"\n--- Загрузка бэкапа на {source_type.upper()} ---", 'header')
+
+    try:
+        destination_dir = get_backup_destination_dir(source_versions_root)
     except Exception as e:
         cprint(f"Не удалось рассчитать путь назначения для бэкапа: {e}", 'error')
-        os.remove(final_archive_path)
         return False
 
+    settings = get_transfer_settings(config)
+    timestamp = time.strftime('%Y%m%d_%H%M%S')
+    if settings['backup_dedup']:
+        return upload_backup_to_repository(settings, destination_dir, local_backup_path, f"{service_name}_backup_{timestamp}",
+                                           source_type, ftp_conn, ftp_url)
+    settings['backup_format'] = resolve_backup_format(settings)
+    archive_name = f"{service_name}_backup_{timestamp}{get_backup_archive_ext(settings['backup_format'])}"
+    if settings['volume_size']:
+        return upload_backup_in_volumes(config, settings, destination_dir, local_backup_path, archive_name,
+                                        source_type, ftp_conn, ftp_url)
+    final_archive_path = None
+
+    if not settings['backup_stream']:
+        final_archive_path = os.path.join(config['General']['download_dir'], archive_name)
+        cprint(f"Создание архива '{archive_name}'...", 'step')
+        try:
+            with open(final_archive_path, 'wb') as archive_file:
+                stats = write_backup_archive(archive_file, local_backup_path, settings)
+            report_backup_archive(stats, os.path.getsize(final_archive_path), settings['backup_format'], settings['backup_level'])
+            cprint(f"Архив успешно создан: '{final_archive_path}'", 'success')
+        except Exception as e:
+            cprint(f"Ошибка при создании архива: {e}", 'error')
+            if os.path.exists(final_archive_path): os.remove(final_archive_path)
+            return False
+
     upload_successful = False
+    started = time.monotonic()
     try:
-        file_size = os.path.getsize(final_archive_path)
-        archive_name = os.path.basename(final_archive_path)
-
         if source_type == 'smb':
-            cprint(f"Загрузка архива на SMB...", 'step')
             os.makedirs(destination_dir, exist_ok=True)
             destination_file_path = os.path.join(destination_dir, archive_name)
-            
-            # Копируем с прогресс-баром
-            chunk_size = 1024 * 1024
-            with open(final_archive_path, 'rb') as fsrc:
-                with open(destination_file_path, 'wb') as fdst:
-                    with tqdm(
-                        total=file_size, unit='B', unit_scale=True, unit_divisor=1024,
-                        desc=archive_name, ascii=True
-                    ) as progress:
-                        while True:
-                            chunk = fsrc.read(chunk_size)
-                            if not chunk: break
-                            fdst.write(chunk)
-                            progress.update(len(chunk))
-            
-            os.remove(final_archive_path) # Удаляем исходный файл после копирования
+
+            if final_archive_path:
+                cprint(f"Загрузка архива на SMB...", 'step')
+                # Копируем с прогресс-баром
+                copy_file_resumable(
+                    final_archive_path, destination_file_path, archive_name,
+                    retries=settings['retries'], retry_delay=settings['retry_delay'], block_size=settings['block_size']
+                )
+                os.remove(final_archive_path) # Удаляем исходный файл после копирования
+            else:
+                cprint(f"Потоковая упаковка и загрузка '{archive_name}' на SMB...", 'step')
+                sent, stats = upload_backup_stream_smb(local_backup_path, destination_file_path, settings)
+                report_backup_archive(stats, sent, settings['backup_format'], settings['backup_level'])
+                report_stream_upload(sent, time.monotonic() - started)
             cprint("Загрузка на SMB завершена.", 'success')
             upload_successful = True
 
         elif source_type == 'ftp':
             if not ftp_conn: raise ConnectionError("FTP соединение не установлено.")
-            cprint(f"Загрузка архива на FTP...", 'step')
-            
+
             destination_dir_ftp = destination_dir.replace('\\', '/')
             try:
                 ftp_conn.cwd('/')
@@ -944,27 +4648,30 @@ def upload_backup(config, source_versions_root, local_backup_path, service_name,
                         ftp_conn.cwd(part)
             except ftplib.all_errors as e:
                 raise IOError(f"Не удалось создать/перейти в директорию на FTP: {e}")
-
-            # Загружаем файл с прогресс-баром
-            with open(final_archive_path, 'rb') as f:
-                with tqdm(
-                    total=file_size, unit='B', unit_scale=True, unit_divisor=1024,
-                    desc=archive_name, ascii=True
-                ) as progress:
-                    # Создаем коллбэк, который будет передавать РАЗМЕР блока, а не сам блок
-                    def progress_callback(chunk):
-                        progress.update(len(chunk))
-                    
-                    ftp_conn.storbinary(f'STOR {archive_name}', f, callback=progress_callback)
-            
-            os.remove(final_archive_path)
+            remote_dir = '/' + '/'.join(path_parts)
+
+            if final_archive_path:
+                cprint(f"Загрузка архива на FTP...", 'step')
+                # Загружаем файл с прогресс-баром
+                ftp_upload_resumable(
+                    ftp_conn, ftp_url, remote_dir, final_archive_path, archive_name,
+                    retries=settings['retries'], retry_delay=settings['retry_delay']
+                )
+                os.remove(final_archive_path)
+            else:
+                cprint(f"Потоковая упаковка и загрузка '{archive_name}' на FTP...", 'step')
+                sent, stats = upload_backup_stream_ftp(ftp_conn, ftp_url, remote_dir, local_backup_path, archive_name, settings)
+                report_backup_archive(stats, sent, settings['backup_format'], settings['backup_level'])
+                report_stream_upload(sent, time.monotonic() - started)
             cprint("Загрузка на FTP завершена.", 'success')
             upload_successful = True
 
     except Exception as e:
         cprint(f"Ошибка при загрузке бэкапа: {e}", 'error')
-        if os.path.exists(final_archive_path):
+        if final_archive_path and os.path.exists(final_archive_path):
              cprint(f"Локальный архив сохранен для ручного копирования: {final_archive_path}", 'warning')
+        else:
+             cprint(f"Локальная папка бэкапа сохранена: {local_backup_path}", 'warning')
         return False
 
     if upload_successful:
@@ -977,10 +4684,15 @@ def upload_backup(config, source_versions_root, local_backup_path, service_name,
     
     return upload_successful
 
-def download_and_place_installers(server_info, update_source_info, ftp_conn=None):
+def download_and_place_installers(server_info, update_source_info, ftp_conn=None, ftp_url=None, settings=None, target_dir=None):
     """
     Находит, загружает и размещает .exe установщики с отображением прогресс-бара.
+    При включенном кэше установщики берутся из него и размещаются жесткими ссылками.
+    Если в index.json есть SHA-256 установщика, загруженный файл сверяется с ним.
+    :param target_dir: Куда класть установщики (подпапки Front/BackOffice); по умолчанию
+                       '<server_dir>/exploded/update'.
     """
+    settings = settings or get_transfer_settings(None)
     server_type = server_info['type']
     server_dir = server_info['server_dir']
     source_type = update_source_info['source']
@@ -988,11 +4700,8 @@ def download_and_place_installers(server_info, update_source_info, ftp_conn=None
 
     cprint(f"  Поиск и размещение установщиков для сервера типа '{server_type}'...", 'step')
 
-    installer_map = {
-        'Setup.Front.exe': 'Front',
-        'Setup.RMS.BackOffice.exe': 'BackOffice',
-        'Setup.Chain.BackOffice.exe': 'BackOffice'
-    }
+    installer_map = INSTALLER_SUBDIRS
+    target_dir = target_dir or os.path.join(server_dir, 'exploded', 'update')
 
     files_to_process = []
     if server_type == 'iikoRMS':
@@ -1009,55 +4718,52 @@ def download_and_place_installers(server_info, update_source_info, ftp_conn=None
             target_subdir = installer_map.get(filename)
             if not target_subdir: continue
 
-            destination_folder = os.path.join(server_dir, 'exploded', 'update', target_subdir)
+            destination_folder = os.path.join(target_dir, target_subdir)
             destination_file_path = os.path.join(destination_folder, filename)
             os.makedirs(destination_folder, exist_ok=True)
 
-            if source_type == 'smb':
-                source_file_path = os.path.join(source_path, filename)
-                if os.path.exists(source_file_path):
-                    # --- TQDM-based copy for SMB ---
-                    file_size = os.path.getsize(source_file_path)
-                    chunk_size = 1024 * 1024
-                    with open(source_file_path, 'rb') as fsrc:
-                        with open(destination_file_path, 'wb') as fdst:
-                            with tqdm(
-                                total=file_size, unit='B', unit_scale=True, unit_divisor=1024,
-                                desc=filename, ascii=True
-                            ) as progress:
-                                while True:
-                                    chunk = fsrc.read(chunk_size)
-                                    if not chunk: break
-                                    fdst.write(chunk)
-                                    progress.update(len(chunk))
+            def fetch_installer(dest_path):
+                if source_type == 'smb':
+                    copy_file(os.path.join(source_path, filename), dest_path, filename, block_size=settings['block_size'])
                 else:
+                    ftp_download_resumable(
+                        ftp_conn, ftp_url, '/' + source_path.strip('/'), filename, dest_path,
+                        retries=settings['retries'], retry_delay=settings['retry_delay'],
+                        blocksize=settings['ftp_blocksize'], queue_blocks=settings['write_queue_blocks']
+                    )
+
+            if source_type == 'smb':
+                if not os.path.exists(os.path.join(source_path, filename)):
                     cprint(f"    ПРЕДУПРЕЖДЕНИЕ: Установщик '{filename}' не найден на SMB.", 'warning')
                     all_successful = False
+                    continue
 
             elif source_type == 'ftp':
                 if not ftp_conn: raise ConnectionError("FTP соединение не установлено.")
                 
-                # --- TQDM-based download for FTP ---
                 absolute_ftp_path = '/' + source_path.strip('/')
                 ftp_conn.cwd(absolute_ftp_path)
                 
                 file_list = ftp_conn.nlst()
-                if filename in file_list:
-                    file_size = ftp_conn.size(filename)
-                    with open(destination_file_path, 'wb') as local_file:
-                        with tqdm(
-                            total=file_size, unit='B', unit_scale=True, unit_divisor=1024,
-                            desc=filename, ascii=True
-                        ) as progress:
-                            def progress_callback(chunk):
-                                local_file.write(chunk)
-                                progress.update(len(chunk))
-                            
-                            ftp_conn.retrbinary(f'RETR {filename}', progress_callback)
-                else:
+                if filename not in file_list:
                     cprint(f"    ПРЕДУПРЕЖДЕНИЕ: Установщик '{filename}' не найден на FTP.", 'warning')
                     all_successful = False
-                
+                    try: ftp_conn.cwd('/')
+                    except: pass
+                    continue
+
+            if settings['cache_max_bytes'] > 0:
+                size, mtime = get_remote_file_facts(source_type, source_path, filename, ftp_conn)
+                cached_path = get_cached_file(settings, source_type, update_source_info['version'], filename, size, mtime, fetch_installer)
+                place_file(cached_path, destination_file_path)
+            else:
+                fetch_installer(destination_file_path)
+
+            if not verify_file_sha256(destination_file_path, indexed_sha256(update_source_info, 'installer_info', filename, ftp_conn)):
+                os.remove(destination_file_path)
+                all_successful = False
+
+            if source_type == 'ftp':
                 try: ftp_conn.cwd('/')
                 except: pass
 
@@ -1065,11 +4771,141 @@ def download_and_place_installers(server_info, update_source_info, ftp_conn=None
             cprint(f"!!! ОШИБКА при обработке установщика '{filename}': {e}", 'error')
             all_successful = False
             if source_type == 'ftp' and ftp_conn:
+                discard_partial_download(os.path.join(target_dir, installer_map.get(filename, ''), filename) + '.part')
                 try: ftp_conn.cwd('/')
                 except: pass
 
     return all_successful
 
+def open_log_shared(path):
+    """
+    Открывает файл на чтение, не мешая другим процессам писать, переименовывать и удалять его.
+    Обычный open() в Windows не дает FILE_SHARE_DELETE, и, пока файл открыт, Tomcat не может ротировать лог.
+    """
+    if os.name != 'nt' or msvcrt is None: return open(path, 'rb', buffering=0)
+    GENERIC_READ, OPEN_EXISTING, FILE_ATTRIBUTE_NORMAL = 0x80000000, 3, 0x80
+    FILE_SHARE_ALL = 0x1 | 0x2 | 0x4 # READ | WRITE | DELETE
+    kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+    kernel32.CreateFileW.restype = wintypes.HANDLE
+    kernel32.CreateFileW.argtypes = [wintypes.LPCWSTR, wintypes.DWORD, wintypes.DWORD, ctypes.c_void_p, wintypes.DWORD, wintypes.DWORD, wintypes.HANDLE]
+    handle = kernel32.CreateFileW(path, GENERIC_READ, FILE_SHARE_ALL, None, OPEN_EXISTING, FILE_ATTRIBUTE_NORMAL, None)
+    if handle == wintypes.HANDLE(-1).value: raise ctypes.WinError(ctypes.get_last_error())
+    return os.fdopen(msvcrt.open_osfhandle(handle, os.O_RDONLY), 'rb', buffering=0)
+
+def decode_log_text(data):
+    """Декодирует целые строки лога: UTF-8, а если это не UTF-8 - построчно с откатом на cp1251."""
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return '\n'.join(decode_bytes_with_fallbacks(line, fallbacks=['utf-8', 'cp1251'], errors='strict') or line.decode('cp1251', errors='replace')
+                         for line in data.split(b'\n'))
+
+class LogTailer:
+    """
+    Чтение дописываемого лога без повторного открытия: один дескриптор на все время, чтение частями
+    по chunk_size байт. Незавершенная строка остается в буфере до следующего чтения, поэтому строка
+    или многобайтовый символ на границе частей не разрываются. Усечение файла (размер меньше прочитанного)
+    и ротация (по пути теперь другой файл) обнаруживаются: после ротации старый файл дочитывается до конца
+    и чтение продолжается с начала нового.
+    Строка длиннее max_line выводится частями, разрезанными по границе символа. Чтобы искомый текст на стыке
+    частей не терялся, последние overlap символов предыдущей части той же строки доступны в self.context.
+    """
+    def __init__(self, path, chunk_size=LOG_READ_CHUNK, max_line=LOG_MAX_LINE, overlap=0):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.max_line = max_line
+        self.overlap = overlap
+        self.file = None
+        self.position = 0
+        self.partial = b''
+        self.carry = '' # хвост уже выведенной части незавершенной длинной строки
+        self.context = '' # текст строки перед последней выданной частью (пусто, если это начало строки)
+        self.stats = {'bytes': 0, 'lines': 0, 'truncations': 0, 'rotations': 0}
+
+    def _open(self):
+        try:
+            self.file = open_log_shared(self.path)
+        except OSError:
+            return False # файла еще нет или он в момент ротации
+        self.position = 0
+        self.partial = b''
+        self.carry = ''
+        return True
+
+    def _replaced(self):
+        """True, если по пути лога теперь другой файл (или его нет)."""
+        try:
+            path_stat = os.stat(self.path)
+        except OSError:
+            return True
+        handle_stat = os.fstat(self.file.fileno())
+        return (path_stat.st_dev, path_stat.st_ino) != (handle_stat.st_dev, handle_stat.st_ino)
+
+    def _split_long_line(self):
+        """Отрезает от слишком длинной незавершенной строки часть, не разрывая многобайтовый символ UTF-8."""
+        partial = self.partial
+        for cut in range(len(partial), max(len(partial) - 4, 0), -1):
+            try:
+                text = partial[:cut].decode('utf-8')
+                break
+            except UnicodeDecodeError:
+                continue # конец части приходится на середину символа
+        else:
+            cut, text = len(partial), decode_log_text(partial) # не UTF-8: однобайтовая кодировка режется где угодно
+        self.partial = partial[cut:]
+        return text
+
+    def _split(self, data):
+        """Добавляет данные к незавершенной строке и возвращает готовые строки парами (context, строка)."""
+        data = self.partial + data
+        end = data.rfind(b'\n') + 1
+        self.partial = data[end:]
+        lines = decode_log_text(data[:end - 1]).split('\n') if end else []
+        pieces = [('', line.rstrip('\r')) for line in lines]
+        if pieces:
+            pieces[0] = (self.carry, pieces[0][1])
+            self.carry = ''
+        if len(self.partial) > self.max_line:
+            text = self._split_long_line()
+            pieces.append((self.carry, text))
+            self.carry = (self.carry + text)[-self.overlap:] if self.overlap else ''
+        self.stats['lines'] += len(lines)
+        return pieces
+
+    def _drain(self):
+        while True:
+            chunk = self.file.read(self.chunk_size)
+            if not chunk: return
+            self.position += len(chunk)
+            self.stats['bytes'] += len(chunk)
+            for context, line in self._split(chunk):
+                self.context = context
+                yield line
+
+    def read_lines(self):
+        """Генератор новых полных строк, появившихся с прошлого вызова. Памяти нужно не больше chunk_size + max_line."""
+        if self.file is None and not self._open(): return
+        if os.fstat(self.file.fileno()).st_size < self.position:
+            # Файл усечен на месте: читаем заново с начала
+            self.stats['truncations'] += 1
+            self.file.seek(0)
+            self.position = 0
+            self.partial = b''
+            self.carry = ''
+        yield from self._drain()
+        if self._replaced():
+            # Ротация: старый файл уже дочитан, его хвост без перевода строки тоже выводим
+            self.stats['rotations'] += 1
+            tail, self.context = self.partial, self.carry
+            self.close()
+            if tail: yield decode_log_text(tail).rstrip('\r')
+            if self._open(): yield from self._drain()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
 def monitor_log_in_thread(log_path, stop_event, success_event, success_message):
     """
     Эта функция выполняется в отдельном потоке, отслеживая лог-файл.
@@ -1079,39 +4915,64 @@ def monitor_log_in_thread(log_path, stop_event, success_event, success_message):
     :param success_message: Строка, которую ищем в логе.
     """
     cprint("  (Поток-наблюдатель запущен...)", 'step')
-    last_pos = 0
-    while not stop_event.is_set():
-        try:
-            if not os.path.exists(log_path):
-                time.sleep(1) # Ждем, если файл временно исчез
-                continue
+    tailer = LogTailer(log_path, overlap=len(success_message) - 1)
+    try:
+        while not stop_event.is_set():
+            try:
+                for line in tailer.read_lines():
+                    print(f"    {line}")
+                    if success_message in tailer.context + line:
+                        cprint("\n  (Поток-наблюдатель нашел сообщение об успехе!)", 'success')
+                        success_event.set() # Сигнализируем об успехе
+                        return # Завершаем поток
+                    if stop_event.is_set(): break
+            except Exception as e:
+                cprint(f"\n  (Ошибка в потоке-наблюдателе: {e})", 'warning')
+                tailer.close() # при следующем опросе файл откроется заново
 
-            with open(log_path, 'rb') as f:
-                f.seek(last_pos)
-                chunk = f.read()
-                if chunk:
-                    decoded_chunk = decode_bytes_with_fallbacks(chunk, fallbacks=['utf-8', 'cp1251', 'cp866'], errors='ignore')
-                    if decoded_chunk:
-                        lines = decoded_chunk.splitlines()
-                        for line in lines:
-                            print(f"    {line}")
-                            if success_message in line:
-                                cprint("\n  (Поток-наблюдатель нашел сообщение об успехе!)", 'success')
-                                success_event.set() # Сигнализируем об успехе
-                                return # Завершаем поток
-                    last_pos = f.tell()
-        except Exception as e:
-            cprint(f"\n  (Ошибка в потоке-наблюдателе: {e})", 'warning')
-        
-        # Небольшая пауза, чтобы не нагружать процессор
-        time.sleep(LOG_POLL_INTERVAL)
+            # Небольшая пауза, чтобы не нагружать процессор
+            stop_event.wait(LOG_POLL_INTERVAL)
+    finally:
+        tailer.close()
     cprint("\n  (Поток-наблюдатель остановлен)", 'step')
 
 # --- Основная логика программы ---
 
+def parse_arguments():
+    """Разбирает аргументы командной строки."""
+    parser = argparse.ArgumentParser(description="Утилита автоматизированного обновления серверов iikoRMS/iikoChain.")
+    parser.add_argument('--rescan', action='store_true',
+                        help="Игнорировать каталог версий и заново просканировать все папки на FTP/SMB.")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Скачать архив и показать, какие файлы изменятся при инкрементальном развертывании, не останавливая службу.")
+    subparsers = parser.add_subparsers(dest='command')
+    index_parser = subparsers.add_parser('build-index', help=f"Просканировать корень дистрибутивов и записать {MANIFEST_FILE_NAME}.")
+    index_parser.add_argument('--source', choices=['smb', 'ftp'],
+                              help="Где строить индекс (по умолчанию SMB, если он указан в config.ini, иначе FTP).")
+    rollback_parser = subparsers.add_parser('rollback', help="Откатить сервер к версии из локального бэкапа.")
+    rollback_parser.add_argument('--backup', help="Путь к папке бэкапа (по умолчанию - выбор из списка в backup_dir).")
+    restore_parser = subparsers.add_parser('restore-backup', help="Восстановить снимок из репозитория бэкапов на SMB/FTP в локальную папку.")
+    restore_parser.add_argument('--snapshot', help="Имя снимка (по умолчанию - выбор из списка).")
+    restore_parser.add_argument('--source', choices=['smb', 'ftp'],
+                                help="Где находится репозиторий (по умолчанию SMB, если он указан в config.ini, иначе FTP).")
+    restore_parser.add_argument('--target', help="Куда восстановить (по умолчанию - папка с именем снимка в backup_dir).")
+    return parser.parse_args()
+
 if __name__ == "__main__":
     
+    args = parse_arguments()
     init() # Инициализация colorama
+
+    if args.command == 'build-index':
+        # Публикация индекса не требует прав администратора и выбора сервера
+        config = load_config(CONFIG_FILE)
+        if config is None: sys.exit(1)
+        sys.exit(0 if run_build_index(config, args.source) else 1)
+    if args.command == 'restore-backup':
+        # Сборка снимка в локальную папку не требует прав администратора
+        config = load_config(CONFIG_FILE)
+        if config is None: sys.exit(1)
+        sys.exit(0 if run_restore_backup_command(config, args.snapshot, args.source, args.target) else 1)
     cprint("--- Утилита автоматизированного обновления серверов iikoRMS ---", 'header')
     
     # Попытка повышения прав UAC
@@ -1134,10 +4995,17 @@ if __name__ == "__main__":
              cprint("Не удалось загрузить конфигурацию после редактирования. Выход.", 'warning')
              exit()
 
+    configure_service_control(config)
+
     # Убедимся, что директории для скачивания и бэкапов существуют
     os.makedirs(config['General']['download_dir'], exist_ok=True)
     os.makedirs(config['General']['backup_dir'], exist_ok=True)
 
+    if args.command == 'rollback':
+        rollback_ok = run_rollback_command(config, args.backup)
+        prompt("Нажмите Enter для выхода.")
+        sys.exit(0 if rollback_ok else 1)
+
     # 2. Поиск локальных серверов
     service_keywords = config['Services'].get('keywords', DEFAULT_CONFIG['Services']['keywords'])
     found_servers = get_service_info_wmic(service_keywords) 
@@ -1154,15 +5022,34 @@ if __name__ == "__main__":
     ftp_conn = None
     ftp_base_path = ''
     available_versions = {} 
+    catalog_refresh = None
 
     if ftp_url:
-        ftp_conn, ftp_base_path = connect_ftp(ftp_url)
-        if ftp_conn: available_versions.update(find_versions_on_ftp(ftp_conn, ftp_base_path))
-        else: cprint("Пропуск поиска на FTP из-за ошибки подключения.", 'warning')
+        ftp_conn, ftp_base_path = connect_ftp(ftp_url, timeout=FTP_TIMEOUT)
+        if not ftp_conn: cprint("Пропуск поиска на FTP из-за ошибки подключения.", 'warning')
     else: cprint("FTP URL не указан в config.ini. Пропуск поиска на FTP.", 'warning')
+    if not smb_path: cprint("SMB Path не указан в config.ini. Пропуск поиска на SMB.", 'warning')
+
+    settings = get_transfer_settings(config)
+    discovery_workers = get_config_int(config, 'Transfer', 'discovery_workers')
+    catalog = load_version_catalog(settings['cache_dir'])
+    source_keys = []
+    if ftp_conn: source_keys.append(catalog_source_key('ftp', ftp_url))
+    if smb_path: source_keys.append(catalog_source_key('smb', smb_path))
 
-    if smb_path: available_versions.update(find_versions_on_smb(smb_path))
-    else: cprint("SMB Path не указан в config.ini. Пропуск поиска на SMB.", 'warning')
+    cached_versions, catalog_age = (None, None) if args.rescan else get_fresh_catalog_versions(
+        catalog, source_keys, get_config_int(config, 'Cache', 'catalog_ttl')
+    )
+    if cached_versions:
+        available_versions = cached_versions
+        cprint(f"Список версий загружен из каталога (обновлен {catalog_age / 60:.0f} мин назад). Проверка изменений выполняется в фоне.", 'info')
+        catalog_refresh = start_background_catalog_refresh(settings['cache_dir'], ftp_url, bool(ftp_conn), smb_path, discovery_workers)
+    elif source_keys:
+        if args.rescan: cprint("Полное сканирование источников обновлений (--rescan)...", 'step')
+        available_versions = scan_update_sources(
+            catalog, ftp_conn, ftp_url, ftp_base_path, smb_path, discovery_workers, revalidate=not args.rescan
+        )
+        save_version_catalog(settings['cache_dir'], catalog)
 
     if not available_versions:
         cprint("\nНе найдено доступных версий обновлений ни на FTP, ни на SMB. Проверьте настройки в config.ini и наличие архивов в директориях.", 'error')
@@ -1224,11 +5111,19 @@ if __name__ == "__main__":
     else: cprint("Учетная запись службы уже 'LocalSystem'.", 'info')
     # --- Конец проверки и изменения учетной записи ---
 
+    if catalog_refresh is not None:
+        if catalog_refresh['thread'].is_alive():
+            cprint("\nФоновая проверка каталога версий еще выполняется. Показан список из каталога.", 'info')
+        elif catalog_refresh['versions']:
+            if sorted(catalog_refresh['versions']) != sorted(available_versions):
+                cprint("\nКаталог версий обновлен: список изменился с прошлого сканирования.", 'info')
+            available_versions = catalog_refresh['versions']
+
     cprint("\nДоступные версии для обновления:", 'step')
     version_keys = sorted(available_versions.keys()) 
     for i, key in enumerate(version_keys):
         info = available_versions[key]
-        cprint(f"{i + 1}. {key} (Архивы: {', '.join(info['archives'])})", 'info') 
+        cprint(f"{i + 1}. {key} (Архивы: {format_archive_list(info)})", 'info') 
 
     selected_version_index = -1
     while selected_version_index < 0 or selected_version_index >= len(version_keys):
@@ -1275,7 +5170,9 @@ if __name__ == "__main__":
     cprint(f"Выбранный архив: {selected_version_info['selected_archive']}", 'step')
 
 
-    confirm = prompt("Вы уверены, что хотите продолжить? (да/нет/y/n): ").lower()
+    if args.dry_run:
+        cprint("Пробный запуск: служба не будет остановлена, файлы сервера не изменятся.", 'info')
+    confirm = 'y' if args.dry_run else prompt("Вы уверены, что хотите продолжить? (да/нет/y/n): ").lower()
     if confirm not in ['да', 'y']:
         cprint("Обновление отменено пользователем.", 'warning')
         if ftp_conn: 
@@ -1286,7 +5183,10 @@ if __name__ == "__main__":
 
     # 5. Скачивание/Копирование архива
     cprint("\n--- Скачивание/Копирование архива обновления ---", 'header')
-    downloaded_archive_path = download_update_archive(selected_version_info, config['General']['download_dir'], ftp_conn=ftp_conn)
+    downloaded_archive_path = download_update_archive(
+        selected_version_info, config['General']['download_dir'], ftp_conn=ftp_conn,
+        ftp_url=ftp_url, settings=get_transfer_settings(config)
+    )
 
     if not downloaded_archive_path:
         cprint("Ошибка при скачивании/копировании архива обновления. Процедура прервана.", 'error')
@@ -1296,13 +5196,23 @@ if __name__ == "__main__":
         prompt("Нажмите Enter для выхода.")
         sys.exit(1)
 
+    if args.dry_run:
+        dry_run_ok = run_deploy_dry_run(selected_server, downloaded_archive_path, get_transfer_settings(config))
+        if ftp_conn:
+            try: ftp_conn.quit()
+            except: pass
+        report_archive_cache(get_transfer_settings(config))
+        prompt("Нажмите Enter для выхода.")
+        sys.exit(0 if dry_run_ok else 1)
+
     # 6. Выполнение процедуры обновления
     update_successful, created_backup_path, monitoring_skipped = perform_update(
         server_info=selected_server,
         downloaded_archive_path=downloaded_archive_path,
         backup_base_dir=config['General']['backup_dir'],
         selected_version_info=selected_version_info,
-        ftp_conn=ftp_conn
+        ftp_conn=ftp_conn,
+        ftp_url=ftp_url
     )
 
     # 7. Загрузка бэкапа на исходный ресурс
@@ -1331,7 +5241,8 @@ if __name__ == "__main__":
                 local_backup_path=created_backup_path,
                 service_name=selected_server['name'],
                 source_type=source_type,
-                ftp_conn=ftp_conn
+                ftp_conn=ftp_conn,
+                ftp_url=ftp_url
             )
         else:
             # Если пользователь следил за логом, спрашиваем как раньше
@@ -1343,7 +5254,8 @@ if __name__ == "__main__":
                     local_backup_path=created_backup_path,
                     service_name=selected_server['name'],
                     source_type=source_type,
-                    ftp_conn=ftp_conn
+                    ftp_conn=ftp_conn,
+                    ftp_url=ftp_url
                 )
             else:
                 cprint("Загрузка бэкапа пропущена. Локальный бэкап сохранен в:", created_backup_path, 'warning')
@@ -1356,5 +5268,6 @@ if __name__ == "__main__":
         try: ftp_conn.quit()
         except: pass
 
+    report_archive_cache(get_transfer_settings(config))
     cprint("\n--- Программа завершила работу ---", 'header')
     prompt("Нажмите Enter для выхода.")
\ No newline at end of file
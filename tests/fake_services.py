@@ -0,0 +1,121 @@
+"""Службы в памяти процесса вместо диспетчера служб Windows: подставляются через iiko_updater.set_service_control."""
+import os
+import signal
+import subprocess
+import sys
+import threading
+
+# Процесс тестовой службы: игнорирует SIGTERM и держит дочерний процесс, как зависший при остановке Tomcat
+FAKE_SERVICE_PROCESS = (
+    "import signal, subprocess, sys, time; signal.signal(signal.SIGTERM, signal.SIG_IGN); "
+    "subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(3600)']); time.sleep(3600)"
+)
+
+
+class FakeServiceControl:
+    """
+    Службы в памяти процесса для проверки логики обновления без Windows.
+    services: {имя: статус} или {имя: {'status': ..., 'account': ..., 'display_name': ..., 'path': ...}}. Запуск и остановка
+    проходят через 'Start pending'/'Stop pending' и завершаются через start_delay/stop_delay секунд.
+    С 'process': True у работающей службы есть настоящий процесс (с дочерним процессом), который не реагирует
+    на SIGTERM; с 'hang_on_stop': True остановка зависает в 'Stop pending', и помогает только kill();
+    с 'reject_stop': True запрос остановки отклоняется без смены статуса, как при ERROR_SERVICE_CANNOT_ACCEPT_CTRL.
+    """
+    label = 'тестовые службы'
+
+    def __init__(self, services, start_delay=0.5, stop_delay=0.5):
+        self.condition = threading.Condition()
+        self.services = {}
+        for name, info in services.items():
+            info = {'status': info} if isinstance(info, str) else dict(info)
+            info.setdefault('account', 'LocalSystem')
+            self.services[name] = info
+        self.start_delay = start_delay
+        self.stop_delay = stop_delay
+        self.calls = [] # (операция, служба) в порядке вызова
+        self.processes = {}
+        for name, info in self.services.items():
+            if info['status'] == 'Running': self._spawn(name)
+
+    def _spawn(self, service_name):
+        if not self.services[service_name].get('process'): return
+        # Отдельная группа процессов: kill() завершает все дерево, как taskkill /T
+        self.processes[service_name] = subprocess.Popen([sys.executable, '-c', FAKE_SERVICE_PROCESS], start_new_session=True)
+
+    def _reap(self, service_name):
+        process = self.processes.pop(service_name, None)
+        if process is None: return
+        try:
+            if hasattr(os, 'killpg'): os.killpg(process.pid, signal.SIGKILL)
+            else: process.kill()
+        except OSError: pass
+        process.wait()
+
+    def set_status(self, service_name, status):
+        """Меняет статус службы и будит ожидающих (в том числе извне, как сделал бы администратор)."""
+        with self.condition:
+            self.services[service_name]['status'] = status
+            if status == 'Running' and service_name not in self.processes: self._spawn(service_name)
+            if status == 'Stopped': self._reap(service_name)
+            self.condition.notify_all()
+
+    def _transition(self, service_name, pending, final, delay):
+        timer = threading.Timer(delay, self.set_status, (service_name, final))
+        timer.daemon = True
+        self.set_status(service_name, pending)
+        timer.start()
+
+    def status(self, service_name):
+        with self.condition:
+            info = self.services.get(service_name)
+            return info['status'] if info else None
+
+    def logon_account(self, service_name):
+        with self.condition:
+            info = self.services.get(service_name)
+            return info['account'] if info else None
+
+    def list_services(self, keywords=None):
+        with self.condition:
+            return [
+                {'Name': name, 'DisplayName': info.get('display_name', name), 'State': info['status'],
+                 'PathName': info.get('path', ''), 'StartName': info['account']}
+                for name, info in self.services.items()
+                if not keywords or any(k.lower() in name.lower() or k.lower() in info.get('display_name', name).lower() for k in keywords)
+            ]
+
+    def start(self, service_name):
+        self.calls.append(('start', service_name))
+        status = self.status(service_name)
+        if status is None: return False
+        if status not in ('Running', 'Start pending'): self._transition(service_name, 'Start pending', 'Running', self.start_delay)
+        return True
+
+    def stop(self, service_name):
+        self.calls.append(('stop', service_name))
+        status = self.status(service_name)
+        if status is None or self.services[service_name].get('reject_stop'): return False
+        if status in ('Stopped', 'Stop pending'): return True
+        if self.services[service_name].get('hang_on_stop'): self.set_status(service_name, 'Stop pending')
+        else: self._transition(service_name, 'Stop pending', 'Stopped', self.stop_delay)
+        return True
+
+    def process_id(self, service_name):
+        process = self.processes.get(service_name)
+        return process.pid if process else 0
+
+    def kill(self, service_name):
+        self.calls.append(('kill', service_name))
+        if service_name not in self.services: return False
+        self.set_status(service_name, 'Stopped') # как SCM после гибели процесса службы
+        return True
+
+    def wait(self, service_name, target_status, timeout):
+        with self.condition:
+            self.condition.wait_for(lambda: self.services.get(service_name, {}).get('status') in (target_status, None), timeout)
+            info = self.services.get(service_name)
+            return info['status'] if info else None
+
+    def close(self):
+        with self.condition:
+            for service_name in list(self.processes): self._reap(service_name)
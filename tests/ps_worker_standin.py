@@ -0,0 +1,27 @@
+"""
+Замена процесса PowerShell для тестов PowerShellWorker: тот же протокол (строка JSON-запроса на stdin,
+строка JSON-ответа на stdout), вместо скриптов PowerShell - команды:
+  echo <текст>  - ответ ok с текстом;   fail <текст> - ответ с ошибкой;
+  hang          - не отвечать;          exit         - завершить процесс без ответа;
+  pid           - PID процесса.
+Перед каждым ответом выводится строка, не являющаяся JSON-ответом, и ответ с чужим id.
+"""
+import json
+import os
+import sys
+import time
+
+for line in sys.stdin.buffer:
+    if not line.strip(): continue
+    request = json.loads(line.decode('utf-8'))
+    command, _, argument = request['script'].partition(' ')
+    if command == 'hang': time.sleep(3600)
+    if command == 'exit': sys.exit(3)
+    if command == 'fail': response = {'id': request['id'], 'ok': False, 'error': argument}
+    elif command == 'pid': response = {'id': request['id'], 'ok': True, 'result': os.getpid()}
+    else: response = {'id': request['id'], 'ok': True, 'result': argument}
+    out = sys.stdout.buffer
+    out.write('WARNING: вывод, не являющийся ответом\n'.encode('utf-8'))
+    out.write(json.dumps({'id': -1, 'ok': True, 'result': 'чужой ответ'}).encode('utf-8') + b'\n')
+    out.write(json.dumps(response, ensure_ascii=False).encode('utf-8') + b'\n')
+    out.flush()
@@ -0,0 +1,45 @@
+"""Архив бэкапа: ZIP, записанный write_backup_archive, читается стандартным zipfile без потерь."""
+import configparser
+import os
+import zipfile
+
+import pytest
+
+import iiko_updater
+
+
+@pytest.fixture
+def backup(tmp_path):
+    root = tmp_path / 'RMS_backup'
+    (root / 'exploded' / 'WEB-INF' / 'lib').mkdir(parents=True)
+    (root / 'logs').mkdir()
+    (root / 'exploded' / 'WEB-INF' / 'lib' / 'app.jar').write_bytes(os.urandom(50000))
+    (root / 'logs' / 'server.log').write_bytes(b'2026-10-18 INFO request done\n' * 100000) # больше одной части
+    (root / 'logs' / 'empty.log').write_bytes(b'')
+    (root / 'exploded' / 'config.xml').write_text('<config name="Центр"/>', encoding='utf-8')
+    return root
+
+
+def files_of(root):
+    return {os.path.relpath(os.path.join(d, f), root.parent).replace(os.sep, '/'): open(os.path.join(d, f), 'rb').read()
+            for d, _, names in os.walk(root) for f in names}
+
+
+@pytest.mark.parametrize('backup_format, level', [('lzma', 0), ('lzma', 6), ('deflate', 1), ('store', 0)])
+def test_archive_round_trip(backup, tmp_path, backup_format, level):
+    config = configparser.ConfigParser()
+    config.read_dict(iiko_updater.DEFAULT_CONFIG)
+    config['Backup'].update(format=backup_format, level=str(level), workers='2')
+    archive = tmp_path / 'backup.zip'
+    with open(archive, 'wb') as f:
+        iiko_updater.write_backup_archive(f, str(backup), iiko_updater.get_transfer_settings(config))
+
+    with zipfile.ZipFile(archive) as z:
+        assert z.testzip() is None
+        contents = {info.filename: z.read(info) for info in z.infolist() if not info.is_dir()}
+        methods = {info.filename: info.compress_type for info in z.infolist()}
+    assert contents == files_of(backup)
+    assert methods['RMS_backup/exploded/WEB-INF/lib/app.jar'] == zipfile.ZIP_STORED
+    expected = {'lzma': zipfile.ZIP_LZMA, 'deflate': zipfile.ZIP_DEFLATED, 'store': zipfile.ZIP_STORED}[backup_format]
+    assert methods['RMS_backup/logs/server.log'] == expected
+
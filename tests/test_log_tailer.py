@@ -0,0 +1,87 @@
+"""LogTailer: строки на границе чтений, слишком длинные строки, усечение и ротация startup.log."""
+import os
+import threading
+
+import iiko_updater
+from iiko_updater import LogTailer
+
+MARKER = iiko_updater.SUCCESS_LOG_MESSAGE
+
+
+def read_all(tailer):
+    return [(tailer.context, line) for line in tailer.read_lines()]
+
+
+def test_line_split_between_writes(tmp_path):
+    log = tmp_path / 'startup.log'
+    data = 'Запуск сервера\r\nГотово\r\n'.encode('utf-8')
+    log.write_bytes(data[:-9]) # обрыв посередине буквы
+    tailer = LogTailer(str(log), chunk_size=5)
+    assert [line for _, line in read_all(tailer)] == ['Запуск сервера']
+    with open(log, 'ab') as f: f.write(data[-9:])
+    assert [line for _, line in read_all(tailer)] == ['Готово']
+    tailer.close()
+
+
+def test_long_line_is_cut_on_character_boundary(tmp_path):
+    log = tmp_path / 'startup.log'
+    line = 'Ж' * 5000 + 'конец'
+    log.write_bytes(line.encode('utf-8') + b'\n')
+    tailer = LogTailer(str(log), chunk_size=333, max_line=1001) # нечетные размеры режут букву пополам
+    pieces = [line for _, line in read_all(tailer)]
+    tailer.close()
+    assert len(pieces) > 2
+    assert '�' not in ''.join(pieces)
+    assert ''.join(pieces) == line
+
+
+def test_marker_across_cut_of_long_line(tmp_path):
+    log = tmp_path / 'startup.log'
+    chunk, max_line = 1000, 3000
+    # Часть отрезается, когда буфер превысит max_line, то есть после 4 чтений; маркер пересекает этот разрез
+    prefix = 'Ж' * ((4 * chunk - 7) // 2) + 'x' * ((4 * chunk - 7) % 2)
+    log.write_bytes((prefix + MARKER + ' ' + 'y' * 5000 + '\n').encode('utf-8'))
+    tailer = LogTailer(str(log), chunk_size=chunk, max_line=max_line, overlap=len(MARKER) - 1)
+    pieces = read_all(tailer)
+    tailer.close()
+    assert not any(MARKER in line for _, line in pieces) # ни одна часть не содержит маркер целиком
+    assert any(MARKER in context + line for context, line in pieces)
+
+
+def test_monitor_finds_marker_across_cut(tmp_path):
+    log = tmp_path / 'startup.log'
+    cut = 5 * iiko_updater.LOG_READ_CHUNK # первая часть отрезается после пятого чтения (больше LOG_MAX_LINE)
+    prefix = 'Ж' * ((cut - 5) // 2) + 'x' * ((cut - 5) % 2)
+    log.write_bytes((prefix + MARKER + '\n').encode('utf-8'))
+    stop_event, success_event = threading.Event(), threading.Event()
+    thread = threading.Thread(target=iiko_updater.monitor_log_in_thread, args=(str(log), stop_event, success_event, MARKER))
+    thread.start()
+    found = success_event.wait(5)
+    stop_event.set()
+    thread.join()
+    assert found
+
+
+def test_truncation_restarts_from_beginning(tmp_path):
+    log = tmp_path / 'startup.log'
+    log.write_bytes(b'old run line\n' * 100)
+    tailer = LogTailer(str(log))
+    assert len(read_all(tailer)) == 100
+    with open(log, 'r+b') as f:
+        f.truncate(0)
+        f.write(b'new run\n')
+    assert [line for _, line in read_all(tailer)] == ['new run']
+    assert tailer.stats['truncations'] == 1
+    tailer.close()
+
+
+def test_rotation_reads_tail_and_new_file(tmp_path):
+    log = tmp_path / 'startup.log'
+    log.write_bytes(b'before rotation\nlast line of old file')
+    tailer = LogTailer(str(log))
+    assert [line for _, line in read_all(tailer)] == ['before rotation']
+    os.rename(log, tmp_path / 'startup.log.1')
+    log.write_bytes(b'fresh line\n')
+    assert [line for _, line in read_all(tailer)] == ['last line of old file', 'fresh line']
+    assert tailer.stats['rotations'] == 1
+    tailer.close()
@@ -0,0 +1,76 @@
+"""PowerShellWorker против процесса-заменителя ps_worker_standin.py: разбор ответов, таймаут, перезапуск."""
+import os
+import sys
+import time
+
+import pytest
+
+import iiko_updater
+from iiko_updater import PowerShellWorker, PowerShellWorkerError
+
+STANDIN = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ps_worker_standin.py')]
+
+
+@pytest.fixture
+def worker():
+    worker = PowerShellWorker(command=STANDIN, timeout=5, restarts=2)
+    yield worker
+    worker.close()
+
+
+def test_requests_reuse_one_process(worker):
+    pid = worker.run('pid')[1]
+    assert worker.run('echo служба "RMS"') == (True, 'служба "RMS"')
+    assert worker.run('pid') == (True, pid)
+    assert pid != os.getpid()
+
+
+def test_error_response(worker):
+    assert worker.run("fail Cannot find any service with service name 'x'.") == (False, "Cannot find any service with service name 'x'.")
+    assert worker.failures == 0
+
+
+def test_timeout_kills_and_restarts_process(worker):
+    pid = worker.run('pid')[1]
+    started = time.monotonic()
+    with pytest.raises(PowerShellWorkerError):
+        worker.run('hang', timeout=0.5)
+    assert time.monotonic() - started < 2
+    assert worker.failures == 1 and not worker.disabled
+
+    new_pid = worker.run('pid')[1]
+    assert new_pid != pid
+    assert worker.failures == 0 # успешный запрос сбрасывает счетчик сбоев
+
+
+def test_crashes_disable_worker_after_restart_limit(worker):
+    for attempt in range(1, 3):
+        with pytest.raises(PowerShellWorkerError):
+            worker.run('exit')
+        assert worker.failures == attempt and not worker.disabled
+    with pytest.raises(PowerShellWorkerError, match='больше не используется'):
+        worker.run('exit')
+    assert worker.disabled
+    with pytest.raises(PowerShellWorkerError, match='отключен'):
+        worker.run('echo x')
+
+
+def test_missing_executable_disables_worker():
+    worker = PowerShellWorker(command=['no-such-powershell-executable'], restarts=5)
+    with pytest.raises(PowerShellWorkerError):
+        worker.run('echo x')
+    assert worker.disabled
+
+
+def test_shell_control_falls_back_to_separate_processes(worker, monkeypatch):
+    commands = []
+    monkeypatch.setattr(iiko_updater, 'run_command', lambda command, **kwargs: commands.append(command) or 'State=Running\r\r\n')
+    control = iiko_updater.ShellServiceControl(worker)
+    assert control.label == 'PowerShell/CIM (постоянный процесс)'
+
+    monkeypatch.setattr(worker, 'run', lambda script, timeout=None: (_ for _ in ()).throw(PowerShellWorkerError('нет ответа')))
+    assert control.status('RMS') == 'Running' # запрос повторен отдельным процессом wmic
+    assert commands and 'wmic' in commands[0]
+
+    worker.disabled = True
+    assert control.label == 'wmic/PowerShell'
@@ -0,0 +1,162 @@
+"""Управление службами через подставной FakeServiceControl: ожидание статусов, запуск, остановка, завершение процессов."""
+import os
+import threading
+import time
+
+import pytest
+
+import iiko_updater
+from fake_services import FakeServiceControl
+
+
+@pytest.fixture
+def install(monkeypatch):
+    """Подставляет FakeServiceControl как текущий способ управления службами."""
+    monkeypatch.setattr(iiko_updater, 'service_control', None)
+    monkeypatch.setattr(iiko_updater, 'service_discovery_cache', {})
+    controls = []
+
+    def install(services, **kwargs):
+        control = iiko_updater.set_service_control(FakeServiceControl(services, **kwargs))
+        controls.append(control)
+        return control
+
+    yield install
+    for control in controls:
+        control.close()
+
+
+def timed(func, *args, **kwargs):
+    started = time.monotonic()
+    return func(*args, **kwargs), time.monotonic() - started
+
+
+def process_group_alive(pgid):
+    """Есть ли в группе процессы, кроме зомби (Linux, через /proc)."""
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit(): continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[2]) == pgid and fields[0] != 'Z': return True
+    return False
+
+
+def eventually(predicate, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline: return False
+        time.sleep(0.02)
+    return True
+
+
+def test_wait_reacts_to_stop_without_poll_tick(install):
+    install({'RMS': 'Running'}, stop_delay=0.3)
+    assert iiko_updater.stop_service_ps('RMS')
+    assert iiko_updater.get_service_status_wmic('RMS') == 'Stop pending'
+    reached, elapsed = timed(iiko_updater.wait_for_service_status, 'RMS', 'Stopped', poll_interval=2)
+    assert reached
+    assert 0.25 < elapsed < 0.6 # смена статуса замечена сразу, а не на следующем тике в 2 с
+
+
+def test_wait_reacts_to_external_change(install):
+    control = install({'RMS': 'Stopped'})
+    threading.Timer(0.2, control.set_status, ('RMS', 'Running')).start()
+    reached, elapsed = timed(iiko_updater.wait_for_service_status, 'RMS', 'Running', poll_interval=2)
+    assert reached
+    assert elapsed < 0.5
+
+
+def test_start_goes_through_pending(install):
+    control = install({'RMS': 'Stopped'}, start_delay=0.2)
+    assert iiko_updater.start_service_ps('RMS')
+    assert iiko_updater.get_service_status_wmic('RMS') == 'Start pending'
+    assert iiko_updater.wait_for_service_status('RMS', 'Running', timeout=5)
+    assert control.calls == [('start', 'RMS')]
+
+
+def test_wait_times_out(install):
+    install({'RMS': 'Running'})
+    reached, elapsed = timed(iiko_updater.wait_for_service_status, 'RMS', 'Stopped', timeout=0.5, poll_interval=0.2)
+    assert not reached
+    assert 0.45 < elapsed < 1.0
+
+
+def test_missing_service(install):
+    install({'RMS': 'Running'})
+    assert iiko_updater.get_service_status_wmic('Other') is None
+    assert not iiko_updater.stop_service_ps('Other')
+    reached, elapsed = timed(iiko_updater.wait_for_service_status, 'Other', 'Stopped')
+    assert not reached
+    assert elapsed < 0.5
+
+
+def test_logon_account(install):
+    install({'RMS': {'status': 'Running', 'account': '.\\iiko'}})
+    assert iiko_updater.get_service_logon_account_wmic('RMS') == '.\\iiko'
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc'), reason="процессы тестовой службы проверяются через /proc")
+def test_kill_terminates_hung_process_tree(install):
+    control = install({'RMS': {'status': 'Running', 'process': True, 'hang_on_stop': True}})
+    pgid = control.process_id('RMS')
+    time.sleep(0.3) # процесс службы успевает запустить дочерний
+    assert process_group_alive(pgid)
+
+    assert iiko_updater.stop_service_ps('RMS')
+    assert not iiko_updater.wait_for_service_status('RMS', 'Stopped', timeout=0.5, poll_interval=0.5)
+    assert iiko_updater.get_service_status_wmic('RMS') == 'Stop pending'
+    assert process_group_alive(pgid) # SIGTERM не помогает, процесс висит
+
+    assert control.kill('RMS')
+    assert iiko_updater.wait_for_service_status('RMS', 'Stopped', timeout=1)
+    assert eventually(lambda: not process_group_alive(pgid)) # SIGKILL доходит до внука асинхронно
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc'), reason="процессы тестовой службы проверяются через /proc")
+def test_escalating_stop_kills_hung_service_after_timeout(install, capsys):
+    control = install({'RMS': {'status': 'Running', 'process': True, 'hang_on_stop': True}})
+    pgid = control.process_id('RMS')
+    stopped, elapsed = timed(iiko_updater.stop_service_escalating, 'RMS', timeout=0.5, kill=True, kill_wait=1)
+    assert stopped
+    assert 0.5 <= elapsed < 1.5
+    assert control.calls == [('stop', 'RMS'), ('kill', 'RMS')]
+    assert eventually(lambda: not process_group_alive(pgid))
+    output = capsys.readouterr().out
+    assert "Служба не остановилась за 0.5 с" in output
+    assert "запрос остановки" in output and "ожидание 0.5 с (неудачно)" in output and "завершение процессов" in output
+
+
+def test_escalating_stop_waits_after_rejected_request(install, capsys):
+    # Служба уже останавливается и отклоняет повторный запрос: ждем ее, а не завершаем процессы
+    control = install({'RMS': {'status': 'Running', 'reject_stop': True}})
+    control.set_status('RMS', 'Stop pending')
+    threading.Timer(0.3, control.set_status, ('RMS', 'Stopped')).start()
+    stopped, elapsed = timed(iiko_updater.stop_service_escalating, 'RMS', timeout=2, kill=True, kill_wait=1)
+    assert stopped
+    assert elapsed < 1
+    assert control.calls == [('stop', 'RMS')]
+    assert "не остановилась" not in capsys.readouterr().out
+
+
+def test_escalating_stop_after_rejected_request_kills_only_after_timeout(install):
+    control = install({'RMS': {'status': 'Running', 'reject_stop': True}})
+    stopped, elapsed = timed(iiko_updater.stop_service_escalating, 'RMS', timeout=0.5, kill=True, kill_wait=1)
+    assert stopped
+    assert elapsed >= 0.5
+    assert control.calls == [('stop', 'RMS'), ('kill', 'RMS')]
+
+
+def test_escalating_stop_without_kill(install):
+    control = install({'RMS': {'status': 'Running', 'hang_on_stop': True}})
+    assert not iiko_updater.stop_service_escalating('RMS', timeout=0.3, kill=False)
+    assert control.calls == [('stop', 'RMS')]
+    assert iiko_updater.get_service_status_wmic('RMS') == 'Stop pending'
+
+
+@pytest.mark.skipif(os.name == 'nt', reason="на Windows SCM доступен")
+def test_native_backend_falls_back_to_shell():
+    control = iiko_updater.create_service_control('native')
+    assert isinstance(control, iiko_updater.ShellServiceControl)
@@ -0,0 +1,131 @@
+"""Поиск служб: экранирование LIKE, разбор записанных ответов wmic /format:rawxml и Get-CimInstance, снимок поиска."""
+import json
+import os
+
+import pytest
+
+import iiko_updater
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+KEYWORDS = 'RMS, iiko_Chain'
+
+
+def load_fixture(name, root):
+    with open(os.path.join(FIXTURES, name), encoding='utf-8') as f:
+        return f.read().replace('@ROOT@', str(root).replace('\\', '/'))
+
+
+@pytest.fixture
+def servers(tmp_path, monkeypatch):
+    """Каталоги серверов из записанных ответов: RMS_Old и rmsagent установленного сервера не имеют."""
+    for server in ('RMS Center', 'Chain'):
+        exe = tmp_path / server / 'Tomcat9' / 'bin' / 'tomcat9.exe'
+        exe.parent.mkdir(parents=True)
+        exe.write_bytes(b'')
+    monkeypatch.setattr(iiko_updater, 'service_control', None)
+    monkeypatch.setattr(iiko_updater, 'service_discovery_cache', {})
+    return tmp_path
+
+
+@pytest.fixture
+def wmic(servers, monkeypatch):
+    """ShellServiceControl без постоянного процесса: вывод wmic берется из tests/fixtures/wmic_services.xml."""
+    output = load_fixture('wmic_services.xml', servers)
+    commands = []
+    def run_command(command, **kwargs):
+        commands.append(command)
+        return '[SC] ChangeServiceConfig SUCCESS' if 'sc.exe' in str(command) else output
+    monkeypatch.setattr(iiko_updater, 'run_command', run_command)
+    iiko_updater.set_service_control(iiko_updater.ShellServiceControl(None))
+    return commands
+
+
+class RecordedWorker:
+    """Постоянный процесс PowerShell, отвечающий записанным выводом Get-CimInstance."""
+    disabled = False
+
+    def __init__(self, services, account=None):
+        self.services = services
+        self.account = account
+        self.scripts = []
+
+    def run(self, script, timeout=None):
+        self.scripts.append(script)
+        if script.startswith('@(Get-CimInstance -Query'): return True, self.services
+        return True, self.account
+
+    def close(self):
+        pass
+
+
+@pytest.mark.parametrize('keyword, pattern', [
+    ('rms', 'rms'),
+    ('iiko_chain', 'iiko[_]chain'),
+    ('100%', '100[%]'),
+    ('[test]', '[[]test]'),
+    ("o'neill", "o\\'neill"),
+    ('c:\\iiko', 'c:\\\\iiko'),
+])
+def test_like_escaping(keyword, pattern):
+    assert iiko_updater.build_service_wql_condition([keyword]) == f"Name LIKE '%{pattern}%' OR DisplayName LIKE '%{pattern}%'"
+
+
+def test_empty_keywords_give_no_condition():
+    assert iiko_updater.build_service_wql_condition([]) == ''
+
+
+def test_parse_rawxml(servers):
+    records = iiko_updater.parse_wmic_rawxml(load_fixture('wmic_services.xml', servers))
+    assert [r['Name'] for r in records] == ['RMS_Center', 'iiko_Chain', 'RMS_Old', 'rmsagent']
+    assert records[0]['DisplayName'] == 'iikoRMS Server, ресторан "Центр" & бар'
+    assert records[0]['StartName'] == '.\\iiko'
+    assert records[3]['PathName'] == ''
+    assert iiko_updater.parse_wmic_rawxml('Node,Name\r\r\n') is None
+
+
+def test_wmic_discovery(wmic, servers):
+    found = iiko_updater.get_service_info_wmic(KEYWORDS)
+    assert [(s['name'], s['type'], s['status']) for s in found] == [('RMS_Center', 'iikoRMS', 'Running'), ('iiko_Chain', 'iikoChain', 'Stopped')]
+    assert found[0]['display_name'] == 'iikoRMS Server, ресторан "Центр" & бар'
+    assert found[0]['server_dir'] == os.path.abspath(servers / 'RMS Center')
+    assert found[1]['server_dir'] == os.path.abspath(servers / 'Chain')
+
+    # Список аргументов без shell: условие с % и _ доходит до wmic без подстановок cmd.exe
+    assert wmic == [['wmic', 'service', 'where',
+                     "Name LIKE '%rms%' OR DisplayName LIKE '%rms%' OR Name LIKE '%iiko[_]chain%' OR DisplayName LIKE '%iiko[_]chain%'",
+                     'get', 'Name,DisplayName,State,PathName,StartName', '/format:rawxml']]
+
+
+def test_wmic_snapshot_reused(wmic):
+    iiko_updater.get_service_info_wmic(KEYWORDS)
+    iiko_updater.get_service_info_wmic(KEYWORDS)
+    assert iiko_updater.get_service_logon_account_wmic('RMS_Center') == '.\\iiko'
+    assert iiko_updater.get_service_logon_account_wmic('IIKO_CHAIN') == 'LocalSystem'
+    assert len(wmic) == 1
+
+    assert iiko_updater.set_service_logon_account_sc('RMS_Center', 'LocalSystem')
+    assert iiko_updater.get_service_logon_account_wmic('RMS_Center') == 'LocalSystem'
+    assert len(wmic) == 2 and 'sc.exe config "RMS_Center"' in wmic[1]
+
+
+def test_cim_discovery(servers):
+    services = json.loads(load_fixture('cim_services.json', servers))
+    worker = RecordedWorker(services, account='.\\Администратор')
+    iiko_updater.set_service_control(iiko_updater.ShellServiceControl(worker))
+
+    found = iiko_updater.get_service_info_wmic(KEYWORDS)
+    assert [s['name'] for s in found] == ['RMS_Center', 'iiko_Chain']
+    assert found[1]['display_name'] == 'iikoChain Сервер сети «Юг»'
+    assert len(worker.scripts) == 1
+    assert "WHERE Name LIKE ''%rms%'' OR DisplayName LIKE ''%rms%'' OR Name LIKE ''%iiko[_]chain%''" in worker.scripts[0]
+
+    # null из ConvertTo-Json приводится к пустой строке, как у wmic
+    assert iiko_updater.find_discovered_service('rmsagent')['PathName'] == ''
+
+    assert iiko_updater.get_service_logon_account_wmic('RMS_Center') == '.\\iiko'
+    assert iiko_updater.get_service_info_wmic(KEYWORDS) == found
+    assert len(worker.scripts) == 1
+
+    # Службы нет в снимке: отдельный запрос, кавычка в имени экранирована для WQL и PowerShell
+    assert iiko_updater.get_service_logon_account_wmic("svc'x") == '.\\Администратор'
+    assert worker.scripts[1] == "(Get-CimInstance -ClassName Win32_Service -Filter 'Name=''svc\\''x''').StartName"